@@ -1,101 +1,721 @@
 # The PL Module offers Prolog functionality for Python programmers.
 # Created by Sawyer Redstone.
 
+import argparse
+import array
+import bisect
+import concurrent.futures
+import functools
+import heapq
+import importlib.util
+import io
 import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import socket
+import socketserver
+import string
+import struct
+import sys
+import threading
+import time
+import weakref
+
+try:
+    import numpy     # Optional. maplist uses it for long lists of floats.
+except ImportError:
+    numpy = None
 
 # Take a list, string, or int, and convert it to type Term.
-def create(term, memo = {}):
-    if str(term) in memo:
-        return memo[str(term)]
+# Memo is a dictionary of the Vars made so far, so that Vars with the same name are the same Var.
+def create(term, memo = None):
+    if memo is None:
+        memo = {}
     if isinstance(term, int) or isinstance(term, float):   # Numbers are constants.
-        memo[str(term)] = Const(term)
-    elif isinstance(term, list):
-        # If the list is empty, it is a Const; otherwise it is a ListPL.
-        memo[str(term)] = ListPL([create(item, memo) for item in term]) if term else Const(term)
-    elif isinstance(term, Goal):
+        return internConst(term)
+    if isinstance(term, list):
+        # If the list is empty, it is a Const; otherwise it is a ListPL, which ends in the term after "|" if it has one.
+        if not term:
+            return Const(term)
+        items = [create(item, memo) for item in term]
+        if len(items) > 2 and isinstance(term[-2], str) and term[-2] == "|":
+            return makeList(items[:-2], items[-1])
+        return makeList(items)
+    if isinstance(term, (set, frozenset)):
+        return SetPL.fromTerms([create(item, memo) for item in term])
+    if isinstance(term, dict):
+        return MapPL.fromPairs([(create(key, memo), create(value, memo)) for key, value in term.items()])
+    if isinstance(term, Goal):
         if term.name == "format_":
             strToWrite = term.args[0]      # The string to write, with {} in places that can be filled with vars.
             if len(term.args) > 1:
                 vars = [create(arg, memo) for arg in term.args[1]]  # The vars to fill in the string.
             else:
                 vars = []
-            memo[str(term)] = Goal(term.pred, [strToWrite, vars])
-        else:
-            memo[str(term)] = Goal(term.pred, [create(arg, memo) for arg in term.args])
-    elif term[0].isupper() and " " not in term:
-        memo[str(term)] = Var(term)
-    elif term[0] == "_":        # Vars that start with "_" are temporary.
+            return Goal(term.pred, [strToWrite, vars])
+        return Goal(term.pred, [create(arg, memo) for arg in term.args])
+    if isinstance(term, Term):
+        return term             # Terms that are already made, like lazy lists, are used as they are.
+    if term in memo:
+        return memo[term]
+    if term[0].isupper() and " " not in term:
+        memo[term] = Var(term)
+        return memo[term]
+    if term[0] == "_":          # Vars that start with "_" are temporary.
         return Var(term)        # Since all _s are different, they should not be added to memo.
     # Otherwise, it is a Const.
-    else:
-        # If string has single quotes around it, remove them.
-        if term[0] == "'" and term[-1] == "'":
-            term = term[1:-1]
-            memo[str(term)] = Const(term)
-        elif " " in term:
-            math = Math()
-            math.mathToList(term, memo)
-            memo[str(term)] = math
-        else:       # Maybe if it is the string of a num, turn it into the num.
-            try:
-                memo[str(term)] = Const(int(term))
-            except ValueError:
-                try:
-                    memo[str(term)] = Const(float(term))
-                except ValueError:
-                    memo[str(term)] = Const(term)
-    return memo[str(term)]
+    # If string has single quotes around it, remove them.
+    if term[0] == "'" and term[-1] == "'":
+        return internConst(term[1:-1])
+    if " " in term:
+        math = Math()
+        math.mathToList(term, memo)
+        return math
+    # Maybe if it is the string of a num, turn it into the num.
+    # Strings that can't be one are skipped, since raising ValueError takes time that grows with the number of
+    # generators a deep query is running.
+    if term[0] not in numberStart:
+        return internConst(term)
+    try:
+        return internConst(int(term))
+    except ValueError:
+        try:
+            return internConst(float(term))
+        except ValueError:
+            return internConst(term)
+
+
+# The characters that a string int() or float() can read may start with, like "-1", ".5", "inf" or "nan".
+numberStart = frozenset("0123456789+-.iInN" + string.whitespace)
+
+
+# Atoms and numbers are interned, so that every term that uses them shares one Const.
+# The table only holds them weakly, so a Const is dropped once no term uses it. It is a dict of weakrefs
+# rather than a WeakValueDictionary, whose get raises KeyError for new atoms (see create).
+atomTable = {}
+
+def internConst(value):
+    key = (type(value), value)
+    ref = atomTable.get(key)
+    const = ref() if ref is not None else None
+    if const is None:
+        const = Const(value)
+        atomTable[key] = weakref.ref(const, functools.partial(dropAtom, key))
+    return const
+
+
+# Removes an atom from the table once its Const is gone, unless a new Const has taken its place.
+def dropAtom(key, ref):
+    if atomTable.get(key) is ref:
+        del atomTable[key]
 
 
 class Predicate():
+    registry = weakref.WeakSet()    # Every predicate that is still in use, for memoryStats.
+    changes = 0                     # Goes up every time an alt is added to any predicate.
     def __init__(self, name):
         self.name = name            # The name of the predicate
         self.alternatives = {}      # Dict filled with all of the predicate alternatives, with arity as key.
+        self.version = 0            # Goes up every time an alt is added, so old analyses aren't used.
+        self.analyses = {}          # The ClauseAnalysis of each arity, made when it is first needed.
+        self.compiled = False       # Whether the alts are run as compiled Python code. See compile.
+        self.reordered = False      # Whether the goals of each alt are reordered before they are run. See reorder.
+        self.program = None         # The DatalogProgram that works out the predicate's facts, if it is evaluated bottom-up.
+        self.sharded = {}           # The ShardedFacts that hold the facts of each arity that was sharded. See shard.
+        self.mapped = {}            # The MappedTable that holds the facts of each arity read from a FactStore. See mapFacts.
+        Predicate.registry.add(self)
     def __repr__(self):
         return self.name
     def __call__(self, *args):
         return Goal(self, args)
+    # Returns the ClauseAnalysis of the alts with this arity, making it again if alts were added since.
+    # A predicate that is evaluated bottom-up is analyzed as the facts that its program found instead.
+    def analyze(self, arity):
+        if self.program is not None:
+            return self.program.analyze(self, arity)
+        analysis = self.analyses.get(arity)
+        if analysis is None or analysis.version != self.version:
+            version = self.version
+            analysis = ClauseAnalysis(self.alternatives.get(arity, []), version)
+            self.analyses[arity] = analysis
+        return analysis
+    # Returns the alts whose heads can unify with the args, in order.
+    # The index of whichever bound arg leaves the fewest alts is used.
+    def matchingAlts(self, args):
+        analysis = self.analyze(len(args))
+        best = None
+        for position in analysis.indexed:
+            key = callKey(args[position])
+            if key is not None:
+                if key == listKey and position in analysis.itemIndexed:
+                    itemKey = callKey(deref(args[position]).head)
+                    alts = analysis.lookup(position, key) if itemKey is None else analysis.lookupItem(position, itemKey)
+                else:
+                    alts = analysis.lookup(position, key)
+                if best is None or len(alts) < len(best):
+                    best = alts
+                    if len(best) <= 1:
+                        break
+        return analysis.alts if best is None else best
+    # Makes the predicate run its alts as compiled Python code, or go back to the interpreter with enabled = False.
+    # Alts added later are compiled the first time they are tried.
+    def compile(self, enabled = True):
+        self.compiled = enabled
+        if enabled:
+            for alts in list(self.alternatives.values()):
+                for alt in alts:
+                    compileAlt(alt)
+        return self
+    # Makes the predicate's answers come from all of its facts, worked out at once by a DatalogProgram,
+    # or go back to running its alts with enabled = False. Raises a ValueError if it isn't Datalog.
+    def bottomUp(self, enabled = True):
+        self.program = DatalogProgram(self) if enabled else None
+        return self
+    # Like bottomUp, but when facts are added or retracted, only the facts that depend on them are updated.
+    def materialize(self, enabled = True):
+        self.program = DatalogProgram(self, incremental = True) if enabled else None
+        return self
+    # Moves the facts of each arity into worker processes, split up by the value of the arg at position.
+    # Goals with that arg bound are only sent to one worker, and other goals are sent to all of them.
+    # Facts added or retracted later go to the workers too. Raises a ValueError if an arity has rules, or
+    # facts whose args aren't all atoms and numbers. With enabled = False, the facts come back into this process.
+    def shard(self, position = 0, workers = 4, enabled = True):
+        with kbLock:
+            if not enabled:
+                for arity, shards in list(self.sharded.items()):
+                    self.alternatives[arity] = [Alt(self, [rawArg(value) for value in row], [])
+                        for row in shards.lookup((), ())]
+                    del self.sharded[arity]
+                    shards.close()
+            else:
+                for arity, alts in list(self.alternatives.items()):
+                    analysis = self.analyze(arity)
+                    if analysis.facts is None or position >= arity:
+                        raise ValueError(self.name + "/" + str(arity) + " can't be sharded, since it "
+                            + ("has an arg that isn't an atom or number, or a rule." if analysis.facts is None
+                                else "doesn't have an arg at position " + str(position) + "."))
+                for arity in list(self.alternatives):
+                    self.sharded[arity] = ShardedFacts(position, workers, self.analyze(arity).facts)
+                    del self.alternatives[arity]
+            self.version += 1
+            Predicate.changes += 1
+        return self
+    # Makes the predicate's facts come from the tables for it in a FactStore, instead of its alts, which are dropped.
+    # The facts can't be changed after that. Raises a ValueError if the store has no table for the predicate.
+    # With enabled = False, the predicate has no facts for those arities until more are added.
+    def mapFacts(self, store, enabled = True):
+        with kbLock:
+            if not enabled:
+                self.mapped = {}
+            else:
+                tables = {arity: table for (name, arity), table in store.tables.items() if name == self.name}
+                if not tables:
+                    raise ValueError(store.path + " has no facts for " + self.name + ".")
+                for arity, table in tables.items():
+                    self.mapped[arity] = table
+                    self.alternatives.pop(arity, None)
+            self.version += 1
+            Predicate.changes += 1
+        return self
+    # Makes the predicate run the goals in each of its alts in the order planGoals thinks is cheapest,
+    # or in the order they were written with enabled = False.
+    def reorder(self, enabled = True):
+        self.reordered = enabled
+        return self
+    # Describes how each arity of the predicate chooses its alts. For example, length/2 gives
+    # {2: {"clauses": 2, "modes": ["+", "?"], "exclusive": [0], "determinism": "semidet"}}
+    def determinism(self):
+        result = {}
+        for arity in self.alternatives:
+            analysis = self.analyze(arity)
+            result[arity] = {"clauses": len(analysis.alts), "modes": analysis.modes,
+                "exclusive": analysis.exclusive, "determinism": analysis.determinism}
+        return result
+
+
+# Keys describe the first part of a term, so heads that can't match a goal are skipped without creating them.
+# A key is a number or atom value, one of the list keys below, or (pred, arity) for a goal. Vars have no key (None).
+emptyListKey = ("[]",)
+listKey = ("[|]",)
+
+
+# The key of an alt's head arg, before it has been made into a term. This follows the same rules as create.
+def headKey(arg):
+    if isinstance(arg, int) or isinstance(arg, float):
+        return arg
+    if isinstance(arg, (set, frozenset, dict)):
+        return None     # Sets and maps aren't indexed.
+    if isinstance(arg, list):
+        return listKey if arg else emptyListKey
+    if isinstance(arg, Goal):
+        return (arg.pred, len(arg.args))
+    if isinstance(arg, Term):
+        return None     # A term that was already made, like a lazy list, isn't looked at until it is unified.
+    if (arg[0].isupper() and " " not in arg) or arg[0] == "_":
+        return None
+    if arg[0] == "'" and arg[-1] == "'":
+        return arg[1:-1]
+    if " " in arg:
+        return None     # Math could unify with any number.
+    try:
+        return int(arg)
+    except ValueError:
+        try:
+            return float(arg)
+        except ValueError:
+            return arg
+
+
+# The key of a goal's arg, once it has been made into a term.
+def callKey(term):
+    term = deref(term)
+    if isinstance(term, (Var, Math)):
+        return None
+    if isinstance(term, ListPL):
+        return listKey
+    if isinstance(term, Goal):
+        return (term.pred, len(term.args))
+    if isinstance(term.value, list):
+        return emptyListKey
+    return term.value
+
+
+# ClauseAnalysis looks at the heads of a predicate's alts (with one arity) when they are loaded.
+# modes: "+" for args where every head has a key, so the alts are chosen by it, or "?" if some head has a Var.
+# exclusive: the args where every head has a different key, so at most one alt can match when that arg is bound.
+# determinism: "det" if there is only one alt, "semidet" if some arg is exclusive, or "nondet".
+# indexed: the args that have at least two different keys, so looking them up leaves out some alts.
+# itemIndexed: the args where heads that are lists have at least two different keys for their first item, like the
+#   tokens of grammar rules, so a list arg can be looked up by its first item as well.
+# facts: the keys of every alt's head, if every alt is a fact whose args are all atoms or numbers.
+class ClauseAnalysis():
+    def __init__(self, alts, version):
+        self.alts = tuple(alts)
+        self.version = version
+        arity = len(self.alts[0].args) if self.alts else 0
+        keys = [[headKey(arg) for arg in alt.args] for alt in self.alts]
+        self.modes = []
+        self.exclusive = []
+        self.indexed = []
+        self.index = []         # For each arg, a dict from key to the alts with that key (or a Var).
+        self.varAlts = []       # For each arg, the numbers of the alts whose head has a Var there.
+        self.itemIndexed = []
+        self.itemIndex = []     # For each arg, a dict from the key of the first item of list heads to their alts.
+        self.itemVarAlts = []   # For each arg, the alts that any list can match, since the head or its first item is a Var.
+        for position in range(arity):
+            column = [altKeys[position] for altKeys in keys]
+            varAlts = [i for i, key in enumerate(column) if key is None]
+            byKey = {}
+            for i, key in enumerate(column):
+                if key is not None:
+                    byKey.setdefault(key, []).append(i)
+            self.modes.append("?" if varAlts else "+")
+            if not varAlts and len(byKey) == len(column) > 1:
+                self.exclusive.append(position)
+            self.index.append(byKey)
+            self.varAlts.append(varAlts)
+            byItem = {}
+            itemVarAlts = []
+            for i, key in enumerate(column):
+                itemKey = headKey(self.alts[i].args[position][0]) if key == listKey else None
+                if itemKey is not None:
+                    byItem.setdefault(itemKey, []).append(i)
+                elif key is None or key == listKey:
+                    itemVarAlts.append(i)
+            if len(byItem) > 1:
+                self.itemIndexed.append(position)
+            if len(byKey) > 1 or (byKey and varAlts) or len(byItem) > 1:
+                self.indexed.append(position)
+            self.itemIndex.append(byItem)
+            self.itemVarAlts.append(itemVarAlts)
+        self.facts = None
+        if self.alts and all(not alt.goals for alt in self.alts):
+            if all(key is not None and not isinstance(key, tuple) for altKeys in keys for key in altKeys):
+                self.facts = [tuple(altKeys) for altKeys in keys]
+        self.factIndexes = {}   # Hash indexes of the facts, keyed by the args they are looked up by.
+        if len(self.alts) <= 1:
+            self.determinism = "det"
+        elif self.exclusive:
+            self.determinism = "semidet"
+        else:
+            self.determinism = "nondet"
+    # Returns the alts that could match a goal whose arg at position has this key.
+    def lookup(self, position, key):
+        numbers = self.index[position].get(key, [])
+        if self.varAlts[position]:
+            # Both lists are sorted, so sorted merges them in linear time. heapq.merge would too, but it raises
+            # StopIteration, which is slow inside deep queries (see create).
+            numbers = sorted(numbers + self.varAlts[position])
+        return [self.alts[i] for i in numbers]
+    # Returns the alts that could match a goal whose arg at position is a list whose first item has this key.
+    def lookupItem(self, position, key):
+        numbers = sorted(self.itemIndex[position].get(key, []) + self.itemVarAlts[position])
+        return [self.alts[i] for i in numbers]
+    # Returns a dict from the values of the facts at positions to the facts with those values, in order.
+    def factIndex(self, positions):
+        index = self.factIndexes.get(positions)
+        if index is None:
+            index = {}
+            for row in self.facts:
+                index.setdefault(tuple(row[position] for position in positions), []).append(row)
+            self.factIndexes[positions] = index
+        return index
 
 
 # Use query << [list of goals] for queries.
 # Once the query is made, Query becomes a list of all the results.
+# Everything a query changes while it runs is kept in its own QueryState and terms,
+# so any number of Querys can run at once on the same knowledge base.
 class Query(list):
     def __init__(self):
         self.goals = []
         self.size = None
+        self.limits = {}
+        self.output = None
+        self.reorder = False
+        self.select = None
+        self.tuples = False
+        self.strategy = "depth"
+        self.heuristic = None
+        self.exceeded = None        # The LimitExceeded error if the last query went over one of its limits.
+        self.inferences = 0         # The number of goals that were called by the last query.
+        self.choicepoints = 0       # The most choicepoints the last query had at once. See QueryState.
         super().__init__()
     def __lshift__(self, goals):
-        # Reset the query. 
-        self.clear()        
+        # Reset the query.
+        self.clear()
+        self.extend(self.answers(goals))
+        if self == []:
+            self.append(False)
+        return self
+    # Yields the answers to the goals one at a time, as they are found, instead of making a list of them.
+    # Each answer is the same as the ones that << gives, and a LimitExceeded error comes last if the query
+    # went over one of its limits. The settings from query(...) are used up once it finishes or is closed.
+    def answers(self, goals):
         # Memo is a dictionary of all args in the goals.
         # This makes sure that no terms are duplicates.
         memo = {}
         goals = [create(goal, memo) for goal in goals]
-        attempt = tryGoals(goals)
+        keepSharedLazyLists(goals)
+        if self.reorder:
+            goals = planGoals(goals)[0]
+        yield from self.solve(goals, memo)
+    # Yields the answers to goals that have already been made into terms. Memo has the query's Vars by name.
+    def solve(self, goals, memo, joins = True):
+        self.exceeded = None
+        state = QueryState(output = self.output, **self.limits)
+        # The Vars whose values are given as Python values, or None if every Var is given as a string.
+        selected = None
+        if self.select is True or (self.select is None and self.tuples):
+            selected = [(name, memo[name]) for name in memo if isinstance(memo[name], Var)]
+        elif self.select is not None:
+            names = [self.select] if isinstance(self.select, str) else list(self.select)
+            for name in names:
+                if not isinstance(memo.get(name), Var):
+                    self.reset()
+                    raise ValueError("'" + str(name) + "' isn't a variable in the query.")
+            selected = [(name, memo[name]) for name in names]
+        tuples = self.tuples
+        if not goals:
+            attempts = iter([(True, False)])    # A query with no goals succeeds once, but tryGoals([]) never ends.
+        elif self.strategy == "depth":
+            attempts = tryGoals(goals, state, joins = joins)
+        else:
+            attempts = searchGoals(goals, state, self.strategy, self.heuristic)
+        error = None
         # Loop through the generator self.size times, or until end if size is not specified.
-        for attempt in itertools.islice(attempt, self.size):
-            success = attempt[0]
-            wasCut = attempt[1]
-            if not success:
-                break
-            args = {}
-            for argName in memo:
-                if isinstance(memo[argName], Var):
-                    args[argName] = str(flatten(memo[argName].value))
-            if len(args) > 0:
-                self.append(args)
-            else:
-                self.append(True)
-            if wasCut:
-                break
-        if self == []:
-            self.append(False)
-        # Reset the size for future queries, in the case where multiple queries are made at once.
+        try:
+            for attempt in itertools.islice(attempts, self.size):
+                success = attempt[0]
+                wasCut = attempt[1]
+                if not success:
+                    break
+                if tuples:
+                    yield tuple([toPython(var) for name, var in selected])
+                elif selected is not None:
+                    yield {name: toPython(var) for name, var in selected} if selected else True
+                else:
+                    args = {}
+                    for argName in memo:
+                        if isinstance(memo[argName], Var):
+                            args[argName] = str(flatten(memo[argName].value))
+                    if len(args) > 0:
+                        yield args
+                    else:
+                        yield True
+                if wasCut:
+                    break
+        except LimitExceeded as err:
+            # Keep the results found so far, and end with the limit that stopped the query.
+            # The traceback is dropped, since it would keep the query's generators alive.
+            error = self.exceeded = err.with_traceback(None)
+        except RecursionError:
+            # Python ran out of stack before maxDepth was reached, so treat it as a depth limit.
+            error = self.exceeded = LimitExceeded("depth", state.deepest)
+        finally:
+            # Release the query's generators and bindings, so nothing from this query stays in memory.
+            if hasattr(attempts, "close"):
+                attempts.close()
+            state.undo(0)
+            state.output.flush()
+            self.inferences = state.inferences
+            self.choicepoints = state.mostChoicepoints
+            self.reset()
+        if error is not None:
+            yield error
+    # Reset the size, limits and output for future queries, in the case where multiple queries are made at once.
+    def reset(self):
         self.size = None
+        self.limits = {}
+        self.output = None
+        self.reorder = False
+        self.select = None
+        self.tuples = False
+        self.strategy = "depth"
+        self.heuristic = None
     # query(3) makes the query only show 3 results.
-    def __call__(self, num):
+    # Limits stop a query that does too much work, e.g. query(maxInferences = 10000, maxTime = 2).
+    # Output sends what the query writes somewhere other than stdout, e.g. query(output = io.StringIO()).
+    # Reorder runs the goals in the order planGoals thinks is cheapest. See explain.
+    # Select gives only the named Vars, as Python values instead of strings (see toPython), e.g. query(select = ["X"]).
+    # Select = True gives every Var that way. With tuples = True, each result is a tuple of the selected values,
+    # in the order they were named.
+    # Strategy is how the answers are searched for: "depth", "iterative", "breadth" or "best". See searchGoals.
+    # Best-first search needs a heuristic, e.g. query(strategy = "best", heuristic = distance).
+    def __call__(self, num = None, maxInferences = None, maxDepth = None, maxTime = None, maxTrail = None, output = None,
+            reorder = False, select = None, tuples = False, strategy = "depth", heuristic = None):
         self.size = num
+        self.limits = {"maxInferences": maxInferences, "maxDepth": maxDepth, "maxTime": maxTime, "maxTrail": maxTrail}
+        self.output = output
+        self.reorder = reorder
+        self.select = select
+        self.tuples = tuples
+        self.strategy = strategy
+        self.heuristic = heuristic
+        return self
+
+
+# The module's query is used by every thread, so each thread gets its own Query behind it.
+# Threads can also make their own, e.g. results = Query() << [goals].
+class ThreadQuery(Query):
+    def __init__(self):
+        list.__init__(self)
+        self.local = threading.local()
+    def current(self):
+        if not hasattr(self.local, "query"):
+            self.local.query = Query()
+        return self.local.query
+    def __lshift__(self, goals):
+        self.current() << goals
         return self
+    def answers(self, goals):
+        return self.current().answers(goals)
+    def __call__(self, *args, **limits):
+        self.current()(*args, **limits)
+        return self
+    # Attributes like exceeded and inferences come from this thread's Query.
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+    def __iter__(self):
+        return iter(self.current())
+    def __len__(self):
+        return len(self.current())
+    def __getitem__(self, index):
+        return self.current()[index]
+    def __contains__(self, item):
+        return item in self.current()
+    def __eq__(self, other):
+        return self.current() == other
+    def __repr__(self):
+        return repr(self.current())
+
+
+# Raised when a query goes over one of its limits.
+# The limit is "inference", "depth", "time" or "trail".
+class LimitExceeded(Exception):
+    def __init__(self, limit, maximum, owner = None):
+        self.limit = limit
+        self.maximum = maximum
+        self.owner = owner          # The call_with_inference_limit goal that set the limit, if any.
+        super().__init__(limit + " limit of " + str(maximum) + " exceeded")
+    def __repr__(self):
+        return self.limit + "_limit_exceeded"
+
+
+# Raised in a query whose stop Event was set, since its answers are no longer needed.
+class QueryStopped(Exception):
+    pass
+
+
+# QueryState keeps track of the work done by one query, and stops the query if it goes over its limits.
+# maxInferences: the number of goals that may be called.
+# maxDepth: how deeply alts may be nested inside each other.
+# maxTime: the number of seconds the query may run for.
+# maxTrail: the number of bindings that may be on the trail at once.
+class QueryState():
+    active = weakref.WeakSet()      # Every query state that is still in use, for memoryStats.
+    def __init__(self, maxInferences = None, maxDepth = None, maxTime = None, maxTrail = None, output = None):
+        self.output = output if isinstance(output, OutputBuffer) else OutputBuffer(output)
+        self.maxInferences = maxInferences
+        self.maxDepth = maxDepth
+        self.maxTime = maxTime
+        self.maxTrail = maxTrail
+        self.inferences = 0
+        self.deepest = 0            # The deepest that alts have been nested so far.
+        self.trail = []             # Every binding made so far, so they can be undone when backtracking.
+        self.startTime = time.perf_counter()
+        self.inferenceLimits = []   # (ceiling, goal) pairs from call_with_inference_limit, innermost last.
+        self.fdQueue = []           # Finite domain constraints waiting to be propagated.
+        self.propagating = False
+        self.depthBound = float("inf")  # Goals deeper than this fail, for iterative deepening.
+        self.cutoff = False         # Whether a goal has failed because of depthBound.
+        self.choicepoints = 0       # The goals that running conjunctions could still backtrack into.
+        self.mostChoicepoints = 0   # The most choicepoints there have been at once.
+        self.stop = None            # An Event that stops the query once it is set, e.g. for a parallel list.
+        QueryState.active.add(self)
+    # Called every time a goal is tried.
+    def infer(self, depth):
+        self.inferences += 1
+        if depth > self.deepest:
+            self.deepest = depth
+        if self.maxInferences is not None and self.inferences > self.maxInferences:
+            raise LimitExceeded("inference", self.maxInferences)
+        for ceiling, owner in self.inferenceLimits:
+            if self.inferences > ceiling:
+                raise LimitExceeded("inference", ceiling, owner)
+        if self.maxDepth is not None and depth > self.maxDepth:
+            raise LimitExceeded("depth", self.maxDepth)
+        if self.maxTime is not None and time.perf_counter() - self.startTime > self.maxTime:
+            raise LimitExceeded("time", self.maxTime)
+        if self.stop is not None and self.stop.is_set():
+            raise QueryStopped()
+    # Called when a conjunction starts, cuts some of its goals, or finishes.
+    def addChoicepoints(self, count):
+        self.choicepoints += count
+        if self.choicepoints > self.mostChoicepoints:
+            self.mostChoicepoints = self.choicepoints
+    # Binds an unbound Var to a term, and records it on the trail.
+    def bind(self, var, term):
+        if isinstance(term, Math):
+            term = Const(term.value)        # Math is evaluated when it is unified.
+        if var.domain is not None or var.constraints:
+            return self.bindConstrained(var, term)
+        var.ref = term
+        self.trail.append(var)
+        if self.maxTrail is not None and len(self.trail) > self.maxTrail:
+            raise LimitExceeded("trail", self.maxTrail)
+        return True
+    # Binds a Var that has a finite domain, and propagates its constraints.
+    def bindConstrained(self, var, term):
+        if isinstance(term, Var):
+            # Move the domain and constraints onto the Var that this one is bound to.
+            domain = fdDomain(var).intersect(fdDomain(term))
+            self.trail.append((term, "constraints", term.constraints))
+            term.constraints = term.constraints + var.constraints
+            var.ref = term
+            self.trail.append(var)
+            return self.narrow(term, domain) and self.propagate(var.constraints)
+        if not isNumber(term.value) or term.value not in fdDomain(var):
+            return False
+        var.ref = term
+        self.trail.append(var)
+        return self.propagate(var.constraints)
+    # Undoes every binding made since the trail was mark long.
+    def undo(self, mark):
+        trail = self.trail
+        while len(trail) > mark:
+            entry = trail.pop()
+            if isinstance(entry, Var):
+                entry.ref = None
+            else:
+                setattr(entry[0], entry[1], entry[2])   # A Var attribute, like its domain, is put back.
+    # Gives a Var a smaller domain. Returns False if no values are left.
+    def narrow(self, var, domain):
+        old = fdDomain(var)
+        if domain.size() == 0:
+            return False
+        if domain.lo == old.lo and domain.hi == old.hi and domain.size() == old.size():
+            return True
+        self.trail.append((var, "domain", var.domain))
+        var.domain = domain
+        if domain.size() == 1:
+            var.ref = Const(domain.lo)      # Only one value is left, so the Var has that value.
+            self.trail.append(var)
+        self.fdQueue.extend(var.constraints)
+        return True
+    # Adds a constraint to each of its Vars, and propagates it.
+    def post(self, constraint):
+        for var in constraint.vars():
+            self.trail.append((var, "constraints", var.constraints))
+            var.constraints = var.constraints + (constraint,)
+        return self.propagate([constraint])
+    # Propagates constraints until none of them can narrow a domain any further.
+    def propagate(self, constraints = ()):
+        self.fdQueue.extend(constraints)
+        if self.propagating:
+            return True
+        self.propagating = True
+        try:
+            while self.fdQueue:
+                constraint = self.fdQueue.pop()
+                if not constraint.propagate(self):
+                    self.fdQueue.clear()
+                    return False
+        finally:
+            self.propagating = False
+        return True
+
+
+# Collects what write, format_ and nl print during a query, and passes it on in large pieces.
+# The sink may be a file or anything with a write method, like a StringIO, or a function that takes a string.
+# With no sink, the output goes to stdout. It is passed on once threshold characters have been
+# collected, and at the end of the query, so queries running at once don't mix their output together.
+class OutputBuffer():
+    def __init__(self, sink = None, threshold = 65536):
+        self.sink = sink
+        self.threshold = threshold
+        self.parts = []
+        self.size = 0
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.threshold:
+            self.flush()
+    def flush(self):
+        if not self.parts:
+            return
+        text = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        sink = sys.stdout if self.sink is None else self.sink
+        if hasattr(sink, "write"):
+            sink.write(text)
+        else:
+            sink(text)
+
+
+# Returns counts of what the knowledge base and the running queries are holding in memory.
+def memoryStats():
+    predicates = list(Predicate.registry)
+    states = list(QueryState.active)
+    return {
+        "predicates": len(predicates),
+        "clauses": sum(len(alts) for pred in predicates for alts in pred.alternatives.values()),
+        "atoms": len(atomTable),
+        "activeQueries": len(states),
+        "trail": sum(len(state.trail) for state in states),
+        "choicepoints": sum(state.choicepoints for state in states),
+        "constraints": sum(len(state.fdQueue) for state in states),
+    }
+
+
+# Only one thread at a time may add alts to the knowledge base.
+kbLock = threading.Lock()
+
 
 # Goals must be completed in order to satisfy a query.
 class Goal():
@@ -108,17 +728,61 @@ class Goal():
         return "goalPred: " + self.name + "\nGoalArgs: " + str(self.args) + "\n"
     # Add facts as: head >> []
     # Add rules as: head >> [goal1, goal2, ...]
+    # Alts are only appended, or removed by making a new list without them, so queries can read them
+    # from any thread without a lock.
     def __rshift__(self, others):
-        if len(self.args) in self.pred.alternatives:
-            self.pred.alternatives[len(self.args)].append(Alt(self.pred, self.args, others))
-        else:
-            self.pred.alternatives[len(self.args)] = [Alt(self.pred, self.args, others)]
+        with kbLock:
+            if len(self.args) in self.pred.mapped:
+                raise ValueError(self.name + "/" + str(len(self.args)) + " is read from a FactStore, so it can't be changed.")
+            if len(self.args) in self.pred.sharded:
+                self.pred.sharded[len(self.args)].add(shardRow(self, others))
+            elif len(self.args) in self.pred.alternatives:
+                self.pred.alternatives[len(self.args)].append(Alt(self.pred, self.args, others))
+            else:
+                self.pred.alternatives[len(self.args)] = [Alt(self.pred, self.args, others)]
+            self.pred.version += 1
+            Predicate.changes += 1
+    # Add grammar rules as: head >= [item1, item2, ...]. See Grammar Rules.
+    def __ge__(self, body):
+        clause = grammarClause(self, body)
+        clause[0] >> clause[1]
+    # Remove facts as: head.retract()
+    # The first fact with the same args is removed. Returns whether there was one.
+    def retract(self):
+        with kbLock:
+            if len(self.args) in self.pred.mapped:
+                raise ValueError(self.name + "/" + str(len(self.args)) + " is read from a FactStore, so it can't be changed.")
+            if len(self.args) in self.pred.sharded:
+                if not self.pred.sharded[len(self.args)].remove(shardRow(self, [])):
+                    return False
+                self.pred.version += 1
+                Predicate.changes += 1
+                return True
+            alts = self.pred.alternatives.get(len(self.args), [])
+            for i, alt in enumerate(alts):
+                if not alt.goals and sameArgs(alt.args, self.args):
+                    self.pred.alternatives[len(self.args)] = alts[:i] + alts[i + 1:]
+                    self.pred.version += 1
+                    Predicate.changes += 1
+                    return True
+        return False
     def __repr__(self):
         return self.name
-    def unifyWith(self, other):
-        if isinstance(other, Var):
-            other.value = self
-        return True
+
+
+# Returns True if two raw args would create the same term. Vars and math must be written the same way.
+def sameArgs(first, second):
+    if isinstance(first, (list, tuple)) and isinstance(second, (list, tuple)):
+        return len(first) == len(second) and all(sameArgs(a, b) for a, b in zip(first, second))
+    if isinstance(first, Goal) and isinstance(second, Goal):
+        return first.pred == second.pred and sameArgs(first.args, second.args)
+    if isinstance(first, (list, tuple, Goal)) or isinstance(second, (list, tuple, Goal)):
+        return False
+    firstKey = headKey(first)
+    secondKey = headKey(second)
+    if firstKey is None or secondKey is None:
+        return first == second
+    return firstKey == secondKey
 
 
 # Alts are individual alternatives that were added to a predicate.
@@ -127,28 +791,99 @@ class Alt():
         self.pred = pred
         self.args = args
         self.goals = goals
+        self.compiled = None    # The alt's compiled Python function, once it has been compiled.
+        keepLazyLists([args, goals])
     def __str__(self):
         return "alt from pred: " + self.pred.name + "\naltArgs: " + str(self.args) + "\naltGoals: " + str(self.goals) + "\n"
     def __repr__(self):
         return "alt from pred: " + self.pred.name
 
 
+# Marks the lazy lists in the args or goals of a clause as kept, since each call of the clause reads them again.
+def keepLazyLists(terms):
+    for source in lazySources(terms, []):
+        source.kept = True
+
+
+# Marks the lazy lists that are in a query's goals more than once as kept, since each of those goals reads them.
+def keepSharedLazyLists(goals):
+    counts = {}
+    for source in lazySources(goals, []):
+        counts[source] = counts.get(source, 0) + 1
+        if counts[source] > 1:
+            source.kept = True
+
+
+# Adds the source of each lazy list in raw terms, or terms made by create, to sources, once for each time it is in them.
+def lazySources(term, sources):
+    if isinstance(term, Goal):
+        lazySources(term.args, sources)
+    elif isinstance(term, (list, tuple)):
+        for item in term:
+            lazySources(item, sources)
+    elif isinstance(term, ListPL):
+        while isinstance(term, ListPL) and not isinstance(term, LazyCell):
+            lazySources(term.head, sources)
+            term = term.tail
+        while isinstance(term, LazyCell) or (isinstance(term, Var) and isinstance(term, LazyList) and term.cell is not None):
+            term = term.tail if isinstance(term, LazyCell) else term.cell     # The cells that have been read.
+        lazySources(term, sources)
+    elif isinstance(term, Var) and isinstance(term, LazyList):     # Built-in clauses are made before LazyList.
+        sources.append(term.source)
+    return sources
+
+
 # This function tries to unify the query and alt args, and returns a bool of its success.
-def tryUnify(queryArgs, altArgs):
+def tryUnify(queryArgs, altArgs, state):
     for queryArg, altArg in zip(queryArgs, altArgs):    # Loop through the query and alt arguments.
-        # Check if unification is possible before unifying.
-        if queryArg != altArg:
+        if not unify(queryArg, altArg, state):
             return False
-        queryArg.unifyWith(altArg)
     return True                                 # If it reaches this point, they can be unified.
 
 
+# Unifies two terms, binding Vars on the state's trail. Returns a bool of its success.
+def unify(first, second, state):
+    first = deref(first)
+    second = deref(second)
+    if first is second:
+        return True
+    if isinstance(first, Var):
+        return state.bind(first, second)
+    if isinstance(second, Var):
+        return state.bind(second, first)
+    if isinstance(first, ListPL) and isinstance(second, ListPL):
+        return unify(first.head, second.head, state) and unify(first.tail, second.tail, state)
+    if isinstance(first, Goal) and isinstance(second, Goal):
+        if first.pred != second.pred or len(first.args) != len(second.args):
+            return False
+        return tryUnify(first.args, second.args, state)
+    if isinstance(first, SetPL) and isinstance(second, SetPL):
+        return len(first.trie) == len(second.trie) and all(key in second.trie for key, term in first.trie)
+    if isinstance(first, MapPL) and isinstance(second, MapPL):
+        if len(first.trie) != len(second.trie):
+            return False
+        for key, (keyTerm, value) in first.trie:
+            other = second.trie.get(key, missing)
+            if other is missing or not unify(value, other[1], state):
+                return False
+        return True
+    if isinstance(first, (ListPL, Goal, SetPL, MapPL)) or isinstance(second, (ListPL, Goal, SetPL, MapPL)):
+        return False
+    return first.value == second.value
+
+
+# Follows bound Vars until it reaches a term that isn't a bound Var.
+def deref(term):
+    while isinstance(term, Var) and term.ref is not None:
+        term = term.ref
+    return term
+
+
 # Variables and Constants are Terms.
 class Term():
     def __init__(self, name, value):
         self.name = name
         self.value = value
-        self.children = []      # The children are the variables that will change if this term has a value.
     @staticmethod
     def changeType(word):
         if isinstance(word, list):
@@ -159,30 +894,28 @@ class Term():
             return ListPL(word)
         # All other values are Consts.
         return Const(word)
-    # This checks if they *can* be equal.
-    def __eq__(self, other):
-        return self.value == other.value or not self or not other
     def __bool__(self):
         return self.value != "Undefined"    # A term is false it if has no value.
     def __repr__(self):
         return str(self.value)
     def __str__(self):
         return str(self.value)
-    def __hash__(self):
-        return hash(repr(self))
-    def unifyWith(self, altArg):
-        altArg.children.append(self)        # The children are the variables we want to find out.
-        if self:
-            altArg.value = self.value
-        changePath(altArg, altArg.value)    # Set all unified terms to new value.
-        return True
 
 
+# A Var gets its value by being bound to another term.
+# Bindings are recorded on the query's trail, so they can be undone when backtracking.
 class Var(Term):
-    def __init__(self, name, value = "Undefined"):
+    domain = None       # The finite Domain of the Var, if it was given one.
+    constraints = ()    # The finite domain constraints on the Var.
+    def __init__(self, name):
         self.name = name
-        self.value = value
-        super().__init__(name = self.name, value = self.value)    # Initialize the Var.
+        self.ref = None     # The term this Var is bound to, or None if it is unbound.
+    @property
+    def value(self):
+        term = deref(self)
+        if isinstance(term, Var):
+            return "Undefined"
+        return term.value
     def __repr__(self):
         return repr(self.name + " = " + str(self.value))
 
@@ -195,7 +928,6 @@ class Const(Term):  # A constant, aka an atom.
 class Math(Term):
     def __init__(self):
         self.mathList = []
-        self.children = []
     @property
     def value(self):
         toEval = self.mathList[:]
@@ -209,27 +941,37 @@ class Math(Term):
                         raise TypeError
                 except:
                     raise ValueError("'" + name + "' doesn't have a numeric value.")
+                if toEval[i] < 0:
+                    toEval[i] = "(" + str(toEval[i]) + ")"    # So that e.g. -3 ** 2 isn't read as -(3 ** 2).
         return eval("".join([str(term) for term in toEval]))
     # This takes a string of math and turns it into a list of numbers and operators
-    def mathToList(self, mathStr, memo = {}):
-        mathStr = mathStr.replace(" ", "")
-        mathStr = mathStr.replace("+", " + ")
-        mathStr = mathStr.replace("-", " - ")
-        mathStr = mathStr.replace("*", " * ")
-        mathStr = mathStr.replace("**", " ** ")
-        mathStr = mathStr.replace("^", " ** ")          # Prolog style for exponentiation.
-        mathStr = mathStr.replace("/", " / ")
-        mathStr = mathStr.replace("//", " // ")
-        mathStr = mathStr.replace("(", " ( ")
-        mathStr = mathStr.replace(")", " ) ")
-        mathStr = mathStr.replace("%", " % ")
-        mathStr = mathStr.replace("mod", " % ")         # Prolog style for modulo.
-        self.mathList = mathStr.split()
+    def mathToList(self, mathStr, memo = None):
+        self.mathList = mathTokens(mathStr)
         for i in range(len(self.mathList)):
-            if self.mathList[i] not in ["+", "-", "*", "**", "/", "//", "(", ")", "%", "mod"]:
+            if self.mathList[i] not in mathOperators:
                 self.mathList[i] = create(self.mathList[i], memo)
 
 
+mathOperators = ["+", "-", "*", "**", "/", "//", "(", ")", "%", "mod"]
+
+
+# Splits a string of math into a list of strings for its numbers, vars and operators.
+def mathTokens(mathStr):
+    mathStr = mathStr.replace(" ", "")
+    mathStr = mathStr.replace("+", " + ")
+    mathStr = mathStr.replace("-", " - ")
+    mathStr = mathStr.replace("*", " * ")
+    mathStr = mathStr.replace("**", " ** ")
+    mathStr = mathStr.replace("^", " ** ")          # Prolog style for exponentiation.
+    mathStr = mathStr.replace("/", " / ")
+    mathStr = mathStr.replace("//", " // ")
+    mathStr = mathStr.replace("(", " ( ")
+    mathStr = mathStr.replace(")", " ) ")
+    mathStr = mathStr.replace("%", " % ")
+    mathStr = mathStr.replace("mod", " % ")         # Prolog style for modulo.
+    return mathStr.split()
+
+
 class ListPL(Term):
     def __init__(self, terms, name = "List"):
         self.head = terms[0]
@@ -238,71 +980,72 @@ class ListPL(Term):
         super().__init__(name = name, value = terms)
     def __len__(self):
         return len(self.value)
-    def __eq__(self, other):
-        if isinstance(other.value, list) and other.value:
-            other = ListPL(other.value)
-        if self.tail and not isinstance(self.tail, ListPL):
-            self.tail = Term.changeType(self.tail.value)
-        if isinstance(other, ListPL):
-            return self.head == other.head and self.tail == other.tail
-        return super().__eq__(other)
-    def unifyWith(self, altArg):
-        if isinstance(altArg.value, list) and altArg.value:
-            altArg = ListPL(altArg.value)
-        if isinstance(altArg, ListPL):
-            if self.head.unifyWith(altArg.head) and self.tail.unifyWith(altArg.tail):
-                return True
-            return False
-        return super().unifyWith(altArg)
     def __str__(self):
         return str(self.value)
     def __repr__(self):
         return str(self.terms)
 
 
-def tryGoal(goal):
-    if isinstance(goal, Var):
-        goal = goal.value
+def tryGoal(goal, state = None, depth = 0):
+    goal = deref(goal)
+    if state is None:
+        state = QueryState()
+    if isinstance(goal, FactJoin):
+        yield from goal.solve(state, depth)
+        return
+    state.infer(depth)
     wasCut = False
-    # Make the goal a copy of itself, so that changing args here doesn't mess up the original args.
-    goal = Goal(goal.pred, goal.args)   
-    if len(goal.args) in goal.pred.alternatives:
-        alts = goal.pred.alternatives[len(goal.args)]   # The list of all alts with matching arity.
-        # If a variable already has a value, this goal cannot change it.
-        # To ensure the value does not get reset, the variable must be changed to a Const.
-        for argIndex, arg in enumerate(goal.args):
-            if isinstance(arg, Var) and arg.value != "Undefined":
-                goal.args[argIndex] = Term.changeType(arg.value)
-        # Only yield if it succeeded, since failing one alt doesn't mean that the goal failed.
+    if depth > state.depthBound:
+        state.cutoff = True     # Iterative deepening will search again with a deeper bound.
+        yield False, wasCut
+        return
+    walk = lazyWalk(goal) if goal.pred in lazyWalks else None
+    if walk is not None:
+        for solved in walk(goal, state, depth):
+            yield (True, wasCut)
+    elif len(goal.args) in goal.pred.alternatives:
+        # Only the alts whose heads can match the goal's args are tried, so no time is spent creating
+        # and unifying the others. These are the alts that existed when the goal was called, even if
+        # another thread adds more.
+        alts = goal.pred.matchingAlts(goal.args)
+        compiled = goal.pred.compiled
         for alt in alts:
-            altAttempts = tryAlt(goal, alt)
+            mark = len(state.trail)
+            if compiled:
+                altAttempts = (alt.compiled or compileAlt(alt))(goal.args, state, depth + 1)
+            else:
+                altAttempts = tryAlt(goal, alt, state, depth + 1)
             # Only yield if it succeeded, since failing one alt doesn't mean that the goal failed.
             for attempt in altAttempts:
                 success = attempt[0]
                 wasCut = attempt[1]
                 if success:
                     # Yield vars, or True if this succeeded without changing vars.
-                    yield (findVars(goal.args) or True, wasCut)
+                    yield (True, wasCut)
                 if wasCut:
                     break
-            # Clear any args that were defined in this goal, so they may be reused for the next alt.
-            for arg in goal.args:
-                if isinstance(arg, Var):
-                    changePath(arg, "Undefined")
+            # Undo any bindings made by this alt, so the args may be reused for the next alt.
+            state.undo(mark)
             if wasCut:
                 wasCut = False
                 break
+    elif len(goal.args) in goal.pred.sharded:
+        for solved in goal.pred.sharded[len(goal.args)].solve(goal, state):
+            yield (True, wasCut)
+    elif len(goal.args) in goal.pred.mapped:
+        for solved in goal.pred.mapped[len(goal.args)].solve(goal, state):
+            yield (True, wasCut)
     # If no predicate exists with this number of arguments, it may be a built-in predicate.
     elif goal.pred == format_:
         strToWrite = goal.args[0]
         varsToFill = [flatten(arg.value) for arg in goal.args[1]]
-        print(strToWrite.format(*varsToFill), end="")
+        state.output.write(strToWrite.format(*varsToFill))
         yield True, wasCut
     elif goal.pred == write:
-        print(flatten(goal.args[0].value), end="")
+        state.output.write(str(flatten(goal.args[0].value)))
         yield True, wasCut
     elif goal.pred == nl:
-        print()
+        state.output.write("\n")
         yield True, wasCut
     elif goal.pred == lt:
         yield (goal.args[0].value < goal.args[1].value, wasCut)
@@ -316,30 +1059,80 @@ def tryGoal(goal):
         wasCut = True
         yield True, wasCut
     elif goal.pred == notEqual:
-        if goal.args[0].value != goal.args[1].value:
-            yield (findVars(goal.args) or True, wasCut)
-    elif goal.pred == call:
+        # The args are not equal if they can't be unified.
+        mark = len(state.trail)
+        unified = unify(goal.args[0], goal.args[1], state)
+        state.undo(mark)
+        if not unified:
+            yield (True, wasCut)
+    elif goal.pred in controlGoals:
+        for solved in controlGoals[goal.pred](goal, state, depth):
+            yield (True, wasCut)
+    elif goal.pred == call_with_inference_limit:
         goalToCall = goal.args[0].value
-        # Make the called goal a copy of itself, so that changing args here doesn't mess up the original args.
         goalToCall = Goal(goalToCall.pred, goalToCall.args)
-        result = next(tryGoal(goalToCall))
-        yield (result[0], wasCut)
+        # The called goal may only make this many inferences, including the ones made when backtracking into it.
+        limit = (state.inferences + goal.args[1].value, goal)
+        attempts = tryGoal(goalToCall, state, depth + 1)
+        mark = len(state.trail)
+        while True:
+            state.inferenceLimits.append(limit)
+            try:
+                success = next(attempts)[0]
+                result = "true"     # This engine can't tell if the goal left choicepoints, so "!" is never given.
+            except LimitExceeded as err:
+                if err.owner is not goal:
+                    raise
+                success = True
+                result = "inference_limit_exceeded"
+            finally:
+                state.inferenceLimits.remove(limit)
+            resultMark = len(state.trail)
+            if not success or not unify(goal.args[2], Const(result), state):
+                break
+            yield (True, wasCut)
+            state.undo(resultMark)
+            if result == "inference_limit_exceeded":
+                break
+        state.undo(mark)
+    elif goal.pred in fdConstraints:
+        mark = len(state.trail)
+        if fdConstraints[goal.pred](goal, state):
+            yield (True, wasCut)
+        state.undo(mark)
+    elif goal.pred in containerGoals:
+        for solved in containerGoals[goal.pred](goal, state):
+            yield (True, wasCut)
+    elif goal.pred in listGoals:
+        for solved in listGoals[goal.pred](goal, state, depth):
+            yield (True, wasCut)
+    elif goal.pred == parallel:
+        for solved in parallelGoals(goal, state, depth):
+            yield (True, wasCut)
+    elif goal.pred == label or goal.pred == labeling:
+        options = ["ff"] if goal.pred == label else [term.value for term in listTerms(goal.args[0])]
+        for labelled in labelVars(listTerms(goal.args[-1]), options, state):
+            yield (True, wasCut)
     yield False, wasCut               # If all the alts failed, then the goal failed.
 
 
 # This tries the current alternative to see if it succeeds.
-def tryAlt(query, alt):
+def tryAlt(query, alt, state = None, depth = 0):
     wasCut = False
+    if state is None:
+        state = QueryState()
     # Memo is a dictionary of all terms in this alt.
     # This makes sure that no terms are duplicates.
     memo = {}
     altArgs = [create(arg, memo) for arg in alt.args]
-    altGoals = [create(goal, memo) for goal in alt.goals]
-    goalsToTry = altGoals                   # A list of goals that must be satisfied for this alt to succeed.
-    if not tryUnify(query.args, altArgs):   # If the alt can't be unified, then it fails.
+    if not tryUnify(query.args, altArgs, state):   # If the alt can't be unified, then it fails.
         yield False, wasCut
-    elif len(goalsToTry) > 0:               # If this alt has goals, try them.
-        for attempt in tryGoals(goalsToTry):
+    elif len(alt.goals) > 0:                # If this alt has goals, try them.
+        # The goals are only created once the head has unified.
+        goalsToTry = [create(goal, memo) for goal in alt.goals]
+        if alt.pred.reordered:
+            goalsToTry = planGoals(goalsToTry)[0]
+        for attempt in tryGoals(goalsToTry, state, depth):
             wasCut = attempt[1]
             yield attempt
             if wasCut:
@@ -348,71 +1141,291 @@ def tryAlt(query, alt):
         yield True, wasCut  # If there are no goals to try, this alt succeeded.
 
 
-def tryGoals(goalsToTry):
+def tryGoals(goalsToTry, state = None, depth = 0, joins = True):
     wasCut = False
-    goals = [tryGoal(goal) for goal in goalsToTry]  # A list of [tryGoal(goal1), tryGoal(goal2), etc]
-    currGoal = 0                                    # This is the index for the goal we are currently trying.
-    failed = False
-    while not failed:
-        while 0 <= currGoal < len(goals):           # The goals succeed it currGoal reaches the end.
-            if wasCut and goalsToTry[currGoal].pred == cut:
-                failed = True
-                break
-            if goalsToTry[currGoal].pred == cut:
-                wasCut = True
-            currGoalAttempt = next(goals[currGoal])
-            success = currGoalAttempt[0]
-            wasCut = currGoalAttempt[1]
-            if success:                        # This goal succeeded and args have been instantiated.
-                currGoal += 1
-            else:
-                if currGoal == 0 or wasCut:   # If the first goal fails, there are no more things to try, and the function fails.
+    if state is None:
+        state = QueryState()
+    if joins and len(goalsToTry) > 1:
+        goalsToTry = joinFacts(goalsToTry)
+    goals = [tryGoal(goal, state, depth) for goal in goalsToTry]  # A list of [tryGoal(goal1), tryGoal(goal2), etc]
+    released = 0                                    # The goals before this index were cut, and their generators closed.
+    state.addChoicepoints(len(goals))
+    try:
+        currGoal = 0                                # This is the index for the goal we are currently trying.
+        failed = False
+        while not failed:
+            while 0 <= currGoal < len(goals):       # The goals succeed it currGoal reaches the end.
+                if currGoal < released or (wasCut and goalsToTry[currGoal].pred == cut):
+                    wasCut = True       # Backtracking into a cut fails the conjunction.
                     failed = True
                     break
-                goals[currGoal] = tryGoal(goalsToTry[currGoal])  # Reset the generator.
-                currGoal -= 1
-        if not failed:
-            yield True, wasCut      # If we got here, then all the goals succeeded.
-            currGoal -= 1           # Go back a goal to try for another solution.
-    yield False, wasCut
-
-
-def changePath(arg, newValue):
-    if isinstance(arg, Var):
-        arg.value = newValue
-    for child in arg.children:
-        changePath(child, newValue)     # Change each child to the new value.
+                if goalsToTry[currGoal].pred == cut:
+                    wasCut = True
+                currGoalAttempt = next(goals[currGoal])
+                success = currGoalAttempt[0]
+                wasCut = currGoalAttempt[1]
+                if success:                    # This goal succeeded and args have been instantiated.
+                    if goalsToTry[currGoal].pred == cut:
+                        # Nothing up to the cut can be retried, so its generators are closed now, instead of
+                        # staying alive until this conjunction is finished. The bindings they made are kept.
+                        for i in range(released, currGoal + 1):
+                            goals[i].close()
+                            goals[i] = None
+                        state.addChoicepoints(released - currGoal - 1)
+                        released = currGoal + 1
+                    currGoal += 1
+                else:
+                    if currGoal == 0 or wasCut:   # If the first goal fails, there are no more things to try, and the function fails.
+                        failed = True
+                        break
+                    goals[currGoal] = tryGoal(goalsToTry[currGoal], state, depth)  # Reset the generator.
+                    currGoal -= 1
+            if not failed:
+                yield True, wasCut      # If we got here, then all the goals succeeded.
+                currGoal -= 1           # Go back a goal to try for another solution.
+        yield False, wasCut
+    finally:
+        state.addChoicepoints(released - len(goals))
 
 
-# Returns a list of all Vars found in a list.
-def findVars(args):
+# Puts each run of two or more goals that call fact tables into a FactJoin.
+def joinFacts(goals):
     result = []
-    for arg in args:
-        if isinstance(arg, ListPL):
-            result.extend(findVars(arg.value))
-        if isinstance(arg, Var) and arg.name[0] != "_":
-            if isinstance(arg.value, list):
-                arg = Var(arg.name, arg.value)
-            result.append(arg)
+    run = []
+    for goal in goals + [None]:
+        if isinstance(goal, Goal) and len(goal.args) in goal.pred.alternatives \
+                and goal.pred.analyze(len(goal.args)).facts is not None:
+            run.append(goal)
+            continue
+        if len(run) > 1:
+            result.append(FactJoin(run))
+        else:
+            result.extend(run)
+        run = []
+        if goal is not None:
+            result.append(goal)
     return result
 
 
+# A FactJoin finds the solutions of goals that only call fact tables all at once, instead of calling each
+# goal again for every solution of the goals before it. The facts of each goal are looked up in a hash index
+# on the args that are already known, which are its atoms and numbers, and the Vars set by earlier goals.
+# Solutions come in the same order, and count the same inferences, as calling the goals one at a time.
+class FactJoin():
+    pred = None
+    def __init__(self, goals):
+        self.goals = goals
+    def __repr__(self):
+        return "join" + str(self.goals)
+    def solve(self, state, depth):
+        plan = self.plan()
+        if plan is None:    # Some arg isn't an atom, number or Var, so the goals are tried one at a time.
+            yield from tryGoals(self.goals, state, depth, joins = False)
+            return
+        steps, slotVars = plan
+        values = [None] * len(slotVars)
+        consts = {}     # Holds on to the Consts for the values, so they aren't made again for every solution.
+        for _ in self.joinStep(steps, 0, values, state, depth):
+            mark = len(state.trail)
+            bound = True
+            for var, value in zip(slotVars, values):
+                const = consts.get((type(value), value))
+                if const is None:
+                    const = consts[(type(value), value)] = internConst(value)
+                if not state.bind(var, const):
+                    bound = False
+                    break
+            if bound:
+                yield True, False
+            state.undo(mark)
+        yield False, False
+    # Works out how each goal's facts are looked up. Returns None if the goals can't be joined.
+    # Each unbound Var gets a slot in values, which is filled in by the first goal that has it.
+    def plan(self):
+        slots = {}
+        steps = []
+        for goal in self.goals:
+            analysis = goal.pred.analyze(len(goal.args))
+            if analysis.facts is None:
+                return None
+            keyPositions = []
+            keyParts = []       # (slot, value), where slot is None for atoms and numbers.
+            newSlots = []       # (position, slot) for Vars first seen in this goal.
+            checks = []         # (position, slot) for Vars seen again in this goal.
+            seen = set()
+            for position, arg in enumerate(goal.args):
+                arg = deref(arg)
+                if isinstance(arg, Var):
+                    if arg in seen:
+                        checks.append((position, slots[arg]))
+                    elif arg in slots:
+                        keyPositions.append(position)
+                        keyParts.append((slots[arg], None))
+                    else:
+                        slots[arg] = len(slots)
+                        seen.add(arg)
+                        newSlots.append((position, slots[arg]))
+                elif isinstance(arg, Const) and isinstance(arg.value, (int, float, str)):
+                    keyPositions.append(position)
+                    keyParts.append((None, arg.value))
+                else:
+                    return None
+            steps.append((analysis, tuple(keyPositions), keyParts, newSlots, checks))
+        return steps, list(slots)
+    # Fills in values with each solution of the goals from the step'th one on.
+    def joinStep(self, steps, step, values, state, depth):
+        if step == len(steps):
+            yield
+            return
+        state.infer(depth)      # Like calling the goal.
+        analysis, keyPositions, keyParts, newSlots, checks = steps[step]
+        key = tuple(value if slot is None else values[slot] for slot, value in keyParts)
+        for row in analysis.factIndex(keyPositions).get(key, ()):
+            for position, slot in newSlots:
+                values[slot] = row[position]
+            if all(row[position] == values[slot] for position, slot in checks):
+                yield from self.joinStep(steps, step + 1, values, state, depth)
+
+
 # This flattens a list with "|" into a list with values, not terms.
 def flatten(toFlatten):
     if not isinstance(toFlatten, list):
         return toFlatten
     lst = toFlatten[:]
+    tail = []
     if len(lst) > 2 and lst[-2].value == "|":
-        tail = lst.pop()
+        tail = flatten(lst.pop().value)
         lst.pop()
-        lst.extend(flatten(tail.value))
-    return [item.value if isinstance(item, Term) else item for item in lst]
+        if not isinstance(tail, list):
+            tail = ["|", tail]      # The tail is unbound, so the list is only partly known.
+    return [flatten(item.value) if isinstance(item, Term) else item for item in lst] + tail
+
+
+# Returns a term as a Python value: a number, a str for an atom, a list, a tuple of the name and args for a goal,
+# a frozenset for a set or a dict for a map. An unbound Var is None, and a list with an unbound tail ends in "|", None.
+def toPython(term):
+    term = deref(term)
+    if isinstance(term, Const):
+        value = term.value
+        return [] if isinstance(value, list) else value     # A new list, so the empty list's Const is never changed.
+    if isinstance(term, ListPL):
+        items = []
+        while isinstance(term, ListPL):
+            items.append(toPython(term.head))
+            term = deref(term.tail)
+        if isinstance(term, Var):
+            items += ["|", None]
+        elif not (isinstance(term, Const) and term.value == []):
+            items += ["|", toPython(term)]
+        return items
+    if isinstance(term, Var):
+        return None
+    if isinstance(term, Goal):
+        return (term.name,) + tuple(toPython(arg) for arg in term.args)
+    if isinstance(term, SetPL):
+        return frozenset(toPython(member) for key, member in term.trie)
+    if isinstance(term, MapPL):
+        return {toPython(keyTerm): toPython(value) for key, (keyTerm, value) in term.trie}
+    return term.value
+
+
+# Returns the terms in a list as a Python list.
+def listTerms(term):
+    terms = []
+    term = deref(term)
+    while isinstance(term, ListPL):
+        terms.append(term.head)
+        term = deref(term.tail)
+    return terms
+
+
+# Returns the goals of an arg of a control goal, like call or parallel, which is a goal or a list of goals.
+def branchGoals(arg):
+    arg = deref(arg)
+    if isinstance(arg, Goal):
+        return [arg]
+    goals = [deref(goal) for goal in listTerms(arg)] if isinstance(arg, ListPL) \
+        or (isinstance(arg, Const) and arg.value == []) else [arg]
+    for goal in goals:
+        if isinstance(goal, Var):
+            raise ValueError("A goal must be bound before it is called, but '" + goal.name + "' isn't.")
+        if not isinstance(goal, Goal):
+            raise TypeError(str(flatten(goal.value)) + " isn't a goal, so it can't be called.")
+    return goals
+
+
+# Like tryGoals, but an empty list of goals succeeds once.
+def solveGoals(goals, state, depth):
+    if goals:
+        return tryGoals(goals, state, depth)
+    return iter([(True, False), (False, False)])
+
+
+# Returns whether the goals have an answer, keeping the bindings of the first one. Their generators are closed
+# right away, so no choicepoints are left behind.
+# Iterative deepening's depthBound isn't used for them, since goals that only failed because of it would make
+# not_ succeed, or once and if_then_else commit to a different answer, and a deeper round can't take that back.
+def firstAnswer(goals, state, depth):
+    depthBound = state.depthBound
+    state.depthBound = float("inf")
+    attempts = solveGoals(goals, state, depth)
+    try:
+        return bool(next(attempts)[0])
+    finally:
+        if hasattr(attempts, "close"):
+            attempts.close()
+        state.depthBound = depthBound
+
+
+# Each control goal takes the goal, the query state and the depth, and yields once for each answer.
+# A cut in the goals that they run only cuts those goals.
+def callGoal(goal, state, depth):
+    mark = len(state.trail)
+    for attempt in solveGoals(branchGoals(goal.args[0]), state, depth + 1):
+        if not attempt[0]:
+            break
+        yield True
+    state.undo(mark)
+
+def notGoal(goal, state, depth):
+    mark = len(state.trail)
+    found = firstAnswer(branchGoals(goal.args[0]), state, depth + 1)
+    state.undo(mark)
+    if not found:
+        yield True
+
+def onceGoal(goal, state, depth):
+    mark = len(state.trail)
+    if firstAnswer(branchGoals(goal.args[0]), state, depth + 1):
+        yield True
+    state.undo(mark)
+
+def ignoreGoal(goal, state, depth):
+    mark = len(state.trail)
+    firstAnswer(branchGoals(goal.args[0]), state, depth + 1)
+    yield True
+    state.undo(mark)
+
+def ifThenElseGoal(goal, state, depth):
+    mark = len(state.trail)
+    if firstAnswer(branchGoals(goal.args[0]), state, depth + 1):
+        branch = goal.args[1]
+    elif len(goal.args) > 2:
+        branch = goal.args[2]
+    else:
+        state.undo(mark)
+        return
+    for attempt in solveGoals(branchGoals(branch), state, depth + 1):
+        if not attempt[0]:
+            break
+        yield True
+    state.undo(mark)
 
 
 # #### Built-in Features ####
 
 # Use to make queries.
-query = Query()
+query = ThreadQuery()
 
 # Evaluates both sides and then tries to unify.
 equals = Predicate("equals")
@@ -450,10 +1463,28 @@ notEqual = Predicate("notEqual")
 # This allows a goal to be used as an argument for another goal.
 call = Predicate("call")
 
-# \+/1 predicate.
+# call_with_inference_limit/3: calls arg1, letting it make at most arg2 inferences.
+# arg3 becomes "true" when the goal succeeds, or "inference_limit_exceeded" when it runs out of inferences.
+call_with_inference_limit = Predicate("call_with_inference_limit")
+
+# \+/1 predicate. It succeeds if its goal (or list of goals) has no answer.
 not_ = Predicate("not_")
-not_("A") >> [call("A"), cut(), fail()]
-not_("_") >> []
+
+# once/1: gives the first answer of a goal, or list of goals, and discards the rest.
+once = Predicate("once")
+
+# ignore/1: like once, but succeeds without binding anything if the goal fails.
+ignore = Predicate("ignore")
+
+# if_then_else/3: if_then_else(Cond, Then, Else) is (Cond -> Then ; Else). It runs Then with the first answer
+# of Cond, or Else if Cond has no answer. Each of them may be a goal or a list of goals.
+if_then_else = Predicate("if_then_else")
+
+# if_then/2: if_then(Cond, Then) is (Cond -> Then), which fails if Cond has no answer.
+if_then = Predicate("if_then")
+
+controlGoals = {call: callGoal, not_: notGoal, once: onceGoal, ignore: ignoreGoal, if_then_else: ifThenElseGoal,
+    if_then: ifThenElseGoal}
 
 # The comparison predicates.
 lt = Predicate("less than")
@@ -482,3 +1513,3744 @@ reverse("Xs", "Ys") >> [reverse("Xs", [], "Ys", "Ys")]
 reverse([], "Ys", "Ys", []) >> []
 reverse(["X", "|", "Xs"], "Rs", "Ys", ["_", "|", "Bound"]) >> [reverse("Xs", ["X", "|", "Rs"], "Ys", "Bound")]
 
+
+
+# #### Finite Domain Constraints ####
+
+infinity = float("inf")
+
+
+# A Domain is the set of integers that a Var may still take.
+# When values is None, the Domain is every integer from lo to hi. lo and hi may be infinite.
+class Domain():
+    def __init__(self, lo, hi, values = None):
+        if values is not None:
+            values = frozenset(value for value in values if lo <= value <= hi)
+            lo = min(values, default = 1)
+            hi = max(values, default = 0)
+            if len(values) == hi - lo + 1:
+                values = None       # There are no gaps, so the bounds are enough.
+        self.lo = lo
+        self.hi = hi
+        self.values = values
+    def size(self):
+        if self.lo > self.hi:
+            return 0
+        if self.values is None:
+            return self.hi - self.lo + 1 if self.isFinite() else infinity    # So an unbounded domain's size isn't nan.
+        return len(self.values)
+    def isFinite(self):
+        return self.lo != -infinity and self.hi != infinity
+    def __contains__(self, value):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not isinstance(value, int):
+            return False
+        return self.lo <= value <= self.hi and (self.values is None or value in self.values)
+    def __iter__(self):
+        if self.values is None:
+            return iter(range(self.lo, self.hi + 1))
+        return iter(sorted(self.values))
+    # Keeps only the values from lo to hi.
+    def restrict(self, lo, hi):
+        if lo <= self.lo and hi >= self.hi:
+            return self
+        return Domain(max(lo, self.lo), min(hi, self.hi), self.values)
+    def remove(self, value):
+        if value not in self:
+            return self
+        if value == self.lo:
+            return self.restrict(value + 1, self.hi)
+        if value == self.hi:
+            return self.restrict(self.lo, value - 1)
+        if not self.isFinite():
+            return self     # An infinite domain can't have gaps.
+        return Domain(self.lo, self.hi, [other for other in self if other != value])
+    def intersect(self, other):
+        domain = self.restrict(other.lo, other.hi)
+        if other.values is not None:
+            domain = Domain(domain.lo, domain.hi, [value for value in other.values if value in domain])
+        return domain
+    def __repr__(self):
+        if self.values is None:
+            return str(self.lo) + ".." + str(self.hi)
+        return str(sorted(self.values))
+
+
+# Returns the Domain of a Var, which is every integer if it was never given one.
+def fdDomain(var):
+    if var.domain is None:
+        return Domain(-infinity, infinity)
+    return var.domain
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# Returns the numeric value of a bound term, for the constraints.
+def numericValue(term):
+    if not isNumber(term.value):
+        raise ValueError("'" + str(term.name) + "' doesn't have a numeric value.")
+    return term.value
+
+
+# Turns a term into a tree for the constraints.
+# Leaves are terms, and nodes are (operator, left, right), or ("neg", operand) for negation.
+def mathTree(term):
+    if not isinstance(term, Math):
+        return term
+    # mathToList splits "**" and "//" into two operators, so join them back together.
+    tokens = []
+    for token in term.mathList:
+        if isinstance(token, str) and token in ("*", "/") and tokens and tokens[-1] == token:
+            tokens[-1] = token * 2
+        else:
+            tokens.append(token)
+    pos = 0
+    def isOperator(*operators):
+        return pos < len(tokens) and isinstance(tokens[pos], str) and tokens[pos] in operators
+    def parseSum():
+        nonlocal pos
+        tree = parseProduct()
+        while isOperator("+", "-"):
+            pos += 1
+            tree = (tokens[pos - 1], tree, parseProduct())
+        return tree
+    def parseProduct():
+        nonlocal pos
+        tree = parseUnary()
+        while isOperator("*", "/", "//", "%"):
+            pos += 1
+            tree = (tokens[pos - 1], tree, parseUnary())
+        return tree
+    def parseUnary():
+        nonlocal pos
+        if isOperator("-"):
+            pos += 1
+            return ("neg", parseUnary())
+        if isOperator("+"):
+            pos += 1
+            return parseUnary()
+        tree = parseAtom()
+        if isOperator("**"):
+            pos += 1
+            tree = ("**", tree, parseUnary())
+        return tree
+    def parseAtom():
+        nonlocal pos
+        pos += 1
+        if tokens[pos - 1] == "(":
+            tree = parseSum()
+            pos += 1        # Skip the ")".
+            return tree
+        return tokens[pos - 1]
+    return parseSum()
+
+
+# Evaluates a tree from mathTree, using value for var.
+# Returns None if the tree has a Var that is still unbound.
+def evalTree(tree, var = None, value = None):
+    if isinstance(tree, tuple):
+        operands = [evalTree(operand, var, value) for operand in tree[1:]]
+        if None in operands:
+            return None
+        if tree[0] == "neg":
+            return -operands[0]
+        left, right = operands
+        if tree[0] == "+":
+            return left + right
+        if tree[0] == "-":
+            return left - right
+        if tree[0] == "*":
+            return left * right
+        if tree[0] == "/":
+            return left / right
+        if tree[0] == "//":
+            return left // right
+        if tree[0] == "%":
+            return left % right
+        return left ** right
+    if isNumber(tree):
+        return tree
+    term = deref(tree)
+    if term is var:
+        return value
+    if isinstance(term, Var):
+        return None
+    return numericValue(term)
+
+
+# Turns a tree into a sum of Vars times coefficients, plus a constant.
+# Returns (coeffs, constant), where coeffs maps id(var) to [var, coeff], or None if the tree isn't linear.
+def linearize(tree):
+    if isinstance(tree, tuple):
+        parts = [linearize(operand) for operand in tree[1:]]
+        if None in parts:
+            return None
+        if tree[0] == "neg":
+            return scaleLinear(parts[0], -1)
+        (leftCoeffs, leftConst), (rightCoeffs, rightConst) = parts
+        if tree[0] in ("+", "-"):
+            sign = 1 if tree[0] == "+" else -1
+            coeffs = {key: list(pair) for key, pair in leftCoeffs.items()}
+            for key, (var, coeff) in rightCoeffs.items():
+                coeffs.setdefault(key, [var, 0])[1] += sign * coeff
+            return coeffs, leftConst + sign * rightConst
+        if tree[0] == "*" and not leftCoeffs:
+            return scaleLinear(parts[1], leftConst)
+        if tree[0] == "*" and not rightCoeffs:
+            return scaleLinear(parts[0], rightConst)
+        if leftCoeffs or rightCoeffs:
+            return None
+        return {}, evalTree((tree[0], leftConst, rightConst))
+    term = deref(tree)
+    if isinstance(term, Var):
+        return {id(term): [term, 1]}, 0
+    return {}, numericValue(term)
+
+
+def scaleLinear(linear, factor):
+    coeffs, const = linear
+    return {key: [var, coeff * factor] for key, (var, coeff) in coeffs.items()}, const * factor
+
+
+# Divides a bound by a coefficient, rounding to the nearest integer inside the bound.
+def divideBound(bound, coeff, roundUp):
+    if bound in (infinity, -infinity):
+        return bound / coeff
+    if roundUp:
+        return int(-(-bound // coeff))
+    return int(bound // coeff)
+
+
+# The Vars in a list of terms that are still unbound, without repeats.
+def unboundVars(terms):
+    found = {}
+    for term in terms:
+        term = deref(term)
+        if isinstance(term, Var):
+            found[id(term)] = term
+    return list(found.values())
+
+
+# sum(coeff * var) + const op 0, where op is "=", "!=" or "<=".
+# Propagation narrows the bounds of each Var from the bounds of the others.
+class LinearConstraint():
+    def __init__(self, op, coeffs, const):
+        self.op = op
+        self.coeffs = coeffs    # A list of (term, coeff) pairs.
+        self.const = const
+    def vars(self):
+        return unboundVars([term for term, coeff in self.coeffs])
+    def propagate(self, state):
+        const = self.const
+        coeffs = {}
+        for term, coeff in self.coeffs:
+            term = deref(term)
+            if isinstance(term, Var):
+                coeffs.setdefault(id(term), [term, 0])[1] += coeff
+            else:
+                const += coeff * numericValue(term)
+        terms = [(var, coeff) for var, coeff in coeffs.values() if coeff != 0]
+        if self.op == "!=":
+            if not terms:
+                return const != 0
+            if len(terms) == 1:
+                var, coeff = terms[0]
+                value = -const / coeff
+                if value.is_integer():
+                    return state.narrow(var, fdDomain(var).remove(int(value)))
+            return True
+        # The smallest and largest that each coeff * var can be.
+        lows = []
+        highs = []
+        for var, coeff in terms:
+            domain = fdDomain(var)
+            ends = (coeff * domain.lo, coeff * domain.hi)
+            lows.append(min(ends))
+            highs.append(max(ends))
+        low = const + sum(low for low in lows if low != -infinity)
+        high = const + sum(high for high in highs if high != infinity)
+        lowInfinite = lows.count(-infinity)
+        highInfinite = highs.count(infinity)
+        if (low > 0 and not lowInfinite) or (self.op == "=" and high < 0 and not highInfinite):
+            return False
+        for i, (var, coeff) in enumerate(terms):
+            # The bounds of everything except this coeff * var.
+            # Infinite ends were left out of low and high, so they are only taken off of them when finite.
+            restLow = -infinity if lowInfinite - (lows[i] == -infinity) else low - lows[i] if lows[i] != -infinity else low
+            restHigh = infinity if highInfinite - (highs[i] == infinity) else high - highs[i] if highs[i] != infinity else high
+            upper = -restLow
+            lower = -restHigh if self.op == "=" else -infinity
+            if coeff > 0:
+                lo, hi = divideBound(lower, coeff, True), divideBound(upper, coeff, False)
+            else:
+                lo, hi = divideBound(upper, coeff, True), divideBound(lower, coeff, False)
+            if not state.narrow(var, fdDomain(var).restrict(lo, hi)):
+                return False
+        return True
+
+
+# A constraint that isn't linear, like X * Y #= 12.
+# It is checked once its Vars are bound, and narrows the last unbound Var by trying each of its values.
+class TreeConstraint():
+    maxValuesTried = 10000
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+    def vars(self):
+        return unboundVars(treeLeaves(self.left) + treeLeaves(self.right))
+    def holds(self, var = None, value = None):
+        return compareValues(evalTree(self.left, var, value), self.op, evalTree(self.right, var, value))
+    def propagate(self, state):
+        vars = self.vars()
+        if not vars:
+            return self.holds()
+        domain = fdDomain(vars[0])
+        if len(vars) == 1 and domain.isFinite() and domain.size() <= self.maxValuesTried:
+            kept = [value for value in domain if self.holds(vars[0], value)]
+            return state.narrow(vars[0], Domain(domain.lo, domain.hi, kept))
+        return True
+
+
+def treeLeaves(tree):
+    if isinstance(tree, tuple):
+        return [leaf for operand in tree[1:] for leaf in treeLeaves(operand)]
+    return [tree]
+
+
+def compareValues(left, op, right):
+    if op == "=":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left >= right
+
+
+# Every term in the list must have a different value.
+# Propagation removes bound values from the other Vars, and fails if there are fewer values than Vars.
+class AllDifferent():
+    def __init__(self, terms):
+        self.terms = terms
+    def vars(self):
+        return unboundVars(self.terms)
+    def propagate(self, state):
+        seen = set()
+        unbound = []
+        for term in self.terms:
+            term = deref(term)
+            if isinstance(term, Var):
+                if any(var is term for var in unbound):
+                    return False        # The same Var can't be different from itself.
+                unbound.append(term)
+            elif term.value in seen:
+                return False
+            else:
+                seen.add(term.value)
+        for var in unbound:
+            domain = fdDomain(var)
+            for value in seen:
+                domain = domain.remove(value)
+            if not state.narrow(var, domain):
+                return False
+        domains = [fdDomain(var) for var in unbound if isinstance(deref(var), Var)]
+        if all(domain.isFinite() and domain.size() <= TreeConstraint.maxValuesTried for domain in domains):
+            values = set()
+            for domain in domains:
+                values.update(domain)
+            if len(values) < len(domains):
+                return False
+        return True
+
+
+# Posts the comparison between the two args of an arithmetic constraint goal.
+def postComparison(goal, op, state):
+    left = mathTree(goal.args[0])
+    right = mathTree(goal.args[1])
+    leftLinear = linearize(left)
+    rightLinear = linearize(right)
+    if leftLinear is None or rightLinear is None:
+        return state.post(TreeConstraint(op, left, right))
+    # Move everything to the left, so that it is compared to 0.
+    if op in (">", ">="):
+        leftLinear, rightLinear = rightLinear, leftLinear
+        op = "<" if op == ">" else "<="
+    coeffs = {key: list(pair) for key, pair in leftLinear[0].items()}
+    for key, (var, coeff) in rightLinear[0].items():
+        coeffs.setdefault(key, [var, 0])[1] -= coeff
+    const = leftLinear[1] - rightLinear[1]
+    if op == "<":
+        op = "<="
+        const += 1          # Values are integers, so A < B is the same as A - B + 1 =< 0.
+    return state.post(LinearConstraint(op, [tuple(pair) for pair in coeffs.values()], const))
+
+
+# Gives a term a smaller domain, or checks that a bound term is in it.
+def restrictDomain(term, domain, state):
+    term = deref(term)
+    if isinstance(term, Var):
+        return state.narrow(term, fdDomain(term).intersect(domain)) and state.propagate()
+    return term.value in domain
+
+
+def fdIn(goal, state):
+    if len(goal.args) == 2:
+        values = [numericValue(deref(term)) for term in listTerms(goal.args[1])]
+        domain = Domain(-infinity, infinity, values)
+    else:
+        domain = Domain(numericValue(deref(goal.args[1])), numericValue(deref(goal.args[2])))
+    return restrictDomain(goal.args[0], domain, state)
+
+
+def fdIns(goal, state):
+    domain = Domain(numericValue(deref(goal.args[1])), numericValue(deref(goal.args[2])))
+    return all(restrictDomain(term, domain, state) for term in listTerms(goal.args[0]))
+
+
+# Tries each value of each Var in turn, until they are all bound.
+# With the "ff" (first-fail) option, the Var with the smallest domain is tried first.
+def labelVars(terms, options, state):
+    vars = unboundVars(terms)
+    if not vars:
+        yield True
+        return
+    for var in vars:
+        if not fdDomain(var).isFinite():
+            raise ValueError("'" + var.name + "' doesn't have a finite domain.")
+    var = vars[0]
+    if "ff" in options:
+        var = min(vars, key = lambda var: var.domain.size())
+    values = list(var.domain)
+    if "down" in options:
+        values.reverse()
+    for value in values:
+        mark = len(state.trail)
+        if unify(var, Const(value), state):
+            yield from labelVars(vars, options, state)
+        state.undo(mark)
+
+
+# in_/2,3: in_("X", 1, 10) gives X the domain 1..10, and in_("X", [1, 3, 5]) gives it those values.
+in_ = Predicate("in")
+
+# ins/3: ins(["X", "Y"], 1, 10) gives each Var in the list the domain 1..10.
+ins = Predicate("ins")
+
+# The arithmetic constraints. Each side may be a number, a Var, or math like "X + 2 * Y".
+fdEquals = Predicate("#=")
+fdNotEqual = Predicate("#\\=")
+fdLt = Predicate("#<")
+fdLe = Predicate("#=<")
+fdGt = Predicate("#>")
+fdGe = Predicate("#>=")
+
+# all_different/1: every term in the list must have a different value.
+all_different = Predicate("all_different")
+
+# label/1 binds each Var in the list to a value in its domain, trying the Var with the smallest domain first.
+# labeling/2 takes a list of options first: "ff" or "leftmost" to choose the Var, and "up" or "down" for its values.
+label = Predicate("label")
+labeling = Predicate("labeling")
+
+# Each finite domain built-in takes the goal and the query state, and returns whether it succeeded.
+fdConstraints = {
+    in_: fdIn,
+    ins: fdIns,
+    fdEquals: lambda goal, state: postComparison(goal, "=", state),
+    fdNotEqual: lambda goal, state: postComparison(goal, "!=", state),
+    fdLt: lambda goal, state: postComparison(goal, "<", state),
+    fdLe: lambda goal, state: postComparison(goal, "<=", state),
+    fdGt: lambda goal, state: postComparison(goal, ">", state),
+    fdGe: lambda goal, state: postComparison(goal, ">=", state),
+    all_different: lambda goal, state: state.post(AllDifferent(listTerms(goal.args[0]))),
+}
+
+
+
+# #### Compiled Predicates ####
+
+# A compiled alt is a Python function made just for that alt, which does the same thing as tryAlt.
+# Instead of creating the alt's terms and unifying them with unify, each head arg is matched by its own
+# code, constants are compared inline, math is turned into a Python expression, and the body goals are
+# made straight from the alt's Vars. Comparisons at the start of the body are done inline too.
+# The body is then run by tryGoals, so cut, limits and output work the same as in the interpreter.
+# Use pred.compile() for one predicate, or compileAll() for the whole knowledge base.
+
+
+# Compiles every predicate that has alts.
+def compileAll():
+    for pred in list(Predicate.registry):
+        if pred.alternatives:
+            pred.compile()
+
+
+# Math made by a compiled alt. It keeps its mathList, but evaluate works it out as a Python expression.
+class NativeMath(Math):
+    def __init__(self, mathList, evaluate):
+        self.mathList = mathList
+        self.evaluate = evaluate
+    @property
+    def value(self):
+        return self.evaluate(self.mathList)
+
+
+# The value of a term used in math, which must be a number.
+def numberValue(term):
+    value = term.value
+    if not isinstance(value, (int, float)):
+        raise ValueError("'" + str(term.name) + "' doesn't have a numeric value.")
+    return value
+
+
+# Args at the start of an alt's body that are compared inline, and the Python operator used for them.
+inlineComparisons = {}
+
+
+# Returns the compiled function of an alt, compiling it if it hasn't been compiled yet.
+def compileAlt(alt):
+    if alt.compiled is None:
+        alt.compiled = AltCompiler(alt).compile()
+    return alt.compiled
+
+
+# Writes the Python code of a compiled alt. The code is made from the alt's raw args and goals,
+# following the same rules as create, and uses the names in self.namespace for its constants.
+class AltCompiler():
+    def __init__(self, alt):
+        self.alt = alt
+        self.lines = []
+        self.namespace = {"deref": deref, "unify": unify, "tryGoals": tryGoals, "Var": Var, "Const": Const,
+            "ListPL": ListPL, "Goal": Goal, "Math": Math, "NativeMath": NativeMath, "numberValue": numberValue,
+            "planGoals": planGoals, "SetPL": SetPL, "MapPL": MapPL}
+        self.constants = {}     # The name in namespace of each constant, keyed by id.
+        self.vars = {}          # The local name of each named Var in the alt.
+        self.defined = set()    # The named Vars that have a value at this point in the code.
+        self.temps = 0
+    def compile(self):
+        alt = self.alt
+        self.emit(0, "def clause(args, state, depth):")
+        for position, arg in enumerate(alt.args):
+            self.matchHead(arg, "args[" + str(position) + "]", 1)
+        goals = list(alt.goals)
+        while goals and self.isInlineComparison(goals[0]):
+            self.compareInline(goals.pop(0))
+        if goals:
+            self.defineVars(goals, 1)
+            self.emit(1, "goals = [" + ", ".join(self.build(goal) for goal in goals) + "]")
+            self.emit(1, "if " + self.constant(alt.pred, "p") + ".reordered:")
+            self.emit(2, "goals = planGoals(goals)[0]")
+            self.emit(1, "for attempt in tryGoals(goals, state, depth):")
+            self.emit(2, "yield attempt")
+            self.emit(2, "if attempt[1]:")
+            self.emit(3, "break")
+        else:
+            self.emit(1, "yield True, False")
+        source = "\n".join(self.lines) + "\n"
+        exec(source, self.namespace)
+        clause = self.namespace["clause"]
+        clause.source = source      # Kept so the code can be looked at, e.g. print(alt.compiled.source).
+        return clause
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+    def temp(self):
+        self.temps += 1
+        return "t" + str(self.temps)
+    # Returns the name of a value in the namespace.
+    def constant(self, value, prefix = "k"):
+        if id(value) not in self.constants:
+            name = prefix + str(len(self.constants))
+            self.constants[id(value)] = name
+            self.namespace[name] = value
+        return self.constants[id(value)]
+    # Returns how a raw arg would be created: "var", "anon", "const", "math", "list", "goal", or "term" for a
+    # term that was already made.
+    @staticmethod
+    def kind(arg):
+        if isinstance(arg, int) or isinstance(arg, float):
+            return "const"
+        if isinstance(arg, (set, frozenset)):
+            return "set"
+        if isinstance(arg, dict):
+            return "map"
+        if isinstance(arg, list):
+            return "list" if arg else "const"
+        if isinstance(arg, Goal):
+            return "goal"
+        if isinstance(arg, Term):
+            return "term"
+        if arg[0].isupper() and " " not in arg:
+            return "var"
+        if arg[0] == "_":
+            return "anon"
+        if arg[0] == "'" and arg[-1] == "'":
+            return "const"
+        if " " in arg:
+            return "math"
+        return "const"
+    def varName(self, name):
+        if name not in self.vars:
+            self.vars[name] = "v" + str(len(self.vars))
+        return self.vars[name]
+    # The named Vars in a raw arg, in order.
+    def namedVars(self, arg):
+        kind = self.kind(arg)
+        if kind == "var":
+            return [arg]
+        if kind == "list":
+            return [name for item in arg for name in self.namedVars(item)]
+        if kind == "goal":
+            items = arg.args
+            if arg.name == "format_":
+                items = arg.args[1] if len(arg.args) > 1 else []   # The string to write has no Vars.
+            return [name for item in items for name in self.namedVars(item)]
+        if kind == "math":
+            return [token for token in mathTokens(arg) if token not in mathOperators and self.kind(token) == "var"]
+        if kind == "set":
+            return [name for item in arg for name in self.namedVars(item)]
+        if kind == "map":
+            return [name for pair in arg.items() for item in pair for name in self.namedVars(item)]
+        return []
+    # Creates new Vars for the named Vars in args that don't have a value yet.
+    def defineVars(self, args, indent):
+        for arg in args:
+            for name in self.namedVars(arg):
+                if name not in self.defined:
+                    self.emit(indent, self.varName(name) + " = Var(" + repr(name) + ")")
+                    self.defined.add(name)
+    # Returns an expression that makes the term for a raw arg. Its named Vars must already be defined.
+    def build(self, arg):
+        kind = self.kind(arg)
+        if kind == "var":
+            return self.vars[arg]
+        if kind == "anon":
+            return "Var(" + repr(arg) + ")"
+        if kind == "const":
+            return self.constant(create(arg))
+        if kind == "list":
+            return "ListPL([" + ", ".join(self.build(item) for item in arg) + "])"
+        if kind == "goal":
+            pred = self.constant(arg.pred, "p")
+            if arg.name == "format_":
+                items = "[" + ", ".join(self.build(item) for item in arg.args[1]) + "]" if len(arg.args) > 1 else "[]"
+                return "Goal(" + pred + ", [" + self.constant(arg.args[0]) + ", " + items + "])"
+            return "Goal(" + pred + ", [" + ", ".join(self.build(item) for item in arg.args) + "])"
+        if kind == "set":
+            return "SetPL.fromTerms([" + ", ".join(self.build(item) for item in arg) + "])"
+        if kind == "map":
+            return "MapPL.fromPairs([" + ", ".join("(" + self.build(key) + ", " + self.build(value) + ")"
+                for key, value in arg.items()) + "])"
+        if kind == "term":
+            return self.constant(arg)
+        return self.buildMath(arg)
+    # Math is made into a NativeMath, with a Python function that evaluates its mathList.
+    def buildMath(self, arg):
+        tokens = mathTokens(arg)
+        terms = []
+        expression = []
+        for i, token in enumerate(tokens):
+            if token in mathOperators:
+                terms.append(repr(token))
+                expression.append(token)
+                continue
+            terms.append(self.build(token))
+            value = create(token)
+            if isinstance(value, Const) and isinstance(value.value, (int, float)) and abs(value.value) != infinity:
+                expression.append(repr(value.value))   # Numbers are put straight into the expression.
+            else:
+                expression.append("numberValue(m[" + str(i) + "])")
+        evaluate = eval("lambda m: " + "".join(expression), self.namespace)
+        return "NativeMath([" + ", ".join(terms) + "], " + self.constant(evaluate, "m") + ")"
+    # Writes the code that unifies the term in expr with a raw head arg, returning from clause if it can't.
+    def matchHead(self, arg, expr, indent):
+        kind = self.kind(arg)
+        if kind == "var" and arg not in self.defined:
+            # The first time a Var is seen, it can just be the term it would be bound to.
+            name = self.varName(arg)
+            self.emit(indent, name + " = " + expr)
+            self.emit(indent, "if isinstance(" + name + ", Math):")
+            self.emit(indent + 1, name + " = Const(" + name + ".value)")
+            self.defined.add(arg)
+        elif kind == "anon":
+            self.emit(indent, "if isinstance(" + expr + ", Math):")
+            self.emit(indent + 1, expr + ".value")        # Math is still evaluated, in case it can't be.
+        elif kind == "const":
+            term = self.temp()
+            const = create(arg)
+            value = const.value
+            if isinstance(value, (int, str)) or (isinstance(value, float) and abs(value) != infinity):
+                literal = repr(value)
+            else:
+                literal = self.constant(value)
+            self.emit(indent, term + " = deref(" + expr + ")")
+            self.emit(indent, "if " + term + ".__class__ is Var:")
+            self.emit(indent + 1, "if not state.bind(" + term + ", " + self.constant(const) + "):")
+            self.emit(indent + 2, "return")
+            self.emit(indent, "elif " + term + ".__class__ is Const:")
+            self.emit(indent + 1, "if " + term + ".value != " + literal + ":")
+            self.emit(indent + 2, "return")
+            self.emit(indent, "elif not unify(" + term + ", " + self.constant(const) + ", state):")
+            self.emit(indent + 1, "return")
+        elif kind == "list":
+            term = self.temp()
+            self.emit(indent, term + " = deref(" + expr + ")")
+            self.emit(indent, "if isinstance(" + term + ", ListPL):")
+            before = set(self.defined)
+            self.matchHead(arg[0], term + ".head", indent + 1)
+            rest = arg[1:]
+            if not rest:
+                rest = []
+            elif isinstance(rest[0], str) and rest[0] == "|":
+                rest = rest[-1]
+            self.matchHead(rest, term + ".tail", indent + 1)
+            after = self.defined
+            self.defined = before
+            self.emit(indent, "elif " + term + ".__class__ is Var:")
+            self.defineVars([arg], indent + 1)
+            self.emit(indent + 1, "if not state.bind(" + term + ", " + self.build(arg) + "):")
+            self.emit(indent + 2, "return")
+            self.emit(indent, "else:")
+            self.emit(indent + 1, "return")
+            self.defined = after | self.defined
+        else:
+            # Repeated Vars, goals and math are unified the same way the interpreter does.
+            self.defineVars([arg], indent)
+            self.emit(indent, "if not unify(" + expr + ", " + self.build(arg) + ", state):")
+            self.emit(indent + 1, "return")
+    @staticmethod
+    def isInlineComparison(goal):
+        return (isinstance(goal, Goal) and goal.pred in inlineComparisons and len(goal.args) == 2
+            and 2 not in goal.pred.alternatives)
+    # Writes a comparison at the start of the body. Like tryGoal, it counts as an inference.
+    def compareInline(self, goal):
+        self.defineVars(goal.args, 1)
+        left, right = [self.build(arg) + ".value" for arg in goal.args]
+        self.emit(1, "state.infer(depth)")
+        self.emit(1, "if not " + left + " " + inlineComparisons[goal.pred] + " " + right + ":")
+        self.emit(2, "return")
+
+
+inlineComparisons.update({lt: "<", le: "<=", gt: ">", ge: ">="})
+
+
+
+# #### Goal Reordering ####
+
+# planGoals puts the goals of a conjunction in the order that it expects to be cheapest, by choosing the
+# goal with the fewest expected solutions each time. The number of solutions is guessed from how many
+# alts match the args that are already bound. Args that earlier goals will bind are guessed to leave
+# one in every few alts, where few is the number of different keys the arg has.
+# Goals are only moved when that can't change the answers, apart from their order:
+# - Impure goals, like cut and write, and goals that call them, stay where they are, and nothing is moved past them.
+# - Goals that call rules stay in the same order as each other, since a rule may not stop with other args unbound.
+# - Goals that need their args to be bound, like lt, are only moved before goals that were written before
+#   them once their Vars are bound by atoms, numbers or fact tables.
+
+
+# Goals that can't be moved. Predicates that call them can't be moved either.
+impureGoals = {cut, write, format_, nl, call_with_inference_limit, fail, label, labeling}
+impureGoals.update(controlGoals)
+impureGoals.update(fdConstraints)
+# Goals that need their args to be bound, and how many solutions each is guessed to have.
+boundGoals = {lt: 0.5, le: 0.5, gt: 0.5, ge: 0.5, notEqual: 0.5}
+ruleCost = 10       # How many solutions each alt of a rule is guessed to have.
+purity = {}         # Whether each predicate is pure, and the value of Predicate.changes when that was found.
+
+
+# Returns True if no alt of pred calls an impure goal, even through other predicates.
+def isPure(pred, visiting = None):
+    if pred in impureGoals:
+        return False
+    cached = purity.get(pred)
+    if cached is not None and cached[1] == Predicate.changes:
+        return cached[0]
+    visiting = visiting or set()
+    if pred in visiting:
+        return True     # A predicate that calls itself is as pure as its other goals.
+    visiting.add(pred)
+    pure = all(isinstance(goal, Goal) and isPure(goal.pred, visiting)
+        for alts in list(pred.alternatives.values()) for alt in alts for goal in alt.goals)
+    visiting.discard(pred)
+    purity[pred] = (pure, Predicate.changes)
+    return pure
+
+
+# Returns the Vars in a term that aren't bound.
+def freeVars(term, result = None):
+    result = [] if result is None else result
+    term = deref(term)
+    if isinstance(term, Var):
+        if term not in result:
+            result.append(term)
+    elif isinstance(term, ListPL):
+        freeVars(term.head, result)
+        freeVars(term.tail, result)
+    elif isinstance(term, Goal):
+        for arg in term.args:
+            freeVars(arg, result)
+    elif isinstance(term, Math):
+        for item in term.mathList:
+            if isinstance(item, Term):
+                freeVars(item, result)
+    return result
+
+
+# Guesses how many solutions a goal has. known is the set of Vars that the goals before it are guessed to bind.
+def goalCost(goal, known):
+    if goal.pred in boundGoals:
+        return boundGoals[goal.pred]
+    arity = len(goal.args)
+    if arity in goal.pred.sharded:
+        return 1 if callKey(goal.args[goal.pred.sharded[arity].position]) is not None else ruleCost
+    if arity in goal.pred.mapped:
+        return goal.pred.mapped[arity].count(goal.args)
+    if arity not in goal.pred.alternatives:
+        return 0                # The goal can only fail.
+    analysis = goal.pred.analyze(arity)
+    args = [deref(arg) for arg in goal.args]
+    if analysis.facts is not None:
+        keyPositions = tuple(i for i, arg in enumerate(args) if not isinstance(arg, Var))
+        key = tuple(callKey(args[i]) for i in keyPositions)
+        try:
+            cost = len(analysis.factIndex(keyPositions).get(key, ()))
+        except TypeError:
+            return 0            # The key can't be hashed, so it is a list or goal, which no fact matches.
+    else:
+        cost = len(goal.pred.matchingAlts(args)) * ruleCost
+    for position, arg in enumerate(args):
+        if isinstance(arg, Var) and arg in known and analysis.index[position]:
+            cost /= len(analysis.index[position])
+    return cost
+
+
+# Returns the goals in the order they should be run, and a list describing each of them in that order.
+def planGoals(goals):
+    ordered = []
+    steps = []
+    segment = []
+    for goal in goals + [None]:
+        goal = deref(goal)
+        if isinstance(goal, Goal) and isPure(goal.pred):
+            segment.append(goal)
+            continue
+        planSegment(segment, ordered, steps)
+        segment = []
+        if goal is not None:
+            ordered.append(goal)
+            steps.append({"goal": termText(goal), "cost": None, "barrier": True})
+    positions = {id(deref(goal)): i for i, goal in enumerate(goals)}
+    for step, goal in zip(steps, ordered):
+        step["position"] = positions[id(goal)]      # Where the goal was written.
+    return ordered, steps
+
+
+# Orders the pure goals between two barriers, adding them to ordered and steps.
+def planSegment(segment, ordered, steps):
+    grounded = set()    # Vars that will be bound by atoms or numbers.
+    known = set()       # Vars that are guessed to be bound.
+    placed = [False] * len(segment)
+    def ready(i):
+        goal = segment[i]
+        if goal.pred in boundGoals or any(isinstance(deref(arg), Math) for arg in goal.args):
+            return all(var in grounded for var in freeVars(goal)) or all(placed[:i])
+        if goal.pred.analyze(len(goal.args)).facts is None and len(goal.args) in goal.pred.alternatives:
+            return all(placed[j] for j in range(i) if isRule(segment[j]))
+        return True
+    for _ in segment:
+        best = None
+        for i, goal in enumerate(segment):
+            if not placed[i] and ready(i):
+                cost = goalCost(goal, known)
+                if best is None or cost < best[0]:
+                    best = (cost, i)
+        cost, i = best
+        placed[i] = True
+        goal = segment[i]
+        ordered.append(goal)
+        steps.append({"goal": termText(goal), "cost": cost, "barrier": False})
+        if goal.pred not in boundGoals:
+            if goal.pred.analyze(len(goal.args)).facts is not None:
+                grounded.update(freeVars(goal))
+            known.update(freeVars(goal))
+
+
+def isRule(goal):
+    return goal.pred not in boundGoals and len(goal.args) in goal.pred.alternatives \
+        and goal.pred.analyze(len(goal.args)).facts is None
+
+
+# Shows how a query's goals would be run with query(reorder = True).
+# Each step has the goal, the position it was written at, its guessed number of solutions (cost),
+# and whether it is a barrier that nothing is moved past.
+def explain(goals):
+    memo = {}
+    return planGoals([create(goal, memo) for goal in goals])[1]
+
+
+# Writes a term the way it would be written in Prolog, e.g. parent(X, 'bob') or [1, 2|T].
+def termText(term):
+    if isinstance(term, list):
+        return "[" + ", ".join(termText(item) for item in term) + "]"   # The vars of a format_ goal.
+    if isinstance(term, str):
+        return repr(term)       # The string of a format_ goal.
+    term = deref(term)
+    if isinstance(term, Var):
+        return term.name
+    if isinstance(term, Goal):
+        return term.name + "(" + ", ".join(termText(arg) for arg in term.args) + ")"
+    if isinstance(term, ListPL):
+        items = listTerms(term)
+        tail = term
+        while isinstance(tail, ListPL):
+            tail = deref(tail.tail)
+        text = ", ".join(termText(item) for item in items)
+        if isinstance(tail, Var):
+            text += "|" + termText(tail)
+        return "[" + text + "]"
+    if isinstance(term, Math):
+        return " ".join(termText(item) if isinstance(item, Term) else item for item in term.mathList)
+    if isinstance(term.value, str):
+        return repr(term.value)
+    return str(term.value)
+
+
+
+# #### Bottom-up Evaluation ####
+
+# A DatalogProgram works out every fact of a predicate at once, starting from the facts it is made from and
+# using its rules until no new facts are found. Each round only uses rules on facts that are new since the
+# round before (semi-naive evaluation), so no fact is worked out more than once from the same facts.
+# The facts are kept as a ClauseAnalysis of fact alts, so queries look them up with its indexes, like facts
+# that were added with >>. With pred.bottomUp(), they are worked out again the next time they are needed
+# after any alts are added. With pred.materialize(), only the facts that depend on facts that were added
+# or retracted are worked out again, unless the rules themselves changed.
+# Each fact is only kept once, so an answer that the alts would find in more than one way is only given once.
+# The predicate and every rule it calls must be Datalog: their args may only be Vars, atoms and numbers,
+# every Var in the head of a rule must be in a goal of its body, and the body may only call other
+# predicates, equals, lt, le, gt, ge and notEqual.
+
+
+# The goals that are tested in Python instead of being looked up, and how.
+datalogTests = {lt: lambda a, b: a < b, le: lambda a, b: a <= b, gt: lambda a, b: a > b,
+    ge: lambda a, b: a >= b, notEqual: lambda a, b: a != b}
+
+
+class DatalogProgram():
+    def __init__(self, pred, incremental = False):
+        self.pred = pred
+        self.incremental = incremental
+        self.lock = threading.Lock()
+        self.changes = None     # The value of Predicate.changes when the facts were worked out.
+        self.views = {}         # The ViewAnalysis of the facts of each (pred, arity).
+        self.ruleTable = None   # The rules that the facts were worked out with.
+        self.relations = {}     # The Relation of every (pred, arity) in the program, including fact tables.
+        self.versions = {}      # The version of each predicate in the program when its facts were worked out.
+        self.rules()            # Check that the program is Datalog now, instead of when it is first used.
+    def analyze(self, pred, arity):
+        with self.lock:
+            if self.changes != Predicate.changes:
+                changes = Predicate.changes
+                changed = self.update()
+                for key in self.ruleTable:
+                    view = self.views.get(key)
+                    if view is None or view.relation is not self.relations[key]:
+                        self.views[key] = ViewAnalysis(key, self.relations[key], self.lock, changes)
+                    elif key in changed:
+                        view.update(changes)
+                self.changes = changes
+        return self.views.get((pred, arity)) or ClauseAnalysis([], self.changes)
+    # Brings the facts up to date, returning the (pred, arity)s whose facts changed.
+    def update(self):
+        if not self.incremental or self.ruleTable is None or self.rulesChanged():
+            return self.evaluate()
+        return self.maintain()
+    def rulesChanged(self):
+        for pred, arity in self.ruleTable:
+            if pred.version != self.versions[pred]:
+                return True
+        for pred, arity in self.relations:
+            if (pred, arity) not in self.ruleTable and pred.version != self.versions[pred] \
+                    and pred.alternatives.get(arity) and (pred.program is not None or pred.analyze(arity).facts is None):
+                return True     # Rules were added to a fact table.
+        return False
+    # Returns the rules of every predicate that the program works out the facts of, keyed by (pred, arity).
+    # Each rule is (head, body), where head is a list of args and body is a list of (pred, args) literals.
+    # Args are ("var", name) or ("const", value).
+    def rules(self):
+        rules = {}
+        toVisit = [(self.pred, arity) for arity in self.pred.alternatives]
+        while toVisit:
+            key = toVisit.pop()
+            pred, arity = key
+            if key in rules:
+                continue
+            if pred is not self.pred and pred.program is None \
+                    and (not pred.alternatives.get(arity) or pred.analyze(arity).facts is not None):
+                continue        # A fact table is used as it is.
+            rules[key] = []
+            for alt in list(pred.alternatives.get(arity, [])):
+                anonymous = itertools.count()
+                head = [self.datalogArg(arg, alt, anonymous) for arg in alt.args]
+                body = []
+                for goal in alt.goals:
+                    if not isinstance(goal, Goal):
+                        raise ValueError(self.error(alt, "a goal must be a predicate"))
+                    if goal.pred in impureGoals or goal.pred in containerGoals or goal.pred in listGoals \
+                            or len(goal.args) in goal.pred.sharded or len(goal.args) in goal.pred.mapped:
+                        raise ValueError(self.error(alt, goal.name + " can't be used"))
+                    args = [self.datalogArg(arg, alt, anonymous) for arg in goal.args]
+                    if goal.pred not in datalogTests and goal.pred is not equals:
+                        toVisit.append((goal.pred, len(args)))
+                    body.append((goal.pred, args))
+                bodyVars = {arg[1] for goalPred, args in body if goalPred not in datalogTests for arg in args}
+                for arg in head + [arg for goalPred, args in body if goalPred in datalogTests for arg in args]:
+                    if arg[0] == "var" and arg[1] not in bodyVars:
+                        raise ValueError(self.error(alt, "the Var " + arg[1] + " isn't bound by a goal"))
+                rules[key].append((head, body))
+        return rules
+    def datalogArg(self, arg, alt, anonymous):
+        kind = AltCompiler.kind(arg)
+        if kind == "var":
+            return ("var", arg)
+        if kind == "anon":
+            return ("var", arg + "#" + str(next(anonymous)))     # Every _ is a different Var.
+        if kind == "const" and not isinstance(arg, list):
+            return ("const", headKey(arg))
+        raise ValueError(self.error(alt, "args must be Vars, atoms or numbers"))
+    def error(self, alt, reason):
+        return self.pred.name + " can't be evaluated bottom-up, since in an alt of " + alt.pred.name + ", " + reason + "."
+    # The rows of a fact table.
+    @staticmethod
+    def baseRows(key):
+        pred, arity = key
+        if not pred.alternatives.get(arity):
+            return []
+        return pred.analyze(arity).facts
+    # The (pred, arity)s of the fact tables that the rules use.
+    def factTables(self):
+        return {(goalPred, len(args)) for rules in self.ruleTable.values() for head, body in rules
+            for goalPred, args in body if goalPred not in datalogTests and goalPred is not equals
+            and (goalPred, len(args)) not in self.ruleTable}
+    # Works out every fact from the start.
+    def evaluate(self):
+        self.ruleTable = self.rules()
+        self.views = {}
+        self.relations = {key: Relation() for key in self.ruleTable}
+        inserted = {}
+        for key in self.factTables():
+            self.relations[key] = Relation(self.baseRows(key))
+            inserted[key] = list(self.relations[key])
+        self.versions = {pred: pred.version for pred, arity in self.relations}
+        # Rules that don't use any facts, like facts with Vars only used by equals, are used once at the start.
+        for key, rules in self.ruleTable.items():
+            for head, body in rules:
+                if all(goalPred in datalogTests or goalPred is equals for goalPred, args in body):
+                    for row in self.fire(head, body, None, None):
+                        if self.relations[key].add(row):
+                            inserted.setdefault(key, []).append(row)
+        self.propagate(inserted)
+        return set(self.relations)
+    # Updates the facts for the facts that were added to and removed from the fact tables, without working
+    # them all out again. Removed facts are handled by delete and rederive (DRed): every fact that was worked
+    # out from them is removed, and the ones that can still be worked out from the facts left are put back.
+    def maintain(self):
+        changed = set()
+        deleted = {}
+        inserted = {}
+        for key in self.factTables():
+            if key[0].version == self.versions[key[0]]:
+                continue
+            rows = dict.fromkeys(self.baseRows(key))
+            deleted[key] = [row for row in self.relations[key] if row not in rows]
+            inserted[key] = [row for row in rows if row not in self.relations[key]]
+        self.versions = {pred: pred.version for pred, arity in self.relations}
+        if any(deleted.values()):
+            changed |= self.delete(deleted)
+        for key, rows in inserted.items():
+            inserted[key] = [row for row in rows if self.relations[key].add(row)]
+        changed |= self.propagate(inserted)
+        return changed
+    # Uses the rules on new facts until no more new facts are found, using semi-naive rounds.
+    # inserted holds the new facts of each (pred, arity), which must already be in its Relation.
+    def propagate(self, inserted):
+        changed = {key for key, rows in inserted.items() if rows}
+        delta = {key: Relation(rows) for key, rows in inserted.items() if rows}
+        while delta:
+            newDelta = {}
+            for key, rows in self.derive(delta):
+                for row in rows:
+                    if row not in self.relations[key]:
+                        newDelta.setdefault(key, Relation()).add(row)
+            for key, rows in newDelta.items():
+                for row in rows:
+                    self.relations[key].add(row)
+            changed |= set(newDelta)
+            delta = newDelta
+        return changed
+    # Removes deleted facts, and every fact that was worked out from them, then puts back the ones that
+    # can still be worked out.
+    def delete(self, deleted):
+        removed = {key: Relation(rows) for key, rows in deleted.items() if rows}
+        delta = dict(removed)
+        while delta:
+            newDelta = {}
+            for key, rows in self.derive(delta):
+                for row in rows:
+                    if row in self.relations[key] and row not in removed.setdefault(key, Relation()):
+                        removed[key].add(row)
+                        newDelta.setdefault(key, Relation()).add(row)
+            delta = newDelta
+        for key, rows in removed.items():
+            for row in rows:
+                self.relations[key].remove(row)
+        rederived = {}
+        for key, rows in removed.items():
+            for row in rows:
+                if key in self.ruleTable and any(next(self.fire(head, body, None, None, row), None) is not None
+                        for head, body in self.ruleTable[key]):
+                    self.relations[key].add(row)
+                    rederived.setdefault(key, []).append(row)
+        return set(removed) | self.propagate(rederived)
+    # Yields (key, rows) for the facts that the rules work out when one of their goals uses delta.
+    def derive(self, delta):
+        for key, rules in self.ruleTable.items():
+            for head, body in rules:
+                for i, (goalPred, args) in enumerate(body):
+                    if (goalPred, len(args)) in delta:
+                        yield key, list(self.fire(head, body, delta, i))
+    # Yields the head rows of a rule for every solution of its body.
+    # The deltaGoal'th goal of the body uses the facts in delta instead of all the facts.
+    # If target is given, only solutions with that head row are found.
+    def fire(self, head, body, delta, deltaGoal, target = None):
+        relations = self.relations
+        def solve(i, binding):
+            if i == len(body):
+                yield tuple(binding[arg[1]] if arg[0] == "var" else arg[1] for arg in head)
+                return
+            goalPred, args = body[i]
+            values = [binding.get(arg[1]) if arg[0] == "var" else arg[1] for arg in args]
+            if goalPred in datalogTests:
+                if datalogTests[goalPred](values[0], values[1]):
+                    yield from solve(i + 1, binding)
+                return
+            if goalPred is equals:
+                if values[0] is None and values[1] is None:
+                    raise ValueError(self.pred.name + " can't be evaluated bottom-up, since equals has two unbound Vars.")
+                if values[0] is None or values[1] is None or values[0] == values[1]:
+                    value = values[1] if values[0] is None else values[0]
+                    yield from solve(i + 1, dict(binding, **{arg[1]: value for arg in args if arg[0] == "var"}))
+                return
+            relation = (delta if i == deltaGoal else relations)[(goalPred, len(args))]
+            positions = tuple(position for position, value in enumerate(values) if value is not None)
+            for row in relation.lookup(positions, tuple(values[position] for position in positions)):
+                newBinding = dict(binding)
+                for position, arg in enumerate(args):
+                    if values[position] is None:
+                        if newBinding.setdefault(arg[1], row[position]) != row[position]:
+                            break   # A Var that is in the goal twice has two different values.
+                else:
+                    yield from solve(i + 1, newBinding)
+        binding = {}
+        if target is not None:
+            for arg, value in zip(head, target):
+                if arg[0] == "const" and arg[1] != value:
+                    return
+                if arg[0] == "var" and binding.setdefault(arg[1], value) != value:
+                    return
+        # The goal that uses delta goes first, since it has the fewest facts.
+        # The tests are done once the goals before them have bound their Vars.
+        order = [goal for goal in body if goal[0] not in datalogTests]
+        if deltaGoal is not None:
+            order.remove(body[deltaGoal])
+            order.insert(0, body[deltaGoal])
+        for test in [goal for goal in body if goal[0] in datalogTests]:
+            names = {arg[1] for arg in test[1] if arg[0] == "var"} - set(binding)
+            position = 0
+            while not names <= {arg[1] for goal in order[:position] for arg in goal[1] if arg[0] == "var"}:
+                position += 1
+            order.insert(position, test)
+        if deltaGoal is not None:
+            deltaGoal = order.index(body[deltaGoal])
+        body = order
+        yield from solve(0, binding)
+
+
+# A Relation holds the rows of a predicate's facts in order, with hash indexes that are kept up to date.
+# Once it is shared with queries, the lists in its indexes are replaced instead of changed, so a query
+# that is part way through one isn't affected by facts being added or removed.
+class Relation():
+    def __init__(self, rows = ()):
+        self.rows = {}
+        self.indexes = {}   # Dicts from the values of the rows at some positions to the rows, keyed by the positions.
+        self.shared = False
+        for row in rows:
+            self.add(row)
+    def __iter__(self):
+        return iter(list(self.rows))
+    def __len__(self):
+        return len(self.rows)
+    def __contains__(self, row):
+        return row in self.rows
+    # Adds a row, returning False if it was already there.
+    def add(self, row):
+        if row in self.rows:
+            return False
+        self.rows[row] = None
+        for positions, index in self.indexes.items():
+            key = tuple(row[position] for position in positions)
+            rows = index.get(key)
+            if rows is None:
+                index[key] = [row]
+            elif self.shared:
+                index[key] = rows + [row]
+            else:
+                rows.append(row)
+        return True
+    def remove(self, row):
+        del self.rows[row]
+        for positions, index in self.indexes.items():
+            key = tuple(row[position] for position in positions)
+            if len(index[key]) == 1:
+                del index[key]
+            elif self.shared:
+                index[key] = [other for other in index[key] if other != row]
+            else:
+                index[key].remove(row)
+    # Returns a dict from the values of the rows at positions to the rows with those values.
+    def index(self, positions):
+        index = self.indexes.get(positions)
+        if index is None:
+            index = {}
+            for row in self.rows:
+                index.setdefault(tuple(row[position] for position in positions), []).append(row)
+            self.indexes[positions] = index
+        return index
+    # Returns the rows with these values at positions.
+    def lookup(self, positions, key):
+        return self.index(positions).get(key, ())
+
+
+# A ViewAnalysis is the ClauseAnalysis of the facts that a DatalogProgram worked out. It reads them from
+# the program's Relation, so the facts don't have to be made into a new ClauseAnalysis every time they change.
+# Alts are only made for the rows that queries look up.
+class ViewAnalysis(ClauseAnalysis):
+    def __init__(self, key, relation, lock, version):
+        self.pred, arity = key
+        self.relation = relation
+        self.lock = lock            # The program's lock, which is held while its Relations change.
+        self.version = version
+        self.altOfRow = {}          # The fact alt made for each row.
+        self.cachedAlts = None
+        self.modes = ["+"] * arity
+        self.exclusive = []
+        self.indexed = list(range(arity))
+        self.itemIndexed = []       # Facts only have atoms and numbers.
+        self.facts = relation
+        relation.shared = True
+    # Called by the program after it changed the facts.
+    def update(self, version):
+        self.version = version
+        self.cachedAlts = None
+        if len(self.altOfRow) > 2 * len(self.relation):
+            self.altOfRow = {row: alt for row, alt in self.altOfRow.items() if row in self.relation}
+    def alt(self, row):
+        alt = self.altOfRow.get(row)
+        if alt is None:
+            alt = self.altOfRow[row] = Alt(self.pred, [rawArg(value) for value in row], [])
+        return alt
+    @property
+    def alts(self):
+        with self.lock:
+            if self.cachedAlts is None:
+                self.cachedAlts = tuple(self.alt(row) for row in self.relation)
+            return self.cachedAlts
+    @property
+    def determinism(self):
+        return "det" if len(self.relation) <= 1 else "nondet"
+    @property
+    def index(self):
+        with self.lock:
+            return [self.relation.index((position,)) for position in self.indexed]
+    def lookup(self, position, key):
+        with self.lock:
+            return [self.alt(row) for row in self.relation.lookup((position,), (key,))]
+    def factIndex(self, positions):
+        with self.lock:
+            return self.relation.index(positions)
+
+
+# Turns the value of an atom or number back into an arg that create makes it from.
+def rawArg(value):
+    if isinstance(value, str):
+        return "'" + value + "'"
+    return value
+
+
+
+# #### Hash Sets and Maps ####
+
+# SetPL and MapPL are terms that hold a HashTrie, so a member can be added, found or removed in O(log n) time.
+# Adding or removing makes a new term that shares almost all of its HashTrie with the old one, and the old one
+# doesn't change, so nothing has to be undone when backtracking.
+# Set members and map keys must be bound. They are found by the same rules as unification, so 1 and 1.0 are
+# the same key. Two sets unify if they have the same members, and two maps unify if they have the same keys
+# and their values unify. Python sets and dicts in goals are made into SetPLs and MapPLs by create.
+
+missing = object()      # Returned by HashTrie.get for a key that isn't there.
+trieBits = 5            # Each level of a HashTrie uses this many bits of the hash.
+trieMask = (1 << trieBits) - 1
+
+
+def bitCount(number):
+    return bin(number).count("1")
+
+
+# A node of a HashTrie. Bit i of bitmap is set if the node has an entry for hash bits i, and entries
+# holds those entries in order. An entry is a TrieNode, a TrieCollision, or a (hash, key, value) tuple.
+class TrieNode():
+    __slots__ = ("bitmap", "entries")
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+# The keys whose hashes are all the same.
+class TrieCollision():
+    __slots__ = ("hash", "pairs")
+    def __init__(self, hash, pairs):
+        self.hash = hash
+        self.pairs = pairs
+
+
+# A persistent hash map (a hash array mapped trie). put and remove return a new HashTrie, and only copy
+# the nodes on the path to the key.
+class HashTrie():
+    __slots__ = ("root", "size")
+    def __init__(self, root = None, size = 0):
+        self.root = root or TrieNode(0, ())
+        self.size = size
+    def __len__(self):
+        return self.size
+    def __contains__(self, key):
+        return self.get(key, missing) is not missing
+    # Yields each (key, value) pair.
+    def __iter__(self):
+        stack = [self.root]
+        while stack:
+            for entry in stack.pop().entries:
+                if isinstance(entry, TrieNode):
+                    stack.append(entry)
+                elif isinstance(entry, TrieCollision):
+                    yield from entry.pairs
+                else:
+                    yield entry[1], entry[2]
+    def get(self, key, default = None):
+        hash = trieHash(key)
+        node = self.root
+        shift = 0
+        while True:
+            bit = 1 << ((hash >> shift) & trieMask)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[bitCount(node.bitmap & (bit - 1))]
+            if isinstance(entry, TrieNode):
+                node = entry
+                shift += trieBits
+            elif isinstance(entry, TrieCollision):
+                for pairKey, value in entry.pairs:
+                    if pairKey == key:
+                        return value
+                return default
+            elif entry[0] == hash and entry[1] == key:
+                return entry[2]
+            else:
+                return default
+    def put(self, key, value):
+        root, added = triePut(self.root, 0, trieHash(key), key, value)
+        return HashTrie(root, self.size + added)
+    # Returns a HashTrie without key, or this one if it doesn't have key.
+    def remove(self, key):
+        root, removed = trieRemove(self.root, 0, trieHash(key), key)
+        if not removed:
+            return self
+        return HashTrie(root, self.size - 1)
+
+
+def trieHash(key):
+    return hash(key) & 0xFFFFFFFFFFFFFFFF     # Negative hashes are made positive, so each level's bits are used.
+
+
+# Returns a copy of node with its index'th entry replaced by entry.
+def trieReplace(node, index, entry):
+    return TrieNode(node.bitmap, node.entries[:index] + (entry,) + node.entries[index + 1:])
+
+
+# Returns a node holding two entries whose hashes differ, from the bits at shift on.
+def trieMerge(first, firstHash, second, secondHash, shift):
+    firstBits = (firstHash >> shift) & trieMask
+    secondBits = (secondHash >> shift) & trieMask
+    if firstBits == secondBits:
+        return TrieNode(1 << firstBits, (trieMerge(first, firstHash, second, secondHash, shift + trieBits),))
+    entries = (first, second) if firstBits < secondBits else (second, first)
+    return TrieNode((1 << firstBits) | (1 << secondBits), entries)
+
+
+# Returns the new node, and 1 if the key was added or 0 if its value was replaced.
+def triePut(node, shift, hash, key, value):
+    bit = 1 << ((hash >> shift) & trieMask)
+    index = bitCount(node.bitmap & (bit - 1))
+    leaf = (hash, key, value)
+    if not node.bitmap & bit:
+        return TrieNode(node.bitmap | bit, node.entries[:index] + (leaf,) + node.entries[index:]), 1
+    entry = node.entries[index]
+    if isinstance(entry, TrieNode):
+        child, added = triePut(entry, shift + trieBits, hash, key, value)
+        return trieReplace(node, index, child), added
+    if isinstance(entry, TrieCollision):
+        if entry.hash != hash:
+            return trieReplace(node, index, trieMerge(entry, entry.hash, leaf, hash, shift + trieBits)), 1
+        pairs = tuple(pair for pair in entry.pairs if pair[0] != key)
+        added = int(len(pairs) == len(entry.pairs))
+        return trieReplace(node, index, TrieCollision(hash, pairs + ((key, value),))), added
+    if entry[0] == hash and entry[1] == key:
+        return trieReplace(node, index, leaf), 0
+    if entry[0] == hash:
+        return trieReplace(node, index, TrieCollision(hash, ((entry[1], entry[2]), (key, value)))), 1
+    return trieReplace(node, index, trieMerge(entry, entry[0], leaf, hash, shift + trieBits)), 1
+
+
+# Returns the new node, or None if it has no entries left, and whether the key was removed.
+def trieRemove(node, shift, hash, key):
+    bit = 1 << ((hash >> shift) & trieMask)
+    if not node.bitmap & bit:
+        return node, False
+    index = bitCount(node.bitmap & (bit - 1))
+    entry = node.entries[index]
+    if isinstance(entry, TrieNode):
+        child, removed = trieRemove(entry, shift + trieBits, hash, key)
+        if not removed:
+            return node, False
+        if child is not None and len(child.entries) == 1 and not isinstance(child.entries[0], TrieNode):
+            child = child.entries[0]    # A node with one leaf is replaced by the leaf.
+    elif isinstance(entry, TrieCollision):
+        if entry.hash != hash:
+            return node, False
+        pairs = tuple(pair for pair in entry.pairs if pair[0] != key)
+        if len(pairs) == len(entry.pairs):
+            return node, False
+        child = TrieCollision(hash, pairs) if len(pairs) > 1 else (hash, pairs[0][0], pairs[0][1])
+    elif entry[0] == hash and entry[1] == key:
+        child = None
+    else:
+        return node, False
+    if child is not None:
+        return trieReplace(node, index, child), True
+    if node.bitmap == bit and shift > 0:
+        return None, True
+    return TrieNode(node.bitmap & ~bit, node.entries[:index] + node.entries[index + 1:]), True
+
+
+# Returns a hashable key for a term, which is equal to another term's key if the terms unify.
+def termKey(term):
+    term = deref(term)
+    if isinstance(term, Var):
+        raise ValueError("Set members and map keys must be bound, but '" + term.name + "' isn't.")
+    if isinstance(term, ListPL):
+        keys = []
+        while isinstance(term, ListPL):
+            keys.append(termKey(term.head))
+            term = deref(term.tail)
+        return (listKey, tuple(keys), termKey(term))
+    if isinstance(term, Goal):
+        return (term.pred, tuple(termKey(arg) for arg in term.args))
+    if isinstance(term, SetPL):
+        return ("{}", frozenset(key for key, member in term.trie))
+    if isinstance(term, MapPL):
+        return ("{:}", frozenset((key, termKey(value)) for key, (keyTerm, value) in term.trie))
+    if isinstance(term.value, list):
+        return emptyListKey
+    return term.value
+
+
+# Returns a copy of a term with its bound variables replaced by their values, so that the copy stays the
+# same when those bindings are undone.
+def resolveTerm(term):
+    term = deref(term)
+    if isinstance(term, ListPL):
+        items = []
+        while isinstance(term, ListPL):
+            items.append(resolveTerm(term.head))
+            term = deref(term.tail)
+        return makeList(items, term)
+    if isinstance(term, Goal):
+        return Goal(term.pred, [resolveTerm(arg) for arg in term.args])
+    if isinstance(term, Math) and not isinstance(term, NativeMath):
+        math = Math()
+        math.mathList = [resolveTerm(item) if isinstance(item, Term) else item for item in term.mathList]
+        return math
+    if isinstance(term, MapPL):
+        return MapPL.fromPairs([(keyTerm, resolveTerm(value)) for key, (keyTerm, value) in term.trie])
+    if isinstance(term, list):
+        return [resolveTerm(item) for item in term]     # The terms that format_ fills in.
+    return term
+
+
+# A set of terms. Its HashTrie maps the key of each member to the member.
+class SetPL(Term):
+    def __init__(self, trie = None):
+        self.name = "Set"
+        self.trie = trie or HashTrie()
+    @staticmethod
+    def fromTerms(terms):
+        trie = HashTrie()
+        for term in terms:
+            trie = trie.put(termKey(term), resolveTerm(term))
+        return SetPL(trie)
+    @property
+    def value(self):
+        return self
+    def __len__(self):
+        return len(self.trie)
+    def __str__(self):
+        return "{" + ", ".join(sorted(repr(flatten(deref(member).value)) for key, member in self.trie)) + "}"
+    def __repr__(self):
+        return str(self)
+
+
+# A map from terms to terms. Its HashTrie maps the key of each key term to (key term, value).
+class MapPL(Term):
+    def __init__(self, trie = None):
+        self.name = "Map"
+        self.trie = trie or HashTrie()
+    @staticmethod
+    def fromPairs(pairs):
+        trie = HashTrie()
+        for keyTerm, value in pairs:
+            trie = trie.put(termKey(keyTerm), (resolveTerm(keyTerm), resolveTerm(value)))
+        return MapPL(trie)
+    @property
+    def value(self):
+        return self
+    def __len__(self):
+        return len(self.trie)
+    def __str__(self):
+        return "{" + ", ".join(sorted(repr(flatten(deref(keyTerm).value)) + ": " + repr(flatten(deref(value).value))
+            for key, (keyTerm, value) in self.trie)) + "}"
+    def __repr__(self):
+        return str(self)
+
+
+# set_new/1: set_new("S") makes S an empty set.
+set_new = Predicate("set_new")
+
+# set_add/3: set_add("S", "X", "S1") makes S1 the set S with X added.
+set_add = Predicate("set_add")
+
+# set_member/2: set_member("X", "S") succeeds if X is in S. If X isn't bound, it is each member in turn.
+set_member = Predicate("set_member")
+
+# set_remove/3: set_remove("S", "X", "S1") makes S1 the set S without X. It fails if X isn't in S.
+set_remove = Predicate("set_remove")
+
+# set_size/2: set_size("S", "N") makes N the number of members of S.
+set_size = Predicate("set_size")
+
+# map_new/1: map_new("M") makes M an empty map.
+map_new = Predicate("map_new")
+
+# map_put/4: map_put("M", "K", "V", "M1") makes M1 the map M with K mapped to V.
+map_put = Predicate("map_put")
+
+# map_get/3: map_get("M", "K", "V") unifies V with the value of K in M. If K isn't bound, it is each key in turn.
+map_get = Predicate("map_get")
+
+# map_remove/3: map_remove("M", "K", "M1") makes M1 the map M without K. It fails if K isn't in M.
+map_remove = Predicate("map_remove")
+
+# map_size/2: map_size("M", "N") makes N the number of keys in M.
+map_size = Predicate("map_size")
+
+
+# Returns the set or map that a goal was given, or None if it was given something else.
+def containerArg(goal, term, kind):
+    term = deref(term)
+    if isinstance(term, Var):
+        raise ValueError(goal.name + " needs a bound " + kind.__name__ + ", but '" + term.name + "' isn't bound.")
+    return term if isinstance(term, kind) else None
+
+
+# Yields once for each time the terms unify, undoing the bindings afterwards.
+def unifyEach(pairs, state):
+    for first, second in pairs:
+        mark = len(state.trail)
+        if unify(first, second, state):
+            yield True
+        state.undo(mark)
+
+
+def setNew(goal, state):
+    yield from unifyEach([(goal.args[0], SetPL())], state)
+
+def setAdd(goal, state):
+    container = containerArg(goal, goal.args[0], SetPL)
+    if container is not None:
+        key = termKey(goal.args[1])
+        if key in container.trie:
+            yield from unifyEach([(goal.args[2], container)], state)    # It's already a member.
+        else:
+            yield from unifyEach([(goal.args[2], SetPL(container.trie.put(key, resolveTerm(goal.args[1]))))], state)
+
+def setMember(goal, state):
+    container = containerArg(goal, goal.args[1], SetPL)
+    if container is None:
+        return
+    if freeVars(goal.args[0]):
+        yield from unifyEach(((goal.args[0], member) for key, member in container.trie), state)
+    elif termKey(goal.args[0]) in container.trie:
+        yield True
+
+def setRemove(goal, state):
+    container = containerArg(goal, goal.args[0], SetPL)
+    if container is not None:
+        trie = container.trie.remove(termKey(goal.args[1]))
+        if trie is not container.trie:
+            yield from unifyEach([(goal.args[2], SetPL(trie))], state)
+
+def mapNew(goal, state):
+    yield from unifyEach([(goal.args[0], MapPL())], state)
+
+def mapPut(goal, state):
+    container = containerArg(goal, goal.args[0], MapPL)
+    if container is not None:
+        trie = container.trie.put(termKey(goal.args[1]), (resolveTerm(goal.args[1]), resolveTerm(goal.args[2])))
+        yield from unifyEach([(goal.args[3], MapPL(trie))], state)
+
+def mapGet(goal, state):
+    container = containerArg(goal, goal.args[0], MapPL)
+    if container is None:
+        return
+    if freeVars(goal.args[1]):
+        pairs = ((ListPL([goal.args[1], goal.args[2]]), ListPL([keyTerm, value])) for key, (keyTerm, value) in container.trie)
+        yield from unifyEach(pairs, state)
+    else:
+        pair = container.trie.get(termKey(goal.args[1]), missing)
+        if pair is not missing:
+            yield from unifyEach([(goal.args[2], pair[1])], state)
+
+def mapRemove(goal, state):
+    container = containerArg(goal, goal.args[0], MapPL)
+    if container is not None:
+        trie = container.trie.remove(termKey(goal.args[1]))
+        if trie is not container.trie:
+            yield from unifyEach([(goal.args[2], MapPL(trie))], state)
+
+def containerSize(kind):
+    def size(goal, state):
+        container = containerArg(goal, goal.args[0], kind)
+        if container is not None:
+            yield from unifyEach([(goal.args[1], internConst(len(container.trie)))], state)
+    return size
+
+
+# Each set and map built-in takes the goal and the query state, and yields once for each solution.
+containerGoals = {
+    set_new: setNew,
+    set_add: setAdd,
+    set_member: setMember,
+    set_remove: setRemove,
+    set_size: containerSize(SetPL),
+    map_new: mapNew,
+    map_put: mapPut,
+    map_get: mapGet,
+    map_remove: mapRemove,
+    map_size: containerSize(MapPL),
+}
+boundGoals.update(dict.fromkeys(containerGoals, 1))
+
+
+
+# #### Sharded Fact Tables ####
+
+# pred.shard() moves a predicate's facts into worker processes, so no one process has to hold all of them.
+# Each fact goes to the worker chosen by the hash of its arg at the sharded position, and each worker keeps its
+# facts in a Relation. A goal with that arg bound is looked up in one worker. Other goals are looked up in
+# every worker at once, and their answers are given one worker after another.
+# Answers come back shardBatch rows at a time, so a goal that is cut early doesn't wait for all of them.
+# Like bottom-up evaluation, each fact is only kept once, and answers aren't in the order the facts were added.
+
+shardBatch = 1000       # How many rows a worker sends back at a time.
+
+
+# Runs in a worker process. Messages are tuples of a request and its args, and each one is answered.
+def shardWorker(connection):
+    relation = Relation()
+    cursors = {}        # The rows still to be sent for each lookup, by its number.
+    while True:
+        message = connection.recv()
+        request = message[0]
+        try:
+            if request == "stop":
+                connection.send(None)
+                break
+            if request == "add":
+                reply = sum(relation.add(row) for row in message[1])
+            elif request == "remove":
+                reply = message[1] in relation
+                if reply:
+                    relation.remove(message[1])
+            elif request == "lookup":
+                number, positions, key = message[1:]
+                rows = list(relation) if not positions else list(relation.lookup(positions, key))
+                cursors[number] = (rows, 0)
+                reply = shardNext(cursors, number)
+            elif request == "next":
+                reply = shardNext(cursors, message[1])
+            elif request == "close":
+                reply = cursors.pop(message[1], None) is not None
+        except Exception as err:
+            reply = err
+        connection.send(reply)
+    connection.close()
+
+
+# Returns the next batch of a lookup's rows, and whether they are the last ones.
+def shardNext(cursors, number):
+    rows, start = cursors[number]
+    batch = rows[start:start + shardBatch]
+    done = start + shardBatch >= len(rows)
+    if done:
+        del cursors[number]
+    else:
+        cursors[number] = (rows, start + shardBatch)
+    return batch, done
+
+
+# Returns the row of values of a fact that is being added to or retracted from a sharded predicate.
+def shardRow(head, goals):
+    row = tuple(headKey(arg) for arg in head.args)
+    if goals or any(value is None or isinstance(value, tuple) for value in row):
+        raise ValueError(head.name + "/" + str(len(head.args)) + " is sharded, so it can only have facts whose "
+            "args are atoms and numbers.")
+    return row
+
+
+# The worker processes that hold the facts of one arity of a sharded predicate.
+class ShardedFacts():
+    lookups = itertools.count()     # Numbers each lookup, so a worker can send its rows a batch at a time.
+    def __init__(self, position, workers, rows):
+        self.position = position
+        self.connections = []
+        self.locks = []             # Only one thread at a time may send a message to a worker and wait for its answer.
+        self.processes = []
+        for _ in range(workers):
+            connection, workerConnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target = shardWorker, args = (workerConnection,), daemon = True)
+            process.start()
+            workerConnection.close()
+            self.connections.append(connection)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        shards = [[] for _ in range(workers)]
+        for row in rows:
+            shards[self.shardOf(row[position])].append(row)
+        self.requestAll(range(workers), [("add", shard) for shard in shards])
+    def shardOf(self, value):
+        return hash(value) % len(self.connections)
+    # Sends each worker its message, and then waits for all of their answers, so the workers run at once.
+    # Locks are always taken in the order of the workers, so two threads can't wait for each other.
+    def requestAll(self, numbers, messages):
+        numbers = list(numbers)
+        for number, message in zip(numbers, messages):
+            self.locks[number].acquire()
+            self.connections[number].send(message)
+        replies = []
+        try:
+            for number in numbers:
+                replies.append(self.connections[number].recv())
+        finally:
+            for number in numbers:
+                self.locks[number].release()
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+    def add(self, row):
+        self.requestAll([self.shardOf(row[self.position])], [("add", [row])])
+    # Returns whether the row was there.
+    def remove(self, row):
+        return self.requestAll([self.shardOf(row[self.position])], [("remove", row)])[0]
+    # Yields the rows with these values at positions.
+    def lookup(self, positions, key):
+        if self.position in positions:
+            numbers = [self.shardOf(key[positions.index(self.position)])]
+        else:
+            numbers = range(len(self.connections))
+        lookup = next(ShardedFacts.lookups)
+        batches = dict(zip(numbers, self.requestAll(numbers, [("lookup", lookup, positions, key)] * len(numbers))))
+        unfinished = [number for number in numbers if not batches[number][1]]   # The workers that have more rows.
+        try:
+            for number in numbers:
+                rows, done = batches[number]
+                while True:
+                    yield from rows
+                    if done:
+                        break
+                    rows, done = self.requestAll([number], [("next", lookup)])[0]
+                if number in unfinished:
+                    unfinished.remove(number)
+        finally:
+            if unfinished:  # The goal was cut, so the workers can forget the rows it didn't get to.
+                self.requestAll(unfinished, [("close", lookup)] * len(unfinished))
+    # Yields once for each fact that the goal unifies with.
+    def solve(self, goal, state):
+        positions = []
+        key = []
+        for position, arg in enumerate(goal.args):
+            value = callKey(arg)
+            if isinstance(value, tuple):
+                return      # Lists and goals can't unify with atoms and numbers.
+            if value is not None:
+                positions.append(position)
+                key.append(value)
+        for row in self.lookup(tuple(positions), tuple(key)):
+            mark = len(state.trail)
+            if all(unify(arg, internConst(value), state) for arg, value in zip(goal.args, row)):
+                yield True
+            state.undo(mark)
+    # Stops the workers. Their facts are lost.
+    def close(self):
+        self.requestAll(range(len(self.connections)), [("stop",)] * len(self.connections))
+        for connection, process in zip(self.connections, self.processes):
+            connection.close()
+            process.join()
+
+
+
+# #### Memory-mapped Fact Stores ####
+
+# buildFactStore writes the facts of some predicates to a file once, and FactStore opens the file with mmap,
+# so any number of processes can read the same facts, sharing the pages through the OS instead of each
+# making its own alts. pred.mapFacts(store) makes the predicate's goals look up its facts in the file.
+# Only facts whose args are all atoms and numbers can be stored. The file is laid out as:
+#   magic, atom count, table count
+#   atom offsets, then the atoms as UTF-8, sorted so an atom's number can be found by binary search
+#   for each table: its name, arity and row count, then a tag and a value for every arg of every row, a column
+#   at a time, then an index for every arg, which is the row numbers sorted by that arg.
+# A tag is atomTag, intTag or floatTag. The value of an atom is its number in the atom table.
+# Integers, and each section, take up 8 bytes, so the columns can be read straight from the file.
+# Every number is little-endian, so a file can be read on any machine. On a big-endian one, the numbers are
+# copied and swapped when the file is opened (see storeArray), so its pages aren't shared.
+
+storeMagic = b"PLFACTS1"
+atomTag = 0
+intTag = 1
+floatTag = 2
+
+
+def padding(data):
+    data.extend(bytes(-len(data) % 8))
+
+
+# Returns the bytes of an array of numbers, in little-endian order.
+def storeBytes(numbers):
+    if sys.byteorder != "little":
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+# Returns the little-endian numbers in part of a FactStore file, with the type code of an array.
+def storeArray(view, code):
+    if sys.byteorder == "little":
+        return view.cast(code)
+    numbers = array.array(code)
+    numbers.frombytes(view)
+    numbers.byteswap()
+    return numbers
+
+
+# Writes the facts of every arity of each predicate to a FactStore file at path. The facts of a sharded
+# predicate are read from its workers, and those of a mapped one from its FactStore.
+# Raises a ValueError if a predicate has a rule, or a fact with an arg that isn't an atom or number.
+def buildFactStore(path, preds):
+    tables = []
+    atoms = set()
+    for pred in preds:
+        for arity in sorted(set(pred.alternatives) | set(pred.sharded) | set(pred.mapped)):
+            if arity in pred.sharded:
+                rows = list(pred.sharded[arity].lookup((), ()))
+            elif arity in pred.mapped:
+                rows = pred.mapped[arity].facts()
+            else:
+                rows = pred.analyze(arity).facts
+            if rows is None:
+                raise ValueError(pred.name + "/" + str(arity) + " can't be stored, since it has an arg that "
+                    "isn't an atom or number, or a rule.")
+            tables.append((pred.name, arity, rows))
+            atoms.update(value for row in rows for value in row if isinstance(value, str))
+    atoms = sorted(atoms, key = lambda atom: atom.encode())
+    atomNumbers = {atom: number for number, atom in enumerate(atoms)}
+    data = bytearray(storeMagic + struct.pack("<QQ", len(atoms), len(tables)))
+    encoded = [atom.encode() for atom in atoms]
+    data.extend(storeBytes(array.array("Q", itertools.accumulate((len(atom) for atom in encoded), initial = 0))))
+    data.extend(b"".join(encoded))
+    padding(data)
+    for name, arity, rows in tables:
+        name = name.encode()
+        data.extend(struct.pack("<Q", len(name)) + name)
+        padding(data)
+        data.extend(struct.pack("<QQ", arity, len(rows)))
+        tags = bytearray()
+        values = array.array("q")
+        for position in range(arity):
+            for row in rows:
+                value = row[position]
+                if isinstance(value, str):
+                    tags.append(atomTag)
+                    values.append(atomNumbers[value])
+                elif isinstance(value, float):
+                    tags.append(floatTag)
+                    values.append(struct.unpack("=q", struct.pack("=d", value))[0])   # The float's bits.
+                elif -2 ** 63 <= value < 2 ** 63:
+                    tags.append(intTag)
+                    values.append(value)
+                else:
+                    raise ValueError(str(value) + " is too big to be stored.")
+        data.extend(tags)
+        padding(data)
+        data.extend(storeBytes(values))
+        for position in range(arity):
+            column = [storeKey(value, atomNumbers) for value in (row[position] for row in rows)]
+            data.extend(storeBytes(array.array("I", sorted(range(len(rows)), key = column.__getitem__))))
+        padding(data)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)     # Processes that already opened the old file keep reading it.
+
+
+# The order that an arg's index sorts its rows in. Atoms come before numbers, and 1 and 1.0 are the same.
+def storeKey(value, atomNumbers):
+    if isinstance(value, str):
+        return (atomTag, atomNumbers[value])
+    return (intTag, value)
+
+
+# A file of fact tables, opened read-only with mmap.
+class FactStore():
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if view[:8] != storeMagic:
+            raise ValueError(path + " isn't a FactStore.")
+        atomCount, tableCount = struct.unpack_from("<QQ", self.map, 8)
+        offset = 24
+        self.atomOffsets = storeArray(view[offset:offset + 8 * (atomCount + 1)], "Q")
+        offset += 8 * (atomCount + 1)
+        self.atomData = view[offset:offset + self.atomOffsets[atomCount]]
+        offset += self.atomOffsets[atomCount] + (-self.atomOffsets[atomCount] % 8)
+        self.atoms = {}     # The atoms that have been read, by their numbers.
+        self.tables = {}    # The MappedTable of each (name, arity).
+        for _ in range(tableCount):
+            nameLength, = struct.unpack_from("<Q", self.map, offset)
+            name = bytes(view[offset + 8:offset + 8 + nameLength]).decode()
+            offset += 8 + nameLength + (-nameLength % 8)
+            arity, rowCount = struct.unpack_from("<QQ", self.map, offset)
+            offset += 16
+            table = MappedTable(self, arity, rowCount, view, offset)
+            self.tables[(name, arity)] = table
+            offset = table.end
+    def __repr__(self):
+        return "FactStore(" + self.path + ")"
+    def atom(self, number):
+        atom = self.atoms.get(number)
+        if atom is None:
+            atom = self.atoms[number] = bytes(self.atomData[self.atomOffsets[number]:self.atomOffsets[number + 1]]).decode()
+        return atom
+    # Returns the number of an atom, or None if no fact has it.
+    def atomNumber(self, atom):
+        encoded = atom.encode()
+        offsets = self.atomOffsets
+        number = bisect.bisect_left(range(len(offsets) - 1), encoded,
+            key = lambda number: bytes(self.atomData[offsets[number]:offsets[number + 1]]))
+        if number < len(offsets) - 1 and bytes(self.atomData[offsets[number]:offsets[number + 1]]) == encoded:
+            return number
+        return None
+
+
+# The facts of one (name, arity) in a FactStore. Nothing is read from the file until a goal looks up its rows.
+class MappedTable():
+    def __init__(self, store, arity, rowCount, view, offset):
+        self.store = store
+        self.arity = arity
+        self.rowCount = rowCount
+        cells = arity * rowCount
+        self.tags = view[offset:offset + cells]
+        offset += cells + (-cells % 8)
+        self.ints = storeArray(view[offset:offset + 8 * cells], "q")
+        self.floats = storeArray(view[offset:offset + 8 * cells], "d")
+        offset += 8 * cells
+        self.indexes = [storeArray(view[offset + 4 * rowCount * position:offset + 4 * rowCount * (position + 1)], "I")
+            for position in range(arity)]
+        offset += 4 * cells
+        self.end = offset + (-offset % 8)
+    def __len__(self):
+        return self.rowCount
+    # Returns the values of every row, in the order they were stored.
+    def facts(self):
+        return [tuple(self.value(position, row) for position in range(self.arity)) for row in range(self.rowCount)]
+    # Returns the value of a row's arg.
+    def value(self, position, row):
+        cell = position * self.rowCount + row
+        tag = self.tags[cell]
+        if tag == atomTag:
+            return self.store.atom(self.ints[cell])
+        if tag == intTag:
+            return self.ints[cell]
+        return self.floats[cell]
+    # The key that the index of the arg at position sorts the row by.
+    def key(self, position, row):
+        cell = position * self.rowCount + row
+        tag = self.tags[cell]
+        if tag == floatTag:
+            return (intTag, self.floats[cell])
+        return (tag, self.ints[cell])
+    # Returns the first and last place in the index of the arg at position that have rows whose arg is value.
+    def span(self, position, value):
+        if isinstance(value, str):
+            number = self.store.atomNumber(value)
+            if number is None:
+                return 0, 0
+            key = (atomTag, number)
+        else:
+            key = (intTag, value)
+        index = self.indexes[position]
+        start = bisect.bisect_left(index, key, key = lambda row: self.key(position, row))
+        end = bisect.bisect_right(index, key, lo = start, key = lambda row: self.key(position, row))
+        return start, end
+    # Returns the bound args of a goal as (position, value) pairs, or None if some arg can't match any row.
+    def boundArgs(self, args):
+        bound = []
+        for position, arg in enumerate(args):
+            value = callKey(arg)
+            if isinstance(value, tuple):
+                return None     # Lists and goals can't unify with atoms and numbers.
+            if value is not None:
+                bound.append((position, value))
+        return bound
+    # Returns the row numbers that have the bound values, using the index of whichever one has the fewest rows.
+    def rows(self, bound):
+        best = None
+        for position, value in bound:
+            start, end = self.span(position, value)
+            if best is None or end - start < best[2] - best[1]:
+                best = (position, start, end)
+        if best is None:
+            return range(self.rowCount)
+        position, start, end = best
+        return self.indexes[position][start:end]    # Rows with the same key were sorted in the order they were stored.
+    # Returns how many rows could match the args.
+    def count(self, args):
+        bound = self.boundArgs(args)
+        if bound is None:
+            return 0
+        return min([len(self)] + [end - start for start, end in (self.span(position, value) for position, value in bound)])
+    # Yields once for each row that the goal unifies with.
+    def solve(self, goal, state):
+        bound = self.boundArgs(goal.args)
+        if bound is None:
+            return
+        for row in self.rows(bound):
+            mark = len(state.trail)
+            if all(unify(arg, internConst(self.value(position, row)), state) for position, arg in enumerate(goal.args)):
+                yield True
+            state.undo(mark)
+
+
+
+# #### Query Server ####
+
+# A QueryServer answers queries sent over a socket, from a process that has already defined its predicates,
+# so a short query doesn't wait for Python to start and the knowledge base to be made.
+# Each message is one line of JSON. A client sends {"id": 1, "goals": [...]}, optionally with "select",
+# "tuples", "limit", "maxInferences", "maxDepth", "maxTime", "maxTrail" and "reorder", which work like the
+# arguments of query(...). The server sends {"id": 1, "answer": ...} for each answer as it is found, and then
+# {"id": 1, "done": true, "inferences": 12, "output": "..."}, with "exceeded" if the query went over a limit,
+# or {"id": 1, "error": "..."} if it couldn't be run. Answers are given as Python values, like query(select = True).
+# Goals are sent as {"pred": name, "args": [...]}, sets as {"set": [...]} and maps as {"map": [[key, value], ...]}.
+# Other args are sent as they would be written in Python, e.g. "X", "'bob'", 3 or [1, "|", "T"].
+# A client may send more queries before the answers to the first one come back. Each connection's queries
+# are run by a pool of threads, so their answers may come back in any order, and each one is marked with its id.
+# A line may also be the goals of a query written in Prolog, like grandparent(X, 'Bob'). See Reading Prolog Text.
+
+
+# Returns a term as JSON.
+def encodeTerm(term):
+    if isinstance(term, Goal):
+        return {"pred": term.pred.name, "args": [encodeTerm(arg) for arg in term.args]}
+    if isinstance(term, (set, frozenset)):
+        return {"set": [encodeTerm(item) for item in term]}
+    if isinstance(term, dict):
+        return {"map": [[encodeTerm(key), encodeTerm(value)] for key, value in term.items()]}
+    if isinstance(term, (list, tuple)):
+        return [encodeTerm(item) for item in term]
+    return term
+
+
+# Makes JSON back into a term, finding predicates by name in predicates.
+def decodeTerm(data, predicates):
+    if isinstance(data, dict):
+        if "pred" in data:
+            pred = predicates.get(data["pred"])
+            if pred is None:
+                raise ValueError("There is no predicate called " + str(data["pred"]) + ".")
+            return Goal(pred, [decodeTerm(arg, predicates) for arg in data.get("args", [])])
+        if "set" in data:
+            return {decodeTerm(item, predicates) for item in data["set"]}
+        if "map" in data:
+            return {decodeTerm(key, predicates): decodeTerm(value, predicates) for key, value in data["map"]}
+        raise ValueError("Terms can't be written as " + json.dumps(data) + ".")
+    if isinstance(data, list):
+        return [decodeTerm(item, predicates) for item in data]
+    return data
+
+
+# Turns the Python values of answers that JSON doesn't have into lists.
+def jsonValue(value):
+    if isinstance(value, (frozenset, set, tuple)):
+        return list(value)
+    raise TypeError(repr(value) + " can't be sent as JSON.")
+
+
+# Finds predicates by name in a dict like globals(), and then by their own names, when they are needed.
+class PredicateLookup():
+    def __init__(self, namespace):
+        self.namespace = namespace
+        # The predicates by their own names, made again when one isn't found. It only holds them weakly, like
+        # the registry, so it doesn't keep alive the ones that queries made.
+        self.byName = weakref.WeakValueDictionary()
+    def get(self, name, default = None):
+        pred = self.namespace.get(name)
+        if isinstance(pred, Predicate):
+            return pred
+        pred = self.byName.get(name)
+        if pred is None:
+            self.byName = weakref.WeakValueDictionary({pred.name: pred for pred in list(Predicate.registry)})
+            pred = self.byName.get(name, default)
+        return pred
+    # A predicate that a query made, since it wasn't defined, has no clauses, so it isn't kept once the query
+    # is done. Otherwise each query with a new name, like a typo, would add one that is never freed.
+    def setdefault(self, name, pred):
+        return pred
+
+
+class QueryServer():
+    # address is the path of a Unix socket, or a (host, port) pair for TCP.
+    # predicates is a dict of names to Predicates, like globals(). Each Predicate can also be found by its own name.
+    # They are looked up as each request is run, so predicates defined after the server started can be used.
+    # workers is how many queries may be run at once.
+    def __init__(self, address, predicates, workers = 4):
+        self.predicates = PredicateLookup(predicates)
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                if self.connection.family != socket.AF_UNIX:
+                    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Answers are sent at once.
+            def handle(self):
+                server.handle(self.rfile, self.wfile)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)      # A socket left behind by a server that stopped.
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(address, Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = None
+    # Answers queries until close is called.
+    def serve(self):
+        self.server.serve_forever()
+    # Answers queries from a thread, and returns the server.
+    def start(self):
+        self.thread = threading.Thread(target = self.serve, daemon = True)
+        self.thread.start()
+        return self
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.shutdown()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+    # Reads the queries from one connection, and runs each of them in the pool.
+    def handle(self, reader, writer):
+        lock = threading.Lock()     # Only one query at a time may write to the connection.
+        def send(message):
+            line = (json.dumps(message, default = jsonValue) + "\n").encode()
+            with lock:
+                writer.write(line)
+                writer.flush()
+        running = []
+        for line in reader:
+            if line.strip():
+                running = [future for future in running if not future.done()]
+                running.append(self.pool.submit(self.run, line, send))
+        concurrent.futures.wait(running)
+    # Runs one query, sending each answer as it is found.
+    def run(self, line, send):
+        answerLine(line, self.predicates, send)
+
+
+# Runs the query on one line of JSON, or of Prolog (see python -m PL), sending each answer as it is found.
+# Settings are used for the parts of the request that it doesn't give, and number is its id if it has none.
+def answerLine(line, predicates, send, settings = None, number = None):
+    try:
+        text = line.strip()
+        if isinstance(text, bytes):
+            text = text.decode()
+        if text.startswith("{"):
+            request = json.loads(text)
+            if not isinstance(request, dict) or not isinstance(request.get("goals"), list):
+                raise ValueError('A request must be a JSON object with a list of goals in "goals".')
+            number = request.get("id", number)
+            goals = [decodeTerm(goal, predicates) for goal in request["goals"]]
+            if not all(isinstance(goal, Goal) for goal in goals):
+                raise ValueError('Each goal must be written as {"pred": name, "args": [...]}.')
+        else:
+            request = {}
+            goals = PrologReader(text, predicates).query()
+        if settings:
+            request = dict(settings, **request)
+        output = io.StringIO()
+        results = Query()
+        results(request.get("limit"), maxInferences = request.get("maxInferences"),
+            maxDepth = request.get("maxDepth"), maxTime = request.get("maxTime"), maxTrail = request.get("maxTrail"),
+            output = output, reorder = request.get("reorder", False), select = request.get("select") or True,
+            tuples = request.get("tuples", False))
+        for answer in results.answers(goals):
+            if not isinstance(answer, LimitExceeded):
+                send({"id": number, "answer": answer})
+        done = {"id": number, "done": True, "inferences": results.inferences, "output": output.getvalue()}
+        if results.exceeded is not None:
+            done["exceeded"] = {"limit": results.exceeded.limit, "maximum": results.exceeded.maximum}
+        send(done)
+    except OSError:
+        return      # The client has gone.
+    except ValueError as err:
+        send({"id": number, "error": str(err)})
+    except Exception as err:
+        send({"id": number, "error": type(err).__name__ + ": " + str(err)})
+
+
+# A QueryClient sends queries to a QueryServer over a pool of connections that stay open.
+# Each query goes to the connection with the fewest queries waiting, and doesn't wait for the ones before it.
+class QueryClient():
+    def __init__(self, address, connections = 4):
+        self.address = address
+        self.ids = itertools.count()
+        self.connections = [ServerConnection(address) for _ in range(connections)]
+    # Sends a query, and returns a PendingQuery for its answers. The options are the ones a QueryServer takes.
+    def submit(self, goals, **options):
+        connection = min(self.connections, key = lambda connection: len(connection.pending))
+        pending = PendingQuery(next(self.ids))
+        request = dict(options, id = pending.id, goals = [encodeTerm(goal) for goal in goals])
+        connection.send(request, pending)
+        return pending
+    # Returns the answers to a query, like query << goals.
+    def query(self, goals, **options):
+        return self.submit(goals, **options).result()
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception):
+        self.close()
+
+
+# The answers to a query that was sent to a QueryServer, which are filled in as they come back.
+class PendingQuery():
+    def __init__(self, id):
+        self.id = id
+        self.answers = []
+        self.output = ""
+        self.inferences = None
+        self.exceeded = None
+        self.error = None
+        self.finished = threading.Event()
+    # Waits for the query to finish, and returns its answers like query << goals would.
+    # Raises a ValueError if the server couldn't run it.
+    def result(self, timeout = None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError("The query didn't finish in " + str(timeout) + " seconds.")
+        if self.error is not None:
+            raise ValueError(self.error)
+        answers = list(self.answers)
+        if self.exceeded is not None:
+            answers.append(self.exceeded)
+        return answers or [False]
+
+
+# One connection to a QueryServer. A thread reads the messages that come back, and gives them to the
+# PendingQuery with their id.
+class ServerConnection():
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.connect(address)
+        self.reader = self.socket.makefile("rb")
+        self.lock = threading.Lock()
+        self.pending = {}       # The PendingQuery of each query that hasn't finished, by its id.
+        self.thread = threading.Thread(target = self.receive, daemon = True)
+        self.thread.start()
+    def send(self, request, pending):
+        self.pending[pending.id] = pending
+        line = (json.dumps(request) + "\n").encode()
+        with self.lock:
+            self.socket.sendall(line)
+    def receive(self):
+        try:
+            for line in self.reader:
+                message = json.loads(line)
+                pending = self.pending.get(message["id"])
+                if pending is None:
+                    continue
+                if "answer" in message:
+                    pending.answers.append(message["answer"])
+                    continue
+                if "error" in message:
+                    pending.error = message["error"]
+                else:
+                    pending.output = message["output"]
+                    pending.inferences = message["inferences"]
+                    if "exceeded" in message:
+                        pending.exceeded = LimitExceeded(message["exceeded"]["limit"], message["exceeded"]["maximum"])
+                del self.pending[message["id"]]
+                pending.finished.set()
+        except (OSError, ValueError):
+            pass
+        # The connection closed, so the queries still waiting will never be answered.
+        for pending in list(self.pending.values()):
+            pending.error = "The connection to the server closed."
+            pending.finished.set()
+        self.pending.clear()
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join()
+
+
+
+# #### Prepared Queries ####
+
+# prepare makes the goals of a query into terms once, so a query that is run many times with different values
+# doesn't parse its goals again each time. Its params are Vars that are given a value each time it is run:
+#   findChildren = prepare([child("X", "Parent")], ["Parent"])
+#   findChildren("'john'")     # Like query << [child("X", "'john'")]
+# Each run copies the terms, with the params replaced by their values, so runs don't share Vars and can be
+# made from many threads at once. The goals are put into FactJoins once, and with reorder = True, they are
+# put in the order planGoals finds for the first values they are run with. Both are done again if alts have
+# been added or removed since.
+
+
+def prepare(goals, params = (), reorder = False):
+    return PreparedQuery(goals, params, reorder)
+
+
+# Returns a copy of a term with new Vars, except that the Vars in mapping are replaced by their terms.
+def copyTerm(term, mapping):
+    if isinstance(term, LazyList):
+        term.source.kept = True     # Each copy reads the same list, so it can't be streamed.
+        return term
+    if isinstance(term, Var):
+        copy = mapping.get(term)
+        if copy is None:
+            copy = mapping[term] = Var(term.name)
+        return copy
+    if isinstance(term, ListPL):
+        items = []
+        while isinstance(term, ListPL):
+            items.append(copyTerm(term.head, mapping))
+            term = term.tail
+        return makeList(items, copyTerm(term, mapping))
+    if isinstance(term, Goal):
+        return Goal(term.pred, [copyTerm(arg, mapping) for arg in term.args])
+    if isinstance(term, FactJoin):
+        return FactJoin([copyTerm(goal, mapping) for goal in term.goals])
+    if isinstance(term, Math):
+        math = Math()
+        math.mathList = [copyTerm(item, mapping) if isinstance(item, Term) else item for item in term.mathList]
+        return math
+    if isinstance(term, MapPL):
+        return MapPL.fromPairs([(keyTerm, copyTerm(value, mapping)) for key, (keyTerm, value) in term.trie])
+    if isinstance(term, list):
+        return [copyTerm(item, mapping) for item in term]    # The terms that format_ fills in.
+    return term
+
+
+class PreparedQuery():
+    def __init__(self, goals, params, reorder):
+        self.memo = {}
+        self.goals = [create(goal, self.memo) for goal in goals]
+        keepLazyLists(self.goals)       # Each run reads the lazy lists in the goals again.
+        for name in params:
+            if not isinstance(self.memo.get(name), Var):
+                raise ValueError("'" + str(name) + "' isn't a variable in the query.")
+        self.params = [self.memo[name] for name in params]
+        self.reorder = reorder
+        self.plan = None    # The value of Predicate.changes, and the goals to run, once they are reordered and joined.
+    # Runs the query with a value for each param, and returns its answers like query << goals.
+    # Settings are the ones that query(...) takes, e.g. prepared("'john'", num = 1, select = ["X"]).
+    def __call__(self, *values, **settings):
+        results = Query()
+        results(**settings)
+        results.extend(self.answers(values, results))
+        if results == []:
+            results.append(False)
+        return results
+    # Yields the answers one at a time, like Query.answers. The settings of results are used, if it is given.
+    def answers(self, values, results = None):
+        if len(values) != len(self.params):
+            raise ValueError("The query takes " + str(len(self.params)) + " values, but was given " + str(len(values)) + ".")
+        mapping = {}
+        for param, value in zip(self.params, values):
+            mapping[param] = create(value, {})
+        plan = self.plan
+        if plan is None or plan[0] != Predicate.changes:
+            changes = Predicate.changes
+            goals = self.goals
+            if self.reorder:
+                planMapping = dict(mapping)
+                copies = [copyTerm(goal, planMapping) for goal in goals]
+                positions = {id(copy): i for i, copy in enumerate(copies)}
+                goals = [goals[positions[id(copy)]] for copy in planGoals(copies)[0]]
+            plan = self.plan = (changes, joinFacts(goals))
+        goals = [copyTerm(goal, mapping) for goal in plan[1]]
+        memo = {name: copyTerm(var, mapping) for name, var in self.memo.items()}
+        yield from (results if results is not None else Query()).solve(goals, memo, joins = False)
+
+
+# #### Search Strategies ####
+
+# searchGoals finds the answers to goals with a strategy other than the depth-first search of tryGoals.
+# "iterative": depth-first search that only goes depthStep levels deeper each time it starts again, so the
+#   answers with the shallowest proofs are found first. An answer found by an earlier round isn't given again.
+# "breadth": every way of taking one step from the goals is tried before any way of taking two, so the answer
+#   with the fewest steps is found first.
+# "best": the goals with the lowest cost are always taken a step further first. The cost comes from the
+#   heuristic, a predicate that is called as heuristic(Goal, Cost) with the first goal left to run. If it fails,
+#   the cost of the goals they came from is used.
+# Breadth-first and best-first search keep a copy of the goals left to run for each way of going on, with the
+# bindings they have made so far filled in. Cut can't take back the copies already made, so a goal whose clauses
+# have a cut is run depth-first by tryGoal as one step, and the query's goals up to its last cut only give their
+# first answer, found depth-first, so cut means the same thing with every strategy. Goals of predicates with no
+# alts (built-ins), control goals like not_ and if_then_else, and call_with_inference_limit are also run by tryGoal
+# as one step, so they work as usual. Finite domains aren't kept in the copies.
+
+depthStep = 1       # How much deeper each round of iterative deepening goes.
+depthFirstGoals = {call_with_inference_limit}
+depthFirstGoals.update(controlGoals)
+
+
+def searchGoals(goals, state, strategy, heuristic = None):
+    goals = [part for goal in goals for part in (goal.goals if isinstance(goal, FactJoin) else [goal])]
+    if strategy == "iterative":
+        yield from deepenGoals(goals, state)
+    elif strategy == "breadth" or strategy == "best":
+        if strategy == "best" and heuristic is None:
+            raise ValueError("Best-first search needs a heuristic predicate.")
+        cuts = [i for i, goal in enumerate(goals) if goal.pred == cut]
+        if not cuts:
+            yield from frontierGoals(goals, state, heuristic if strategy == "best" else None)
+        elif firstAnswer(goals[:cuts[-1] + 1], state, 0):
+            if goals[cuts[-1] + 1:]:
+                yield from frontierGoals(goals[cuts[-1] + 1:], state, heuristic if strategy == "best" else None)
+            else:
+                yield True, False
+    else:
+        raise ValueError("There is no search strategy called " + str(strategy) + ".")
+    yield False, False
+
+
+# Iterative deepening. Each round runs tryGoals again with a deeper depthBound, until a round doesn't have
+# to stop at the bound. Answers are counted by their values, so one found again isn't given twice.
+def deepenGoals(goals, state):
+    answerVars = []
+    for goal in goals:
+        freeVars(goal, answerVars)
+    given = {}      # How many times each answer has been given.
+    state.depthBound = 0
+    while True:
+        state.cutoff = False
+        found = {}
+        for attempt in tryGoals(goals, state):
+            if not attempt[0]:
+                break
+            key = repr([toPython(var) for var in answerVars])
+            found[key] = found.get(key, 0) + 1
+            if found[key] > given.get(key, 0):
+                given[key] = found[key]
+                yield True, False
+        if not state.cutoff:
+            break
+        state.depthBound += depthStep
+    state.depthBound = float("inf")
+
+
+# Breadth-first or best-first search. Each entry of the frontier is the goals left to run, and the values of
+# the query's Vars, with the bindings made so far filled in. Breadth-first search uses the number of steps
+# taken as the cost, so both take the entry with the lowest cost first.
+def frontierGoals(goals, state, heuristic):
+    answerVars = []
+    for goal in goals:
+        freeVars(goal, answerVars)
+    order = itertools.count()       # Entries with the same cost are taken in the order they were made.
+    frontier = [(0, next(order), 0, resolveTerm(list(goals)), resolveTerm(answerVars))]
+    while frontier:
+        cost, _, depth, goals, values = heapq.heappop(frontier)
+        for nextGoals, nextValues in expandGoals(goals, values, state, depth):
+            if not nextGoals:
+                # Every goal has been run, so this is an answer. The query's Vars are bound to its values.
+                mark = len(state.trail)
+                if all(unify(var, value, state) for var, value in zip(answerVars, nextValues)):
+                    yield True, False
+                state.undo(mark)
+            elif heuristic is None:
+                heapq.heappush(frontier, (depth + 1, next(order), depth + 1, nextGoals, nextValues))
+            else:
+                nextCost = heuristicCost(heuristic, nextGoals[0], state, depth)
+                heapq.heappush(frontier, (cost if nextCost is None else nextCost, next(order), depth + 1,
+                    nextGoals, nextValues))
+
+
+# Yields the goals left to run, and the values, after each way of taking one step from the first goal.
+def expandGoals(goals, values, state, depth):
+    goal = deref(goals[0])
+    rest = goals[1:]
+    mark = len(state.trail)
+    alts = None
+    if goal.pred not in depthFirstGoals and goal.pred.program is None and len(goal.args) in goal.pred.alternatives:
+        alts = goal.pred.matchingAlts(goal.args)
+        if any(isinstance(altGoal, Goal) and altGoal.pred == cut for alt in alts for altGoal in alt.goals):
+            alts = None     # Its cuts must take back its other clauses, so it is run depth-first.
+    if alts is None:
+        for attempt in tryGoal(goal, state, depth):
+            if attempt[0]:
+                yield resolveTerm(rest), resolveTerm(values)
+        state.undo(mark)
+    else:
+        state.infer(depth)
+        for alt in alts:
+            memo = {}
+            altArgs = [create(arg, memo) for arg in alt.args]
+            if tryUnify(goal.args, altArgs, state):
+                body = [create(altGoal, memo) for altGoal in alt.goals]
+                if alt.pred.reordered:
+                    body = planGoals(body)[0]
+                yield resolveTerm(body + rest), resolveTerm(values)
+            state.undo(mark)
+
+
+# Returns the number that heuristic(goal, Cost) gives, or None if it fails.
+def heuristicCost(heuristic, goal, state, depth):
+    cost = Var("Cost")
+    mark = len(state.trail)
+    for attempt in tryGoal(Goal(heuristic, [goal, cost]), state, depth):
+        if attempt[0]:
+            value = cost.value
+            state.undo(mark)
+            if not isinstance(value, (int, float)):
+                raise ValueError(heuristic.name + " gave " + str(flatten(value)) + " as a cost, which isn't a number.")
+            return value
+        break
+    state.undo(mark)
+    return None
+
+
+# #### Parallel Conjunctions ####
+
+# parallel(goals1, goals2, ...) runs each list of goals (or single goal) at the same time, and gives every
+# combination of their answers, like the conjunction of all of them. The first list runs in the query's thread,
+# and the others run in parallelPool, each with its own QueryState, and their answers are kept. So the later
+# lists are only solved once, instead of once for each answer of the lists before them.
+# The lists must not share any unbound Vars, since they can't see each other's bindings. If they do, they are
+# run one after another, like a normal conjunction. Inferences and output of the other lists are added to the
+# query's once they finish. Threads only run Python code one at a time, so goals that wait, like ones on
+# sharded or served facts, gain the most. Cut in a list only cuts that list.
+# A parallel goal inside one of the other lists runs its lists one after another, so threads in the pool
+# never wait for each other. If the query stops before it needs the other lists' answers, like when the first
+# list has none or a cut ends it, the lists that haven't started are cancelled, and the running ones are stopped
+# and waited for, so they don't go on using the query's Vars.
+
+parallel = Predicate("parallel")
+impureGoals.add(parallel)       # Goals aren't moved past it, since its lists must stay independent.
+parallelWorkers = 4
+parallelPool = None         # Made the first time it is needed.
+branchThread = threading.local()
+
+
+# Runs one list of goals in its own QueryState, and returns the values of its Vars for each answer,
+# the number of inferences it made, and its output. It stops early, with no answers, once stop is set.
+def solveBranch(goals, answerVars, limits, depth, stop = None):
+    branchThread.active = True
+    parts = []
+    state = QueryState(output = OutputBuffer(parts.append), **limits)
+    state.stop = stop
+    rows = []
+    try:
+        for attempt in solveGoals(goals, state, depth):
+            if not attempt[0] or (stop is not None and stop.is_set()):
+                break
+            rows.append([resolveTerm(var) for var in answerVars])
+    except QueryStopped:
+        rows = []
+    finally:
+        state.undo(0)
+        state.output.flush()
+        branchThread.active = False
+    return rows, state.inferences, "".join(parts)
+
+
+# The other lists are only given what was left of the query's inference and time limits, so a limit that one of
+# them went over is raised again with the query's own maximum.
+def queryLimit(err, state):
+    maximum = {"inference": state.maxInferences, "time": state.maxTime}.get(err.limit, err.maximum)
+    return LimitExceeded(err.limit, maximum)
+
+
+def parallelGoals(goal, state, depth):
+    global parallelPool
+    branches = [branchGoals(arg) for arg in goal.args]
+    if not branches:
+        yield True
+        return
+    branchVars = []
+    for goals in branches:
+        answerVars = []
+        for branchGoal in goals:
+            freeVars(branchGoal, answerVars)
+        branchVars.append(answerVars)
+    seen = set()
+    for answerVars in branchVars:
+        if seen.intersection(answerVars):
+            # The lists share a Var, so they aren't independent.
+            for attempt in solveGoals([goal for goals in branches for goal in goals], state, depth + 1):
+                if not attempt[0]:
+                    break
+                yield True
+            return
+        seen.update(answerVars)
+    limits = {"maxInferences": None if state.maxInferences is None else state.maxInferences - state.inferences,
+        "maxDepth": state.maxDepth, "maxTrail": state.maxTrail,
+        "maxTime": None if state.maxTime is None else state.maxTime - (time.perf_counter() - state.startTime)}
+    jobs = list(zip(branches[1:], branchVars[1:]))
+    if getattr(branchThread, "active", False):
+        try:
+            results = [solveBranch(goals, answerVars, limits, depth + 1) for goals, answerVars in jobs]
+        except LimitExceeded as err:
+            raise queryLimit(err, state) from None
+        futures = []
+    else:
+        if parallelPool is None:
+            parallelPool = concurrent.futures.ThreadPoolExecutor(parallelWorkers)
+        stop = threading.Event()
+        results = futures = [parallelPool.submit(solveBranch, goals, answerVars, limits, depth + 1, stop)
+            for goals, answerVars in jobs]
+    rows = None
+    try:
+        for attempt in solveGoals(branches[0], state, depth + 1):
+            if not attempt[0]:
+                break
+            if rows is None:
+                # The other lists are waited for once the first one has an answer, and raise any limit they went over.
+                try:
+                    results = [result if isinstance(result, tuple) else result.result() for result in results]
+                except LimitExceeded as err:
+                    raise queryLimit(err, state) from None
+                rows = [result[0] for result in results]
+                for result in results:
+                    state.inferences += result[1]
+                    state.output.write(result[2])
+            for combination in itertools.product(*rows):
+                mark = len(state.trail)
+                if all(unify(var, value, state) for row, answerVars in zip(combination, branchVars[1:])
+                        for var, value in zip(answerVars, row)):
+                    yield True
+                state.undo(mark)
+    finally:
+        if futures and rows is None:
+            stop.set()
+            running = [future for future in futures if not future.cancel()]
+            concurrent.futures.wait(running)
+
+
+# #### List Predicates ####
+
+# maplist/2..5, foldl/4..6, sum_list/2, max_list/2 and numlist/3 are run natively, so a whole list takes one
+# inference instead of one for each item.
+# The closure of maplist and foldl is a goal that is given the items as extra args, e.g. maplist(add(1), "Xs", "Ys")
+# calls add(1, X, Y) for each X in Xs and Y in Ys, or a lambda_ of params and a goal or list of goals:
+#   maplist(lambda_(["X", "Y"], equals("Y", "X * 2")), [1, 2, 3], "Ys")
+# Each call of a lambda_ has new Vars for its params, and shares its other Vars with the rest of the query.
+# foldl(G, [X1, X2, ...], V0, V) calls G(X1, V0, V1), G(X2, V1, V2) and so on, and V is the last of them.
+# When a lambda_'s body is one equals that works out its last param with math, and the other lists are all
+# numbers, the math is made into a Python function once, and run over the whole list without making any terms.
+# maplist runs it with NumPy instead, if it is installed, for lists of at least numpyThreshold floats and math
+# that only adds, subtracts and multiplies, since those give the same answers as Python.
+
+lambda_ = Predicate("lambda_")
+maplist = Predicate("maplist")
+foldl = Predicate("foldl")
+sum_list = Predicate("sum_list")
+max_list = Predicate("max_list")
+numlist = Predicate("numlist")
+
+numpyThreshold = 100
+numpyOperators = {"+", "-", "*", "(", ")"}
+lambdaFunctions = {}    # The Python function made for each expression.
+numberTypes = (int, float)
+
+
+# A list made from its last cell to its first, so each cell doesn't keep a copy of the rest of the list.
+# Its terms are found from its cells when they are needed.
+class BuiltList(ListPL):
+    def __init__(self, head, tail):
+        self.name = "List"
+        self.head = head
+        self.tail = tail
+    @property
+    def terms(self):
+        terms = []
+        term = self
+        while isinstance(term, BuiltList):
+            terms.append(term.head)
+            term = deref(term.tail)
+        if isinstance(term, ListPL):
+            return terms + term.terms
+        if isinstance(term, Const) and term.value == []:
+            return terms
+        return terms + [Const("|"), term]
+    @property
+    def value(self):
+        return self.terms
+    def __len__(self):
+        return len(self.terms)
+
+
+# Returns a list of the terms, ending in tail, or in [] if there is no tail.
+def makeList(terms, tail = None):
+    result = Const([]) if tail is None else tail
+    for term in reversed(terms):
+        result = BuiltList(term, result)
+    return result
+
+
+# Returns the items of a list, or None if its tail isn't bound.
+def properItems(term):
+    items = []
+    term = deref(term)
+    while isinstance(term, ListPL):
+        items.append(term.head)
+        term = deref(term.tail)
+    if isinstance(term, Const) and term.value == []:
+        return items
+    return None
+
+
+# Returns the numbers in a list, or None if it isn't a whole list of numbers.
+def numberItems(term):
+    numbers = []
+    term = deref(term)
+    while isinstance(term, ListPL):
+        item = term.head
+        if isinstance(item, Var):
+            item = deref(item)
+        if not isinstance(item, Const) or type(item.value) not in numberTypes:
+            return None
+        numbers.append(item.value)
+        term = term.tail
+        if isinstance(term, Var):
+            term = deref(term)
+    if isinstance(term, Const) and term.value == []:
+        return numbers
+    return None
+
+
+# Returns the items of each list. They must all be as long as the first of them whose length is known, and the
+# others are bound to lists of new Vars that long. Returns None if they can't be.
+def listColumns(goal, lists, state):
+    columns = [properItems(term) for term in lists]
+    known = [items for items in columns if items is not None]
+    if not known:
+        raise ValueError(goal.name + " needs a list whose length is known.")
+    length = len(known[0])
+    for i, items in enumerate(columns):
+        if items is None:
+            columns[i] = [Var("_") for _ in range(length)]
+            if not unify(lists[i], makeList(columns[i]), state):
+                return None
+        elif len(items) != length:
+            return None
+    return columns
+
+
+# Returns the goals that calling a closure with the extra args runs.
+def closureGoals(closure, extra):
+    closure = deref(closure)
+    if isinstance(closure, Goal) and closure.pred == lambda_ and len(closure.args) == 2:
+        params = listTerms(closure.args[0])
+        if len(params) != len(extra):
+            raise ValueError("The lambda_ takes " + str(len(params)) + " args, but was given " + str(len(extra)) + ".")
+        body = resolveTerm(branchGoals(closure.args[1]))
+        paramVars = freeVars(params)
+        mapping = {var: var for var in freeVars(body) if var not in paramVars}   # These Vars are shared.
+        goals = []
+        for param, arg in zip(params, extra):
+            param = deref(param)
+            if isinstance(param, Var) and param not in mapping:
+                mapping[param] = arg
+            else:
+                goals.append(Goal(equals, [copyTerm(resolveTerm(param), mapping), arg]))
+        goals += [copyTerm(goal, mapping) for goal in body]
+        if any(goal.pred == cut for goal in goals):
+            return [Goal(call, [makeList(goals)])]     # So that the cut only cuts this call.
+        return goals
+    if isinstance(closure, Goal):
+        return [Goal(closure.pred, closure.args + list(extra))]
+    raise ValueError(str(flatten(closure.value)) + " can't be called.")
+
+
+# Returns the Python function for a lambda_ of arity params whose body is one equals that works out its last
+# param with math, with the values of the other Vars in the math, and the operators it uses.
+# Returns None if the lambda_ isn't like that, or one of the other Vars isn't bound to a number.
+def lambdaFunction(closure, arity):
+    closure = deref(closure)
+    if not isinstance(closure, Goal) or closure.pred != lambda_ or len(closure.args) != 2:
+        return None
+    params = [deref(param) for param in listTerms(closure.args[0])]
+    body = branchGoals(closure.args[1])
+    if len(params) != arity or len(body) != 1 or body[0].pred != equals or len(body[0].args) != 2:
+        return None
+    if not all(isinstance(param, Var) for param in params) or len(set(params)) != arity:
+        return None
+    math = deref(body[0].args[1])
+    if deref(body[0].args[0]) is not params[-1] or not isinstance(math, Math):
+        return None
+    expression = []
+    constants = []
+    operators = set()
+    for item in math.mathList:
+        if not isinstance(item, Term):
+            if item in ("*", "/") and expression and expression[-1] == item:
+                operators.discard(item)
+                item = expression.pop() * 2    # mathToList splits "**" and "//" into two operators, like in mathTree.
+            expression.append(item)
+            operators.add(item)
+            continue
+        item = deref(item)
+        if item in params[:-1]:
+            expression.append("a" + str(params.index(item)))
+        elif isinstance(item, Const) and isNumber(item.value):
+            expression.append("c" + str(len(constants)))
+            constants.append(item.value)
+        else:
+            return None
+    names = ["c" + str(i) for i in range(len(constants))] + ["a" + str(i) for i in range(arity - 1)]
+    source = "lambda " + ", ".join(names) + ": " + " ".join(expression)
+    function = lambdaFunctions.get(source)
+    if function is None:
+        try:
+            function = lambdaFunctions[source] = eval(source, {})
+        except SyntaxError:
+            return None     # Math that Python can't read the same way, which is worked out by calling the lambda_.
+    return function, constants, operators
+
+
+# Returns the value of the lambda_'s last param for the items at each position of the inputs,
+# or None if it can't be worked out without calling it.
+def mapValues(closure, inputs):
+    compiled = lambdaFunction(closure, len(inputs) + 1)
+    if compiled is None or len(set(len(items) for items in inputs)) != 1:
+        return None
+    function, constants, operators = compiled
+    if numpy is not None and len(inputs[0]) >= numpyThreshold and operators <= numpyOperators \
+            and all(isinstance(value, float) for items in inputs for value in items):
+        result = function(*constants, *[numpy.array(items) for items in inputs])
+        if numpy.ndim(result) == 1:
+            return result.tolist()
+    return list(map(functools.partial(function, *constants), *inputs))
+
+
+# Returns the value that foldl gives with the lambda_, or None if it can't be worked out without calling it.
+def foldValue(closure, inputs, start):
+    compiled = lambdaFunction(closure, len(inputs) + 2)
+    if compiled is None or len(set(len(items) for items in inputs)) != 1:
+        return None
+    function = functools.partial(compiled[0], *compiled[1])
+    value = start
+    for items in zip(*inputs):
+        value = function(*items, value)
+    return value
+
+
+# Each list built-in takes the goal, the query state and the depth, and yields once for each solution.
+def maplistGoal(goal, state, depth):
+    closure = goal.args[0]
+    lists = goal.args[1:]
+    mark = len(state.trail)
+    inputs = [numberItems(term) for term in lists[:-1]]
+    if inputs and None not in inputs:
+        values = mapValues(closure, inputs)
+        if values is not None:
+            yield from unifyEach([(lists[-1], makeList([Const(value) for value in values]))], state)
+            return
+    columns = listColumns(goal, lists, state)
+    if columns is not None:
+        goals = [called for items in zip(*columns) for called in closureGoals(closure, items)]
+        for attempt in solveGoals(goals, state, depth + 1):
+            if not attempt[0]:
+                break
+            yield True
+    state.undo(mark)
+
+def foldlGoal(goal, state, depth):
+    closure = goal.args[0]
+    lists = goal.args[1:-2]
+    start = deref(goal.args[-2])
+    mark = len(state.trail)
+    inputs = [numberItems(term) for term in lists]
+    if None not in inputs and isinstance(start, Const) and isNumber(start.value):
+        value = foldValue(closure, inputs, start.value)
+        if value is not None:
+            yield from unifyEach([(goal.args[-1], Const(value))], state)
+            return
+    columns = listColumns(goal, lists, state)
+    if columns is not None:
+        length = len(columns[0])
+        values = [start] + [Var("_") for _ in range(length - 1)] + [goal.args[-1]]
+        if length == 0:
+            goals = [Goal(equals, [start, goal.args[-1]])]
+        else:
+            goals = [called for i, items in enumerate(zip(*columns))
+                for called in closureGoals(closure, items + (values[i], values[i + 1]))]
+        for attempt in solveGoals(goals, state, depth + 1):
+            if not attempt[0]:
+                break
+            yield True
+    state.undo(mark)
+
+def sumListGoal(goal, state, depth):
+    numbers = numberItems(goal.args[0])
+    if numbers is None:
+        raise ValueError(goal.name + " needs a list of numbers.")
+    yield from unifyEach([(goal.args[1], internConst(sum(numbers)))], state)
+
+def maxListGoal(goal, state, depth):
+    numbers = numberItems(goal.args[0])
+    if numbers is None:
+        raise ValueError(goal.name + " needs a list of numbers.")
+    if numbers:
+        yield from unifyEach([(goal.args[1], internConst(max(numbers)))], state)
+
+def numlistGoal(goal, state, depth):
+    low = goal.args[0].value
+    high = goal.args[1].value
+    if not isinstance(low, int) or not isinstance(high, int) or isinstance(low, bool) or isinstance(high, bool):
+        raise ValueError(goal.name + " needs two integers.")
+    if low <= high:
+        yield from unifyEach([(goal.args[2], makeList([Const(number) for number in range(low, high + 1)]))], state)
+
+
+listGoals = {maplist: maplistGoal, foldl: foldlGoal, sum_list: sumListGoal, max_list: maxListGoal,
+    numlist: numlistGoal}
+impureGoals.update([maplist, foldl])      # Like call, their closures may be impure.
+boundGoals.update(dict.fromkeys([sum_list, max_list, numlist], 1))
+
+
+# #### Lazy Lists ####
+
+# lazyList(items) is a list whose cells are read from a Python iterable, like a file, a csv.reader or a
+# generator, only once something looks at them:
+#   query << [member("X", lazyList(open("words.txt"), str.strip))]
+# Each item is given to convert, if there is one, and made into a term by dataTerm, so strings are atoms.
+# A lazy list is a Var that is bound to its next cell as soon as it is dereferenced, so the rest of the engine
+# sees a normal list. Cells only refer to the cells after them, so the ones that have been read are kept only
+# while something still refers to a cell before them, like the goal that the list was given to.
+# member/2, length/2 and append/3 walk a lazy list in a loop instead of running their rules for each cell, so
+# long lists don't go over maxDepth or Python's recursion limit. append with a lazy first list and an unbound
+# third list makes the third list lazy too, reading the first list as it is read.
+# When one of them is given a lazy list itself, rather than a Var bound to one, and the list is only in one of the
+# query's goals, no other goal can read it, so it streams the list: the cells it hasn't read yet aren't kept, and
+# lists bigger than memory can be walked. A lazy list that is in more than one goal of a query, in a clause, or in
+# a prepared query is kept, since it is read again. Reading a lazy list again in a later query after it was streamed
+# raises a ValueError.
+
+
+# Reads the items of a lazy list. tail is the term after the last item.
+class LazySource():
+    def __init__(self, items, convert, tail):
+        self.items = iter(items)
+        self.convert = convert
+        self.tail = tail
+        self.kept = False               # Whether the list is in a clause, so it can't be streamed.
+        self.lock = threading.Lock()    # So two threads can't read the same cell.
+    # Returns the cell of a LazyList, reading the next item if it hasn't been read yet.
+    def read(self, lazy):
+        with self.lock:
+            if lazy.cell is None:
+                if lazy.streamed:
+                    raise ValueError("A lazy list can't be read again after member, length or append streamed it.")
+                lazy.cell = self.next()
+            return lazy.cell
+    # Returns the cell of a LazyList without keeping it, for a walk that streams the list.
+    def stream(self, lazy):
+        with self.lock:
+            if lazy.cell is not None:
+                return deref(lazy.cell)
+            if lazy.streamed:
+                raise ValueError("A lazy list can't be read again after member, length or append streamed it.")
+            lazy.streamed = True
+            return deref(self.next())
+    def next(self):
+        try:
+            item = next(self.items)
+        except StopIteration:
+            return self.tail
+        return LazyCell(self.convert(item), LazyList(self))
+
+
+# The unread part of a lazy list.
+class LazyList(Var):
+    def __init__(self, source):
+        self.name = "_lazy"
+        self.source = source
+        self.cell = None
+        self.streamed = False
+    @property
+    def ref(self):
+        if self.cell is None:
+            return self.source.read(self)
+        return self.cell
+
+
+# A cell that has been read from a lazy list.
+class LazyCell(BuiltList):
+    pass
+
+
+def lazyList(items, convert = None):
+    return LazyList(LazySource(items, dataTerm if convert is None else lambda item: dataTerm(convert(item)), Const([])))
+
+
+# Returns a Python value as a term, without reading strings as Vars or math, so data is always an atom, a number,
+# or a list of them.
+def dataTerm(value):
+    if isinstance(value, Term):
+        return value
+    if isinstance(value, (list, tuple)):
+        return makeList([dataTerm(item) for item in value])
+    return Const(value)
+
+
+# Yields the items of a list for a lazy list made by append, which must end in [].
+def appendItems(term, streaming):
+    term = walkTerm(term, streaming)
+    while isinstance(term, ListPL):
+        yield term.head
+        term = walkTerm(term.tail, streaming)
+    if not (isinstance(term, Const) and term.value == []):
+        raise ValueError("append can't make a lazy list from a list that ends in '" + str(term.name) + "'.")
+
+
+# Runs a goal that goes on where a walk stopped, yielding once for each solution.
+def restGoal(goal, state, depth):
+    for attempt in tryGoal(goal, state, depth + 1):
+        if not attempt[0]:
+            break
+        yield True
+
+
+# Dereferences a term of a list that is being walked. A walk that streams a lazy list reads the cells that
+# haven't been read yet without keeping them, so the ones it has walked past can be freed.
+def walkTerm(term, streaming):
+    if streaming and isinstance(term, LazyList) and term.cell is None and not term.source.kept:
+        return term.source.stream(term)
+    return deref(term)
+
+
+# Each walk takes the goal, the query state, the depth and whether it streams the list, and yields once for
+# each solution.
+def memberWalk(goal, state, depth, streaming):
+    item = goal.args[0]
+    term = walkTerm(goal.args[1], streaming)
+    while isinstance(term, LazyCell):
+        mark = len(state.trail)
+        if unify(item, term.head, state):
+            yield True
+        state.undo(mark)
+        term = walkTerm(term.tail, streaming)
+    yield from restGoal(Goal(member, [item, term]), state, depth)
+
+def lengthWalk(goal, state, depth, streaming):
+    count = 0
+    term = walkTerm(goal.args[0], streaming)
+    while isinstance(term, LazyCell):
+        count += 1
+        term = walkTerm(term.tail, streaming)
+    if isinstance(term, Const) and term.value == []:
+        yield from unifyEach([(goal.args[1], Const(count))], state)
+        return
+    restLength = Var("_")
+    for solved in restGoal(Goal(length, [term, restLength]), state, depth):
+        yield from unifyEach([(goal.args[1], Const(count + restLength.value))], state)
+
+def appendWalk(goal, state, depth, streaming):
+    first, second, whole = goal.args
+    if isinstance(deref(whole), Var):
+        items = appendItems(first, streaming)
+        yield from unifyEach([(whole, LazyList(LazySource(items, lambda item: item, second)))], state)
+        return
+    mark = len(state.trail)
+    term = walkTerm(first, streaming)
+    rest = whole
+    while isinstance(term, LazyCell):
+        cell = deref(rest)
+        if isinstance(cell, Var):
+            cell = BuiltList(Var("_"), Var("_"))
+            unify(rest, cell, state)
+        if not isinstance(cell, ListPL) or not unify(term.head, cell.head, state):
+            state.undo(mark)
+            return
+        rest = cell.tail
+        term = walkTerm(term.tail, streaming)
+    yield from restGoal(Goal(append, [term, second, rest]), state, depth)
+    state.undo(mark)
+
+
+# The arity of each walk, and the position of the list that must be lazy for it to be used.
+lazyWalks = {member: (2, 1, memberWalk), length: (2, 0, lengthWalk), append: (3, 0, appendWalk)}
+
+
+# Returns the walk for a goal, or None if its list isn't lazy.
+def lazyWalk(goal):
+    arity, position, walk = lazyWalks[goal.pred]
+    if len(goal.args) != arity:
+        return None
+    arg = goal.args[position]
+    if isinstance(arg, LazyList) and arg.cell is None and not arg.source.kept:
+        return functools.partial(walk, streaming = True)    # Only this goal has the list, so nothing else reads it.
+    if isinstance(deref(arg), LazyCell):
+        return functools.partial(walk, streaming = isinstance(arg, LazyCell))
+    return None
+
+
+# #### Grammar Rules ####
+
+# Grammar rules (DCGs) are added as head >= body, like Prolog's head --> body:
+#   greeting() >= [["'hello'"], name("N")]
+#   name("N") >= [["N"], {member("N", ["'bob'", "'ann'"])}]
+# Each item of the body is a goal of another grammar rule, a list of tokens, a set of one goal that is run
+# without reading any tokens, like {gt("X", 0)}, cut(), or not_(items), which reads nothing and succeeds if
+# the items can't be read.
+# Each rule is made into a clause with two more args, the tokens before the rule and the tokens left after it,
+# which are passed through the body as difference lists, so no list is split with append. The tokens at the
+# start of the body go into the clause's head, so a goal that is given tokens only tries the rules that can
+# start with its first one (see itemIndexed in ClauseAnalysis), and parsing takes time about linear in the tokens.
+# A cut in a rule that has read many tokens is slower, since Python takes time that grows with the number of
+# running generators to close the ones it cuts.
+# Rules run on a thread with a deep stack (see deepGoals), so they can read tens of thousands of tokens.
+# phrase(Rule, Tokens) reads all of the tokens with a rule, and phrase(Rule, Tokens, Rest) leaves Rest unread.
+# Rule may also be a list of tokens.
+
+phrase = Predicate("phrase")
+
+
+# Returns the head and goals of the clause for a grammar rule.
+def grammarClause(head, body):
+    items = body if isinstance(body, list) else [body]
+    names = ("S__" + str(number) for number in itertools.count())   # The names of the Vars for the tokens.
+    start = current = next(names)
+    if items and isinstance(items[0], list) and items[0]:
+        current = next(names)
+        start = items[0] + ["|", current]
+        items = items[1:]
+    goals, current = grammarGoals(items, current, names)
+    return Goal(head.pred, head.args + [start, current]), goals
+
+
+# Returns the goals for the items of a grammar rule, which read the tokens in the Var named current,
+# and the name of the Var for the tokens left after them.
+def grammarGoals(items, current, names):
+    goals = []
+    for item in items:
+        if isinstance(item, list):
+            if item:
+                after = next(names)
+                goals.append(Goal(equals, [current, item + ["|", after]]))
+                current = after
+        elif isinstance(item, (set, frozenset)):
+            if len(item) != 1:
+                raise ValueError("Each {} in a grammar rule must hold one goal.")
+            goals.extend(item)
+        elif isinstance(item, Goal) and item.pred == cut:
+            goals.append(item)
+        elif isinstance(item, Goal) and item.pred == not_:
+            inner = item.args[0] if isinstance(item.args[0], list) else [item.args[0]]
+            goals.append(Goal(not_, [grammarGoals(inner, current, names)[0]]))
+        elif isinstance(item, Goal):
+            after = next(names)
+            goals.append(Goal(item.pred, item.args + [current, after]))
+            current = after
+        else:
+            raise ValueError(repr(item) + " can't be used in a grammar rule.")
+    return goals, current
+
+
+def phraseGoal(goal, state, depth):
+    rule = deref(goal.args[0])
+    rest = goal.args[2] if len(goal.args) > 2 else Const([])
+    if isinstance(rule, Goal):
+        goals = [Goal(rule.pred, rule.args + [goal.args[1], rest])]
+    elif isinstance(rule, ListPL) or (isinstance(rule, Const) and rule.value == []):
+        goals = [Goal(equals, [goal.args[1], makeList(listTerms(rule), rest)])]
+    else:
+        raise ValueError("phrase needs a grammar rule, but was given " + str(flatten(rule.value)) + ".")
+    mark = len(state.trail)
+    for attempt in deepGoals(goals, state, depth + 1):
+        if not attempt[0]:
+            break
+        yield True
+    state.undo(mark)
+
+
+# A grammar rule calls itself once for each token it reads, so long token lists would run out of Python's
+# stack after a few hundred tokens. phrase runs the rule on a thread of its own, with a stack of
+# deepStackSize bytes, and raises the recursion limit to deepRecursionLimit while any such thread runs,
+# which is enough for about thirty thousand tokens.
+deepStackSize = 256 * 1024 * 1024
+deepRecursionLimit = 100000
+deepThread = threading.local()
+deepLock = threading.Lock()
+deepThreads = {"running": 0, "limit": None}
+
+
+# Yields the answers to the goals like solveGoals does, but solves them on a deep stack thread.
+# The two threads take turns, so the goals still share the query's state and bindings.
+def deepGoals(goals, state, depth):
+    if getattr(deepThread, "active", False):
+        yield from solveGoals(goals, state, depth)      # Already on a deep stack.
+        return
+    requests = queue.Queue()
+    answers = queue.Queue()
+    branch = getattr(branchThread, "active", False)
+
+    def work():
+        deepThread.active = True
+        branchThread.active = branch
+        attempts = solveGoals(goals, state, depth)
+        try:
+            while requests.get():
+                try:
+                    answers.put((next(attempts, None), None))
+                except BaseException as err:
+                    answers.put((None, err))
+                    break
+        finally:
+            if hasattr(attempts, "close"):
+                attempts.close()        # On this thread, since closing the goals unwinds the same stack.
+
+    with deepLock:
+        if deepThreads["running"] == 0:
+            deepThreads["limit"] = sys.getrecursionlimit()
+            sys.setrecursionlimit(max(deepRecursionLimit, deepThreads["limit"]))
+        deepThreads["running"] += 1
+        size = threading.stack_size(deepStackSize)
+        try:
+            thread = threading.Thread(target = work, daemon = True)
+            thread.start()
+        finally:
+            threading.stack_size(size)
+    try:
+        while True:
+            requests.put(True)
+            attempt, error = answers.get()
+            if error is not None:
+                raise error
+            if attempt is None:
+                break
+            yield attempt
+    finally:
+        requests.put(False)
+        thread.join()
+        with deepLock:
+            deepThreads["running"] -= 1
+            if deepThreads["running"] == 0:
+                sys.setrecursionlimit(deepThreads["limit"])
+
+
+controlGoals[phrase] = phraseGoal
+impureGoals.add(phrase)         # Like call, the rule it runs may be impure.
+depthFirstGoals.add(phrase)
+
+
+# #### Reading Prolog Text ####
+
+# consult(path) reads clauses and grammar rules written in Prolog, and adds them like >> and >= do:
+#   parent(X, Y) :- child(Y, X), \+ X = Y.
+#   greeting --> [hello], name.
+# Predicates are looked up by name in predicates, a dict like globals(), and then in the built-ins. The ones
+# that aren't found are made, and added to predicates if it doesn't have anything else by that name.
+# consult returns a dict of every predicate the text used. consultText does the same for a string of Prolog.
+# Atoms are always quoted, so they stay atoms, and "text" is a list of one-letter atoms. The math of is and the
+# comparisons is made into PL's math, and =, \=, \+, !, ->, true, fail and format are made into the built-ins
+# that mean the same thing. A ; that is the whole body of a clause makes a clause for each side, and other ;s must
+# be if-then-else. Directives, like :- initialization(main), are run as queries when they are read.
+
+prologToken = re.compile("|".join([
+    r"(?P<layout>\s+|%[^\n]*|/\*.*?\*/)",
+    r"(?P<num>\d+\.\d+(?:[eE][+-]?\d+)?|\d+)",
+    r"(?P<var>[A-Z_][A-Za-z0-9_]*)",
+    r"(?P<atom>[a-z][A-Za-z0-9_]*|[!;]|[-+*/\\^<>=~:.?@#&$]+)",
+    r"(?P<quoted>'(?:[^'\\]|''|\\.)*')",
+    r"(?P<string>\"(?:[^\"\\]|\"\"|\\.)*\")",
+    r"(?P<punct>[()\[\]{},|])"]), re.S)
+
+# The priority and type of each operator.
+infixOperators = {":-": (1200, "xfx"), "-->": (1200, "xfx"), ";": (1100, "xfy"), "->": (1050, "xfy"),
+    ",": (1000, "xfy"), "=": (700, "xfx"), "\\=": (700, "xfx"), "is": (700, "xfx"), "<": (700, "xfx"),
+    ">": (700, "xfx"), "=<": (700, "xfx"), ">=": (700, "xfx"), "=:=": (700, "xfx"), "=\\=": (700, "xfx"),
+    "==": (700, "xfx"), "\\==": (700, "xfx"), "+": (500, "yfx"), "-": (500, "yfx"), "*": (400, "yfx"),
+    "/": (400, "yfx"), "//": (400, "yfx"), "mod": (400, "yfx"), "**": (200, "xfx"), "^": (200, "xfy")}
+prefixOperators = {":-": (1200, "fx"), "?-": (1200, "fx"), "dynamic": (1150, "fx"), "discontiguous": (1150, "fx"),
+    "\\+": (900, "fy"), "-": (200, "fy")}
+
+prologComparisons = {"<": lt, "=<": le, ">": gt, ">=": ge, "=:=": equals, "=\\=": notEqual}
+prologMath = {"+": "+", "-": "-", "*": "*", "/": "/", "//": "//", "mod": "%", "**": "**", "^": "**"}
+
+
+def consult(path, predicates = None):
+    with open(path) as file:
+        return consultText(file.read(), predicates)
+
+
+def consultText(text, predicates = None):
+    reader = PrologReader(text, {} if predicates is None else predicates)
+    reader.load()
+    return reader.used
+
+
+# Splits Prolog text into (kind, text, whether there was layout before it, line) tokens.
+def prologTokens(text):
+    tokens = []
+    position = 0
+    line = 1
+    layout = True
+    while position < len(text):
+        match = prologToken.match(text, position)
+        if match is None:
+            raise ValueError("Line " + str(line) + ": " + repr(text[position:position + 20]) + " can't be read.")
+        kind = match.lastgroup
+        value = match.group()
+        if kind == "layout":
+            layout = True
+        else:
+            if kind == "atom" and value == "." and (match.end() == len(text) or text[match.end()] in " \t\r\n%"):
+                kind = "end"
+            elif kind == "quoted" or kind == "string":
+                quote = value[0]
+                value = re.sub(r"\\(.)", lambda escape: {"n": "\n", "t": "\t"}.get(escape.group(1), escape.group(1)),
+                    value[1:-1].replace(quote * 2, quote))
+            tokens.append((kind, value, layout, line))
+            layout = False
+        line += match.group().count("\n")
+        position = match.end()
+    tokens.append(("eof", "", True, line))
+    return tokens
+
+
+# Reads Prolog text into trees of ("num", value), ("var", name), ("atom", name), ("string", text),
+# ("list", items, tail) and ("compound", name, args), and then into PL's clauses.
+class PrologReader():
+    def __init__(self, text, predicates):
+        self.tokens = prologTokens(text)
+        self.position = 0
+        self.predicates = predicates
+        self.used = {}
+    def error(self, message):
+        return ValueError("Line " + str(self.tokens[min(self.position, len(self.tokens) - 1)][3]) + ": " + message)
+    def peek(self):
+        return self.tokens[self.position]
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+    # Reads the token if it is the punctuation given.
+    def take(self, text):
+        token = self.peek()
+        if token[0] == "punct" and token[1] == text:
+            self.position += 1
+            return True
+        return False
+    def expect(self, text):
+        if not self.take(text):
+            raise self.error("expected " + text + " before " + repr(self.peek()[1]) + ".")
+    # Reads a term whose operators have a priority of at most maxPriority.
+    def parse(self, maxPriority):
+        left, leftPriority = self.primary(maxPriority)
+        while True:
+            token = self.peek()
+            if token[0] == "atom" and token[1] in infixOperators:
+                name = token[1]
+            elif token[0] == "punct" and token[1] in (",", "|"):
+                name = "," if token[1] == "," else ";"
+            else:
+                break
+            priority, kind = infixOperators[name]
+            leftMax = priority if kind == "yfx" else priority - 1
+            rightMax = priority if kind == "xfy" else priority - 1
+            if priority > maxPriority or leftPriority > leftMax:
+                break
+            self.next()
+            left = ("compound", name, [left, self.parse(rightMax)])
+            leftPriority = priority
+        return left
+    # Reads a term that isn't an infix operator, and returns it with its priority.
+    def primary(self, maxPriority):
+        kind, text, layout, line = self.next()
+        if kind == "num":
+            return ("num", float(text) if "." in text else int(text)), 0
+        if kind == "var" or kind == "string":
+            return (kind, text), 0
+        if kind == "punct" and text == "(":
+            term = self.parse(1200)
+            self.expect(")")
+            return term, 0
+        if kind == "punct" and text == "[":
+            if self.take("]"):
+                return ("atom", "[]"), 0
+            items = [self.parse(999)]
+            while self.take(","):
+                items.append(self.parse(999))
+            tail = self.parse(999) if self.take("|") else None
+            self.expect("]")
+            return ("list", items, tail), 0
+        if kind == "punct" and text == "{":
+            if self.take("}"):
+                return ("atom", "{}"), 0
+            term = self.parse(1200)
+            self.expect("}")
+            return ("compound", "{}", [term]), 0
+        if kind != "atom" and kind != "quoted":
+            self.position -= 1
+            raise self.error((repr(text) if text else "the end") + " can't start a term.")
+        following = self.peek()
+        if following[0] == "punct" and following[1] == "(" and not following[2]:
+            self.next()
+            args = [self.parse(999)]
+            while self.take(","):
+                args.append(self.parse(999))
+            self.expect(")")
+            return ("compound", text, args), 0
+        if kind == "atom" and text == "-" and following[0] == "num" and not following[2]:
+            number = self.primary(0)[0]
+            return ("num", -number[1]), 0
+        if kind == "atom" and text in prefixOperators and self.startsTerm(following):
+            priority, operatorKind = prefixOperators[text]
+            priority = min(priority, maxPriority)
+            operand = self.parse(priority if operatorKind == "fy" else priority - 1)
+            return ("compound", text, [operand]), priority
+        return ("atom", text), 0
+    @staticmethod
+    def startsTerm(token):
+        if token[0] == "atom":
+            return token[1] not in infixOperators
+        return token[0] in ("num", "var", "string", "quoted") or (token[0] == "punct" and token[1] in "([{")
+    # Reads the goals of a query, which may end with a full stop.
+    def query(self):
+        term = self.parse(1200)
+        if self.next()[0] not in ("end", "eof"):
+            self.position -= 1
+            raise self.error("expected the end of the query before " + repr(self.peek()[1]) + ".")
+        if term[0] == "compound" and term[1] == "?-" and len(term[2]) == 1:
+            term = term[2][0]
+        return self.goals(term)
+    # Reads every clause, and adds it to the knowledge base.
+    def load(self):
+        while self.peek()[0] != "eof":
+            clause = self.parse(1200)
+            if self.next()[0] != "end":
+                self.position -= 1
+                raise self.error("expected the end of the clause before " + repr(self.peek()[1]) + ".")
+            if clause[0] == "compound" and clause[1] in (":-", "?-") and len(clause[2]) == 1:
+                directive = clause[2][0]
+                if not (directive[0] == "compound" and directive[1] in ("dynamic", "discontiguous")):
+                    Query() << self.goals(directive)
+            elif clause[0] == "compound" and clause[1] == ":-":
+                for body in self.alternatives(clause[2][1]):
+                    self.head(clause[2][0]) >> self.goals(body)
+            elif clause[0] == "compound" and clause[1] == "-->":
+                for body in self.alternatives(clause[2][1]):
+                    self.head(clause[2][0]) >= self.grammarItems(body)
+            else:
+                self.head(clause) >> []
+    def predicate(self, name):
+        pred = self.predicates.get(name)
+        if not isinstance(pred, Predicate):
+            pred = self.used.get(name) or globals().get(name)
+            if not isinstance(pred, Predicate):
+                pred = Predicate(name)
+                self.predicates.setdefault(name, pred)
+        self.used[name] = pred
+        return pred
+    # The sides of a ; that is a whole body, which each make a clause.
+    def alternatives(self, body):
+        if body[0] == "compound" and body[1] == ";" and not self.isIfThen(body[2][0]):
+            return self.alternatives(body[2][0]) + self.alternatives(body[2][1])
+        return [body]
+    @staticmethod
+    def isIfThen(term):
+        return term[0] == "compound" and term[1] == "->" and len(term[2]) == 2
+    def head(self, term):
+        if term[0] == "atom":
+            return Goal(self.predicate(term[1]), [])
+        if term[0] == "compound":
+            return Goal(self.predicate(term[1]), [self.raw(arg) for arg in term[2]])
+        raise self.error(self.text(term) + " can't be the head of a clause.")
+    # Returns a term as a raw arg, like the ones that are written in Python.
+    def raw(self, term):
+        kind = term[0]
+        if kind == "num":
+            return term[1]
+        if kind == "var":
+            return "V" + term[1] if len(term[1]) > 1 and term[1][0] == "_" else term[1]   # So that create keeps it.
+        if kind == "atom":
+            return [] if term[1] == "[]" else "'" + term[1] + "'"
+        if kind == "string":
+            return ["'" + char + "'" for char in term[1]]
+        if kind == "list":
+            items = [self.raw(item) for item in term[1]]
+            return items if term[2] is None else items + ["|", self.raw(term[2])]
+        return Goal(self.predicate(term[1]), [self.raw(arg) for arg in term[2]])
+    # Returns a term as a raw arg that is evaluated as math.
+    def math(self, term):
+        if term[0] == "num" or term[0] == "var":
+            return self.raw(term)
+        return self.mathText(term)
+    def mathText(self, term):
+        if term[0] == "num":
+            return str(term[1]) if term[1] >= 0 else "(" + str(term[1]) + ")"
+        if term[0] == "var":
+            return self.raw(term)
+        if term[0] == "compound" and len(term[2]) == 2 and term[1] in prologMath:
+            return "(" + self.mathText(term[2][0]) + " " + prologMath[term[1]] + " " + self.mathText(term[2][1]) + ")"
+        if term[0] == "compound" and len(term[2]) == 1 and term[1] == "-":
+            return "(- " + self.mathText(term[2][0]) + ")"
+        raise self.error(self.text(term) + " can't be used in math.")
+    # Returns the goals of a body.
+    def goals(self, term):
+        if term[0] == "compound" and term[1] == "," and len(term[2]) == 2:
+            return self.goals(term[2][0]) + self.goals(term[2][1])
+        if term[0] == "atom" and term[1] == "true":
+            return []
+        return [self.goal(term)]
+    def goal(self, term):
+        kind = term[0]
+        if kind == "var":
+            return Goal(call, [self.raw(term)])
+        if kind == "atom":
+            if term[1] == "!":
+                return Goal(cut, [])
+            if term[1] == "fail" or term[1] == "false":
+                return Goal(fail, [])
+            return Goal(self.predicate(term[1]), [])
+        if kind != "compound":
+            raise self.error(self.text(term) + " can't be a goal.")
+        name, args = term[1], term[2]
+        if name == ";" and len(args) == 2:
+            if not self.isIfThen(args[0]):
+                raise self.error("a ; that isn't the whole body of a clause must be (If -> Then ; Else).")
+            condition, then = args[0][2]
+            return Goal(if_then_else, [self.goals(condition), self.goals(then), self.goals(args[1])])
+        if name == "->" and len(args) == 2:
+            return Goal(if_then, [self.goals(args[0]), self.goals(args[1])])
+        if (name == "\\+" or name == "not") and len(args) == 1:
+            return Goal(not_, [self.goals(args[0])])
+        if name in prologComparisons and len(args) == 2:
+            return Goal(prologComparisons[name], [self.math(arg) for arg in args])
+        if name == "is" and len(args) == 2:
+            return Goal(equals, [self.raw(args[0]), self.math(args[1])])
+        if name == "format" and len(args) <= 2 and args[0][0] in ("string", "atom"):
+            values = args[1] if len(args) > 1 else ("atom", "[]")
+            items = [self.raw(item) for item in values[1]] if values[0] == "list" else [] if values == ("atom", "[]") else [self.raw(values)]
+            return Goal(format_, [self.formatText(args[0][1]), items])
+        if name == "=" and len(args) == 2:
+            return Goal(equals, [self.raw(arg) for arg in args])
+        if name == "\\=" and len(args) == 2:
+            return Goal(notEqual, [self.raw(arg) for arg in args])
+        if name == ",":
+            return Goal(call, [self.goals(term)])
+        return Goal(self.predicate(name), [self.raw(arg) for arg in args])
+    # Makes the ~w, ~a, ~d and ~n of format into the text that format_ writes.
+    @staticmethod
+    def formatText(text):
+        text = text.replace("{", "{{").replace("}", "}}")
+        return re.sub("~([wapdsn~])", lambda directive: {"n": "\n", "~": "~"}.get(directive.group(1), "{}"), text)
+    # Returns the items of the body of a grammar rule, like the ones given to >=.
+    def grammarItems(self, term):
+        if term[0] == "compound" and term[1] == "," and len(term[2]) == 2:
+            return self.grammarItems(term[2][0]) + self.grammarItems(term[2][1])
+        if term[0] in ("list", "string") or term == ("atom", "[]"):
+            return [self.raw(term)]
+        if term[0] == "compound" and term[1] == "{}":
+            return [{goal} for goal in self.goals(term[2][0])]
+        if term == ("atom", "!"):
+            return [Goal(cut, [])]
+        if term[0] == "compound" and term[1] == "\\+" and len(term[2]) == 1:
+            return [Goal(not_, [self.grammarItems(term[2][0])])]
+        if term[0] in ("atom", "compound"):
+            return [self.head(term)]
+        raise self.error(self.text(term) + " can't be used in a grammar rule.")
+    # Writes a tree back as Prolog, for errors.
+    def text(self, term):
+        if term[0] in ("num", "var", "atom"):
+            return str(term[1])
+        if term[0] == "string":
+            return '"' + term[1] + '"'
+        if term[0] == "list":
+            return "[" + ", ".join(self.text(item) for item in term[1]) + ("" if term[2] is None else "|" + self.text(term[2])) + "]"
+        return term[1] + "(" + ", ".join(self.text(arg) for arg in term[2]) + ")"
+
+
+# #### Command Line ####
+
+# python -m PL family.py rules.pl < queries.txt answers queries in a shell pipeline. The knowledge base is loaded
+# from Python modules, whose Predicates are found by name, and from files of Prolog text (see consult), in order.
+# Each line of the queries is the goals of a query written in Prolog, like grandparent(X, 'Bob'), or a request
+# in the JSON that a QueryServer reads. Each answer is written as a line of JSON as soon as it is found, in the
+# messages that a QueryServer sends, and each query's id is the number of its line unless its request has one.
+# --limit, --max-time, --max-inferences and --max-depth limit each query, unless its request has its own limits.
+# --workers runs that many queries at once in their own processes, so their answers may be written in any order.
+
+batchPredicates = None      # The knowledge base that main loaded, which forked workers share.
+
+
+def commandLine():
+    parser = argparse.ArgumentParser(prog = "python -m PL", description = "Answers queries, one per line, "
+        "and writes each answer as a line of JSON as soon as it is found.")
+    parser.add_argument("files", nargs = "*", help = "Python modules and Prolog files (.pl) with the knowledge base")
+    parser.add_argument("-q", "--queries", default = "-", help = "the file of queries, or - for stdin (the default)")
+    parser.add_argument("--limit", type = int, help = "the most answers to give to each query")
+    parser.add_argument("--max-time", type = float, help = "the most seconds each query may take")
+    parser.add_argument("--max-inferences", type = int, help = "the most goals each query may call")
+    parser.add_argument("--max-depth", type = int, help = "the deepest each query's goals may go")
+    parser.add_argument("--workers", type = int, default = 1, help = "how many queries to run at once")
+    return parser
+
+
+# Loads Python modules and Prolog files, and returns a dict of their predicates by name.
+def loadKnowledgeBase(files):
+    predicates = {pred.name: pred for pred in Predicate.registry}
+    for path in files:
+        if path.endswith(".pl"):
+            consult(path, predicates)
+            continue
+        if path.endswith(".py") or os.path.sep in path:
+            name = os.path.splitext(os.path.basename(path))[0]
+            sys.path.insert(0, os.path.dirname(os.path.abspath(path)))    # So it can import the modules next to it.
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(path)
+        predicates.update({name: pred for name, pred in vars(module).items() if isinstance(pred, Predicate)})
+    return predicates
+
+
+# Returns a function that writes messages as lines of JSON, one at a time.
+def lineWriter(lock):
+    def send(message):
+        line = json.dumps(message, default = jsonValue) + "\n"
+        with lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    return send
+
+
+def batchWorker(files, settings, tasks, lock):
+    predicates = batchPredicates if batchPredicates is not None else loadKnowledgeBase(files)
+    send = lineWriter(lock)
+    try:
+        for number, line in iter(tasks.get, None):
+            answerLine(line, predicates, send, settings, number)
+            sys.stdout.flush()      # answerLine stops quietly when stdout is closed, so check it again here.
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def main(arguments = None):
+    global batchPredicates
+    parser = commandLine()
+    options = parser.parse_args(arguments)
+    settings = {"limit": options.limit, "maxTime": options.max_time, "maxInferences": options.max_inferences,
+        "maxDepth": options.max_depth}
+    settings = {key: value for key, value in settings.items() if value is not None}
+    try:
+        batchPredicates = loadKnowledgeBase(options.files)
+    except (OSError, ValueError) as err:
+        parser.error(str(err))
+    queries = sys.stdin if options.queries == "-" else open(options.queries)
+    lines = ((number, line) for number, line in enumerate(queries, 1) if line.strip())
+    try:
+        if options.workers <= 1:
+            send = lineWriter(threading.Lock())
+            for number, line in lines:
+                answerLine(line, batchPredicates, send, settings, number)
+                sys.stdout.flush()
+            return 0
+        tasks = multiprocessing.Queue(options.workers * 16)
+        lock = multiprocessing.Lock()
+        workers = [multiprocessing.Process(target = batchWorker, args = (options.files, settings, tasks, lock),
+            daemon = True) for _ in range(options.workers)]
+        for worker in workers:
+            worker.start()
+        for task in itertools.chain(lines, [None] * len(workers)):
+            while True:
+                try:
+                    tasks.put(task, timeout = 1)
+                    break
+                except queue.Full:
+                    if not any(worker.is_alive() for worker in workers):
+                        return 1    # The workers have stopped, e.g. because the output was closed.
+        for worker in workers:
+            worker.join()
+        return 0
+    except BrokenPipeError:
+        # The output was closed, e.g. by head, so stop without Python complaining that it can't flush it.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if queries is not sys.stdin:
+            queries.close()
+
+
+if __name__ == "__main__":
+    # Knowledge bases import PL, so run the module they get, not this copy of it that Python runs as __main__.
+    import PL
+    sys.exit(PL.main())
@@ -215,6 +215,12 @@ studies("alex", "physics") >> []
 # query << [all_diff(["a", "b", "c"])]
 # query << [all_diff(["a", "b", "c", "b"])]
 # query << [between(1, 3, "X"), between(1, 3, "Y"), between(1, 3, "Z"), all_diff(["X", "Y", "Z"])]
+# query << [ins(["X", "Y", "Z"], 1, 3), all_different(["X", "Y", "Z"]), label(["X", "Y", "Z"])]    # Constraints prune before labelling.
+# query << [in_("X", 1, 10), in_("Y", 1, 10), fdEquals("X + Y", 15), fdLt("X", "Y"), label(["X", "Y"])]
+# query << [in_("X", 0, 100), fdEquals("X * X", 49), label(["X"])]
+# query << [fdEquals("X", "Y + 1"), equals("Y", 2)]    # Vars without an in_ may have any value.
+# query << [in_("X", 1, 3), fdEquals("Y", "X + 1"), label(["X"])]
+# query << [fdLe("X", 5), fdGe("X", 3), label(["X"])]
 # query << [not_(member("X", ["a", "b", "c"])), equals("X", "f")]
 # query << [equals("X", "f"), not_(member("X", ["a", "b", "c"]))]
 # query << [equals("X", ["q", "y", "z", "w"]), not_(length("X", 4))]
@@ -229,6 +235,10 @@ studies("alex", "physics") >> []
 # query << [is_digesting("X", "Y")]
 # query(3) << [collatz(10, "L")]          # To see only some results, use query(number_of_results).
 # query(10) << [count(0, "X")]
+# query(maxInferences = 100) << [count(0, "X")]     # Stops with inference_limit_exceeded as the last result.
+# query(maxDepth = 50) << [collatz(27, "L")]
+# query(maxTime = 0.5) << [count(0, "X")]
+# query << [call_with_inference_limit(count(0, "X"), 30, "Result")]
 # query << [always_true()]
 # query << [equals("X", [])]
 # query << [basicList(["X", "Y", "Z"])]
@@ -265,7 +275,7 @@ studies("alex", "physics") >> []
 # query << [ismember2(1, [1, 2, 3, 1])]
 # query << [ismember2("X", [1, 2, 3, 1])]
 # query << [sublist_cut(["a"], ["b", "a", "a", "b"])]
-# query << [teaches("dr_fred", "Course"), studies("Student", "Course")]
+# query << [teaches("dr_fred", "Course"), studies("Student", "Course")]      # Fact tables are joined on Course all at once.
 # query << [teaches("dr_fred", "Course"), cut(), studies("Student", "Course")]
 # query << [teaches("dr_fred", "Course"), studies("Student", "Course"), cut()]
 # query << [cut(), teaches("dr_fred", "Course"), studies("Student", "Course")]
@@ -278,8 +288,50 @@ studies("alex", "physics") >> []
 # query << [printUnsolvedMaze()]
 # query << [not_(male("bob"))]
 # query << [printSolvedMaze()]
+# query(output = print) << [printSolvedMaze()]          # Output can go to a file, a StringIO, or a function.
 # query << [format_("Hello, I'm {} and you are {}.", ["sawyer", "john"])]
 # query << [format_("{}'s brother is {}.", ["Child1", "Child2"])]
+# print(length.determinism())   # Shows the modes of each arity and whether it can leave choicepoints.
+# compileAll()                  # Runs every predicate as compiled Python code. Use e.g. merge.compile() for just one.
+# print(explain([uncle("X", "john")]))   # Shows the order query(reorder = True) would run the goals in.
+# uncle.reorder()                         # Runs the goals of uncle's alts in the cheapest order found.
+# ancestor.bottomUp()                     # Works out every ancestor fact at once, then answers from them.
+# sibling.materialize()                   # Keeps the sibling facts, updating them when facts are added or retracted.
+# child("bob", "john").retract()          # Removes a fact.
+# query << [set_new("S0"), set_add("S0", "'bob'", "S1"), set_add("S1", "'john'", "S"), set_member("X", "S")]
+# query << [map_new("M0"), map_put("M0", "'bob'", 30, "M"), map_get("M", "'bob'", "Age")]
+# query << [equals("S", {1, 2, 3}), set_size("S", "N")]     # Python sets and dicts are sets and maps.
+# query(select = ["X"]) << [length([1, 2, 3], "X")]           # Gives X as the number 3 instead of the string "3".
+# query(select = ["X", "Y"], tuples = True) << [append("X", "Y", [1, 2])]   # Each result is a tuple, like ([1], [2]).
+# child.shard(0, workers = 2)             # Keeps the child facts in 2 worker processes, split up by the first arg.
+# buildFactStore("family.facts", [male, female, child])   # Writes the facts to a file that processes can share.
+# child.mapFacts(FactStore("family.facts"))                # Looks up the child facts in the file instead.
+# server = QueryServer("/tmp/pl.sock", globals()).start()    # Answers queries from other processes, even about
+#                                                            # predicates defined after it started.
+# print(QueryClient("/tmp/pl.sock").query([child("X", "john")]))
+# children = prepare([child("X", "Parent")], ["Parent"])     # Makes the goals once.
+# print(children("'john'"), children("'kathryn'"))           # Runs them with Parent = john, then kathryn.
+# query(1, strategy = "breadth") << [ancestor("X", "john")]  # Finds the answer with the fewest steps first.
+# Goals whose clauses have a cut(), like maze.py's solve, are run depth-first by "breadth" and "best", and the
+# query's goals up to a cut() give only their first answer, so cut gives the same answers as with "depth".
+# query(strategy = "iterative") << [ancestor("X", "john")]  # Or "best", with heuristic = a predicate like h(Goal, Cost).
+# query(strategy = "iterative") << [not_(member("X", ["a", "b", "c"])), equals("X", "f")]   # [False], like "depth".
+# query(strategy = "iterative") << [member("X", [1, 2]), if_then_else(gt("X", 1), equals("Y", "big"), equals("Y", "small"))]
+# # not_, once, ignore and if_then_else's condition aren't cut off by iterative deepening, so they give the same answers.
+# query << [parallel([male("X")], [female("Y")])]            # Finds the males and the females at the same time.
+# query << [member("X", [1, 5]), if_then_else(gt("X", 2), equals("Y", "'big'"), equals("Y", "'small'"))]
+# query << [once(member("X", [1, 2, 3]))]                     # Only X = 1. ignore(Goal) also succeeds if Goal fails.
+# query << [call("G")]      # Raises a ValueError, since G isn't bound. call("'foo'") raises a TypeError.
+# query << [maplist(lambda_(["X", "Y"], equals("Y", "X + 1")), [12, 99, 4, -7], "L")]   # Like increment_all, in one step.
+# query << [numlist(1, 100, "L"), sum_list("L", "S"), foldl(lambda_(["X", "A0", "A"], equals("A", "A0 * X")), [1, 2, 3], 1, "P")]
+# query << [maplist(lambda_(["X", "Y"], equals("Y", "X ** 2 // 3")), [5, 7], "L")]   # L = [8, 16].
+# query << [member("X", lazyList(open("family.py"), str.strip)), equals("X", "'from PL import *'")]   # Reads lines as needed.
+# query << [length(lazyList(range(10 ** 6)), "N")]    # Streams the list, so memory stays flat however long it is.
+# sentence() >= [["'the'"], noun()]; noun() >= [["'cat'"]]; query << [phrase(sentence(), ["'the'", "'cat'"])]   # Grammar rules.
+# digits = Predicate("digits"); digits(["D", "|", "T"]) >= [["D"], digits("T")]; digits([]) >= []; query << [phrase(digits("Ds"), list(range(3000)))]   # Reads 3000 tokens.
+# consult("family.pl", globals())   # Adds the clauses in a file written in Prolog.
+# From a shell: echo "ancestor(X, bob)" | python -m PL family.py   # Writes each answer as a line of JSON.
+# From a shell: echo "true" | python -m PL family.py   # One answer, true, and then done, like query << [].
 
 
 ### Testing Zone ###
@@ -291,3 +343,4 @@ for result in query:
     # # If you want to use the results, you can do something like this:
     # X = result["X"]
     # print(X)
+    # # With query(select = ["X"]), X is a Python value, like a number or a list, instead of a string.